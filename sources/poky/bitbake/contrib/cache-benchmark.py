@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+#
+# Copyright BitBake Contributors
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+# Compare startup cost of the original single pickle stream bb_cache.dat
+# format against the indexed (mmap) format using synthetic recipe data.
+#
+# "cold" runs drop the file from the page cache first (best effort, via
+# posix_fadvise), "warm" runs read it straight after a previous load.
+#
+
+import argparse
+import os
+import pickle
+import resource
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.abspath(os.path.dirname(sys.argv[0])), '../lib'))
+import bb
+import bb.cache
+from bb.cache import CoreRecipeInfo, SiggenRecipeInfo, IndexedCacheFile, LazyDependsCache, write_indexed_cachefile
+
+def make_entries(count):
+    for i in range(count):
+        core = CoreRecipeInfo.__new__(CoreRecipeInfo)
+        core.__dict__.update({
+            "file_depends": [("/layers/meta/conf/include-%d.inc" % j, 1700000000 + j) for j in range(20)],
+            "timestamp": 1700000000,
+            "variants": [""],
+            "appends": [],
+            "nocache": "",
+            "pn": "recipe%d" % i,
+            "packages": ["recipe%d" % i, "recipe%d-dev" % i, "recipe%d-dbg" % i],
+            "skipped": False,
+            "tasks": ["do_%s" % t for t in ("fetch", "unpack", "patch", "configure", "compile", "install", "package")],
+            "depends": ["dep%d" % j for j in range(i % 30)],
+            "pv": "1.%d" % i,
+        })
+        siggen = SiggenRecipeInfo.__new__(SiggenRecipeInfo)
+        siggen.siggen_gendeps = {"do_compile": frozenset(["CC", "CFLAGS", "recipe%d_var" % i])}
+        siggen.siggen_varvals = {"do_compile": "oe_runmake %s" % ("x" * (i % 2000)), "CC": "gcc"}
+        siggen.siggen_taskdeps = {"do_compile": frozenset(["do_configure"])}
+        yield "/layers/meta/recipes/recipe%d/recipe%d_1.0.bb" % (i, i), [core, siggen]
+
+def write_legacy(files, entries):
+    for idx, cachefile in enumerate(files):
+        SiggenRecipeInfo.reset()
+        with open(cachefile, "wb") as f:
+            p = pickle.Pickler(f, pickle.HIGHEST_PROTOCOL)
+            p.dump(bb.cache.__cache_version__)
+            p.dump(bb.__version__)
+            for key, infos in entries:
+                p.dump(key)
+                p.dump(infos[idx])
+
+def write_indexed(files, entries):
+    for idx, cachefile in enumerate(files):
+        write_indexed_cachefile(cachefile, ((key, infos[idx]) for key, infos in entries))
+
+def drop_caches(files):
+    for cachefile in files:
+        with open(cachefile, "rb") as f:
+            os.fsync(f.fileno())
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+def load_legacy(files, touch):
+    depends_cache = {}
+    for cachefile in files:
+        SiggenRecipeInfo.reset()
+        with open(cachefile, "rb") as f:
+            pickled = pickle.Unpickler(f)
+            pickled.load()
+            pickled.load()
+            while True:
+                try:
+                    key = pickled.load()
+                    value = pickled.load()
+                except EOFError:
+                    break
+                depends_cache.setdefault(key, []).append(value)
+    return len(depends_cache)
+
+def load_indexed(files, touch):
+    depends_cache = LazyDependsCache([IndexedCacheFile(f) for f in files])
+    for n, key in enumerate(depends_cache):
+        if n >= touch:
+            break
+        depends_cache[key]
+    count = len(depends_cache)
+    depends_cache.close()
+    return count
+
+def timed(func, files, touch, cold):
+    if cold:
+        drop_caches(files)
+    start = time.perf_counter()
+    func(files, touch)
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description="bb_cache.dat startup benchmark")
+    parser.add_argument("--recipes", type=int, default=4000,
+                        help="Number of synthetic recipes (default: %(default)s)")
+    parser.add_argument("--touch", type=int, default=None,
+                        help="Number of entries the indexed loader deserializes (default: all)")
+    parser.add_argument("--runs", type=int, default=5,
+                        help="Number of runs for each measurement (default: %(default)s)")
+    args = parser.parse_args()
+
+    touch = args.recipes if args.touch is None else args.touch
+    entries = list(make_entries(args.recipes))
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        results = []
+        for name, write, load in (("legacy", write_legacy, load_legacy), ("indexed", write_indexed, load_indexed)):
+            files = [os.path.join(tmpdir, "%s-%s" % (name, c.cachefile)) for c in (CoreRecipeInfo, SiggenRecipeInfo)]
+            write(files, entries)
+            size = sum(os.path.getsize(f) for f in files)
+            cold = min(timed(load, files, touch, True) for _ in range(args.runs))
+            warm = min(timed(load, files, touch, False) for _ in range(args.runs))
+            results.append((name, size, cold, warm))
+
+    print("%d recipes, indexed loader touching %d entries" % (args.recipes, touch))
+    print("%-10s %12s %10s %10s" % ("format", "size", "cold (s)", "warm (s)"))
+    for name, size, cold, warm in results:
+        print("%-10s %12d %10.3f %10.3f" % (name, size, cold, warm))
+    print("Peak RSS: %d kB" % resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -24,7 +24,7 @@ import argparse
 
 # For importing bb.cache
 sys.path.insert(0, os.path.join(os.path.abspath(os.path.dirname(sys.argv[0])), '../lib'))
-from bb.cache import CoreRecipeInfo
+from bb.cache import CoreRecipeInfo, IndexedCacheFile, is_indexed_cachefile
 
 import pickle
 
@@ -44,33 +44,44 @@ class DumpCache(object):
 
         self.args = parser.parse_args()
 
-    def main(self):
-        with open(self.args.cachefile[0], "rb") as cachefile:
-            pickled = pickle.Unpickler(cachefile)
+    def entries(self, cachefile):
+        if is_indexed_cachefile(cachefile):
+            indexed = IndexedCacheFile(cachefile)
+            for key in indexed.keys():
+                yield key, indexed.load(key)
+            indexed.close()
+            return
+
+        with open(cachefile, "rb") as f:
+            pickled = pickle.Unpickler(f)
             while True:
                 try:
                     key = pickled.load()
                     val = pickled.load()
                 except Exception:
                     break
-                if isinstance(val, CoreRecipeInfo):
-                    pn = val.pn
+                yield key, val
+
+    def main(self):
+        for key, val in self.entries(self.args.cachefile[0]):
+            if isinstance(val, CoreRecipeInfo):
+                pn = val.pn
 
-                    if self.args.recipe and self.args.recipe != pn:
-                        continue
+                if self.args.recipe and self.args.recipe != pn:
+                    continue
 
-                    if self.args.skip and val.skipped:
-                        continue
+                if self.args.skip and val.skipped:
+                    continue
 
-                    if self.args.members:
-                        out = key
-                        for member in self.args.members.split(','):
-                            out += ": %s" % val.__dict__.get(member)
-                        print("%s" % out)
-                    else:
-                        print("%s: %s" % (key, val.__dict__))
-                elif not self.args.recipe:
-                    print("%s %s" % (key, val))
+                if self.args.members:
+                    out = key
+                    for member in self.args.members.split(','):
+                        out += ": %s" % val.__dict__.get(member)
+                    print("%s" % out)
+                else:
+                    print("%s: %s" % (key, val.__dict__))
+            elif not self.args.recipe:
+                print("%s %s" % (key, val))
 
 if __name__ == "__main__":
     try:
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+#
+# Copyright BitBake Contributors
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+# Measure how long the runqueue takes to compute the hashes of a synthetic
+# task graph when the hash equivalence server is some distance away.
+#
+# A local hash equivalence server is started behind a proxy which delays
+# everything passing through it by half the given round trip time in each
+# direction. RunQueueData.compute_task_hashes() is then run against it and
+# compared with looking up the unihashes a level of the graph at a time, as
+# was done before the lookups were pipelined. Each task burns some CPU time
+# in prep_taskhash() to stand in for the file checksums and signature data
+# work of a real build.
+#
+
+import argparse
+import asyncio
+import hashlib
+import os
+import sys
+import tempfile
+import threading
+import time
+import types
+
+sys.path.insert(0, os.path.join(os.path.abspath(os.path.dirname(sys.argv[0])), '../lib'))
+import bb
+import bb.parse
+import bb.runqueue
+import bb.siggen
+import hashserv
+
+# do_t5 stands in for do_populate_sysroot, the task other recipes depend upon
+TASKS = 8
+SETSCENE = (5, 6, 7)
+
+def make_rqdata(recipes):
+    rqdata = types.SimpleNamespace(runtaskentries={}, dataCaches=None, cooker=types.SimpleNamespace(data=None))
+    for r in range(recipes):
+        for t in range(TASKS):
+            entry = bb.runqueue.RunTaskEntry()
+            entry.depends = set()
+            if t:
+                entry.depends.add("recipe%d.bb:do_t%d" % (r, t - 1))
+            if t == 2 and r:
+                entry.depends |= set("recipe%d.bb:do_t5" % d for d in (r // 2, r // 3, r // 5, r // 7))
+            rqdata.runtaskentries["recipe%d.bb:do_t%d" % (r, t)] = entry
+    rqdata.taskgraph = bb.runqueue.TaskGraph(rqdata.runtaskentries)
+    return rqdata
+
+class SignatureGenerator(bb.siggen.SignatureGeneratorUniHashMixIn, bb.siggen.SignatureGenerator):
+    def __init__(self, server, rqdata, work):
+        self.server = server
+        self.method = "benchmark"
+        self.max_parallel = 1
+        self.rqdata = rqdata
+        self.work = work
+        super().__init__(types.SimpleNamespace(getVar=lambda var: None))
+        self.setscenetasks = set(tid for tid in rqdata.runtaskentries if int(tid[-1]) in SETSCENE)
+
+    def prep_taskhash(self, tid, deps, dataCaches):
+        self.tidtopn[tid] = tid.split(".")[0]
+        h = tid.encode("utf-8")
+        for _ in range(self.work):
+            h = hashlib.sha256(h).digest()
+        self.basehash[tid] = h.hex()
+        return deps
+
+    def get_taskhash(self, tid, deps, dataCaches):
+        data = self.basehash[tid] + "".join(self.get_unihash(dep) for dep in sorted(deps))
+        self.taskhash[tid] = hashlib.sha256(data.encode("utf-8")).hexdigest()
+        return self.taskhash[tid]
+
+def compute_levelled(rqdata):
+    graph = rqdata.taskgraph
+    for level in graph.levels():
+        ready = set()
+        for i in level:
+            tid = graph.tids[i]
+            bb.parse.siggen.prep_taskhash(tid, rqdata.runtaskentries[tid].depends, None)
+            rqdata.runtaskentries[tid].hash = bb.parse.siggen.get_taskhash(tid, rqdata.runtaskentries[tid].depends, None)
+            ready.add(tid)
+        unihashes = bb.parse.siggen.get_unihashes(ready)
+        for tid in ready:
+            rqdata.runtaskentries[tid].unihash = unihashes[tid]
+
+def compute_pipelined(rqdata):
+    bb.runqueue.RunQueueData.compute_task_hashes(rqdata)
+
+async def delay_stream(reader, writer, delay):
+    # Deliver each chunk delay seconds after it was read, without holding up
+    # the chunks behind it
+    chunks = asyncio.Queue()
+
+    async def read():
+        while True:
+            data = await reader.read(65536)
+            await chunks.put((time.monotonic() + delay, data))
+            if not data:
+                return
+
+    async def write():
+        while True:
+            when, data = await chunks.get()
+            wait = when - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            if not data:
+                writer.close()
+                return
+            writer.write(data)
+            await writer.drain()
+
+    await asyncio.gather(read(), write())
+
+def start_proxy(address, rtt):
+    host, port = address.rsplit(":", 1)
+    started = threading.Event()
+    proxy = {}
+
+    async def handle(client_reader, client_writer):
+        server_reader, server_writer = await asyncio.open_connection(host, int(port))
+        await asyncio.gather(delay_stream(client_reader, server_writer, rtt / 2),
+                             delay_stream(server_reader, client_writer, rtt / 2))
+
+    def main():
+        loop = asyncio.new_event_loop()
+        server = loop.run_until_complete(asyncio.start_server(handle, "127.0.0.1", 0))
+        proxy["address"] = "127.0.0.1:%d" % server.sockets[0].getsockname()[1]
+        started.set()
+        loop.run_forever()
+
+    threading.Thread(target=main, daemon=True).start()
+    started.wait()
+    return proxy["address"]
+
+def main():
+    parser = argparse.ArgumentParser(description="Time task hash computation against a hash equivalence server with added latency")
+    parser.add_argument("--recipes", type=int, default=1000,
+                        help="Number of recipes of %d tasks in the graph (default: %%(default)s)" % TASKS)
+    parser.add_argument("--rtt", type=float, default=50,
+                        help="Round trip time to the server in ms (default: %(default)s)")
+    parser.add_argument("--work", type=int, default=1000,
+                        help="Rounds of sha256 done in prep_taskhash for each task (default: %(default)s)")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Runs of each method, the best is reported (default: %(default)s)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        server = hashserv.create_server("127.0.0.1:0", os.path.join(tempdir, "hashserv.db"))
+        server.serve_as_process()
+        try:
+            address = start_proxy(server.address, args.rtt / 1000)
+            print("%d tasks, %.0fms round trip time" % (args.recipes * TASKS, args.rtt))
+            for name, compute in (("level by level", compute_levelled), ("pipelined", compute_pipelined)):
+                times = []
+                for _ in range(args.repeat):
+                    rqdata = make_rqdata(args.recipes)
+                    bb.parse.siggen = SignatureGenerator(address, rqdata, args.work)
+                    start = time.monotonic()
+                    compute(rqdata)
+                    times.append(time.monotonic() - start)
+                    bb.parse.siggen.exit()
+                print("%-15s %6.2fs" % (name, min(times)))
+        finally:
+            server.process.terminate()
+            server.process.join()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+#
+# Copyright BitBake Contributors
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+# Replay the storm of reports a hash equivalence server receives at the end
+# of a large build and report the latency of each report.
+#
+# Many clients connect at once and each reports the output hash of its
+# share of the tasks as fast as the server answers. Some of the tasks share
+# output hashes so that the server also has to find equivalent ones. Unless
+# an address is given a local server is started on a new sqlite database.
+#
+
+import argparse
+import asyncio
+import hashlib
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.abspath(os.path.dirname(sys.argv[0])), '../lib'))
+import hashserv
+
+METHOD = "report.storm"
+
+def make_hash(*args):
+    return hashlib.sha256(" ".join(str(a) for a in args).encode("utf-8")).hexdigest()
+
+async def run_client(address, seed, client, reports, equivalent, latencies):
+    async with await hashserv.create_async_client(address) as c:
+        for i in range(reports):
+            task = "%d.%d" % (client, i)
+            # Every equivalent-th task has the same output as one reported by
+            # another client
+            output = i if equivalent and i % equivalent == 0 else task
+            start = time.monotonic()
+            await c.report_unihash(make_hash(seed, "taskhash", task), METHOD,
+                                   make_hash(seed, "outhash", output), make_hash(seed, "unihash", task))
+            latencies.append(time.monotonic() - start)
+
+async def storm(address, args):
+    latencies = []
+    start = time.monotonic()
+    await asyncio.gather(*(run_client(address, args.seed, c, args.reports, args.equivalent, latencies)
+                           for c in range(args.clients)))
+    return time.monotonic() - start, latencies
+
+def percentile(values, p):
+    return statistics.quantiles(values, n=100, method="inclusive")[p - 1]
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure hash equivalence server latency under a storm of reports")
+    parser.add_argument("--address", help="Server to report to (default: start a local server)")
+    parser.add_argument("--clients", type=int, default=64,
+                        help="Number of clients reporting at the same time (default: %(default)s)")
+    parser.add_argument("--reports", type=int, default=100,
+                        help="Number of reports sent by each client (default: %(default)s)")
+    parser.add_argument("--equivalent", type=int, default=4,
+                        help="Make every Nth task of a client equivalent to a task of the others, 0 for none (default: %(default)s)")
+    parser.add_argument("--no-sync", action="store_true",
+                        help="Don't sync the local server's database to disk")
+    parser.add_argument("--seed", default=str(time.time()),
+                        help="Seed for the hashes, so that repeated runs report new tasks (default: the time)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="hashserv-report-storm") as tempdir:
+        server = None
+        address = args.address
+        if address is None:
+            server = hashserv.create_server("unix://" + os.path.join(tempdir, "sock"),
+                                            os.path.join(tempdir, "db.sqlite"), sync=not args.no_sync)
+            server.serve_as_process()
+            address = server.address
+
+        try:
+            elapsed, latencies = asyncio.run(storm(address, args))
+        finally:
+            if server is not None:
+                server.process.terminate()
+                server.process.join()
+
+    print("%d reports from %d clients in %.2fs (%.0f reports/s)" % (len(latencies), args.clients, elapsed, len(latencies) / elapsed))
+    print("Latency: p50 %.1fms, p99 %.1fms, max %.1fms" % (percentile(latencies, 50) * 1000,
+                                                          percentile(latencies, 99) * 1000,
+                                                          max(latencies) * 1000))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
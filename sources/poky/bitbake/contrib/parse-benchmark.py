@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+#
+# Copyright BitBake Contributors
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+# Measure recipe parsing throughput at different BB_NUMBER_PARSE_THREADS
+# values. Run from an initialised build directory (e.g. after sourcing
+# oe-init-build-env for oe-core) with bitbake in PATH. Each run parses with
+# an empty recipe cache so every recipe is really parsed.
+#
+
+import argparse
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+def parse(threads, tmpdir):
+    cachedir = os.path.join(tmpdir, "cache-%d" % threads)
+    shutil.rmtree(cachedir, ignore_errors=True)
+    conf = os.path.join(tmpdir, "parse-benchmark.conf")
+    with open(conf, "w") as f:
+        f.write('BB_NUMBER_PARSE_THREADS = "%d"\n' % threads)
+        f.write('CACHE = "%s"\n' % cachedir)
+
+    start = time.perf_counter()
+    p = subprocess.run(["bitbake", "-R", conf, "-p"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                       universal_newlines=True)
+    elapsed = time.perf_counter() - start
+    shutil.rmtree(cachedir, ignore_errors=True)
+    if p.returncode:
+        print(p.stdout)
+        raise RuntimeError("bitbake -p failed with exit code %d" % p.returncode)
+
+    m = re.search(r"Parsing of (\d+) \.bb files complete \((\d+) cached, (\d+) parsed\)", p.stdout)
+    if not m:
+        print(p.stdout)
+        raise RuntimeError("Unable to find the parsing summary in the bitbake output")
+    return elapsed, int(m.group(3))
+
+def main():
+    parser = argparse.ArgumentParser(description="BitBake recipe parsing throughput benchmark")
+    parser.add_argument("--threads", default="1 2 4 8 16",
+                        help="Space separated BB_NUMBER_PARSE_THREADS values (default: %(default)s)")
+    parser.add_argument("--runs", type=int, default=3,
+                        help="Number of runs for each value, the fastest is reported (default: %(default)s)")
+    args = parser.parse_args()
+
+    if not os.path.exists(os.path.join("conf", "local.conf")):
+        print("Please run from an initialised build directory")
+        return 1
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix="parse-benchmark-", dir=".") as tmpdir:
+        tmpdir = os.path.abspath(tmpdir)
+        for threads in (int(t) for t in args.threads.split()):
+            best = None
+            for _ in range(args.runs):
+                elapsed, parsed = parse(threads, tmpdir)
+                if best is None or elapsed < best[0]:
+                    best = (elapsed, parsed)
+            results.append((threads, best[0], best[1]))
+            print("%d threads: %d recipes in %.2fs" % (threads, best[1], best[0]), file=sys.stderr)
+
+    print("%8s %10s %10s %12s" % ("threads", "recipes", "time (s)", "recipes/s"))
+    for threads, elapsed, parsed in results:
+        print("%8d %10d %10.2f %12.1f" % (threads, parsed, elapsed, parsed / elapsed))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
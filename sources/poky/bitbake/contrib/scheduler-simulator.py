@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+#
+# Copyright BitBake Contributors
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+# Replay a recorded build under each runqueue scheduler and report the
+# predicted makespan.
+#
+# The task graph comes from the task-depends.dot written by "bitbake -g" for
+# the same targets and the task durations from the buildstats directory of
+# the recorded build. Tasks without a buildstats entry (e.g. covered by
+# sstate or noexec) are taken to complete instantly. Each scheduler's
+# priority order is replayed on BB_NUMBER_THREADS simulated slots, ignoring
+# pressure limits and per task thread limits.
+#
+# The critical scheduler is given the recorded durations, as it would be
+# after learning them from the recorded build.
+#
+
+import argparse
+import heapq
+import os
+import re
+import sys
+import types
+
+sys.path.insert(0, os.path.join(os.path.abspath(os.path.dirname(sys.argv[0])), '../lib'))
+import bb
+import bb.parse
+import bb.runqueue
+import bb.taskstats
+
+def read_task_depends(dotfile):
+    """
+    Return a dict of tid to (pf, set of tids depended upon) from a
+    task-depends.dot file. The tids used are "<recipe file>:<taskname>".
+    """
+    node = re.compile(r'^"([^"]+)\.(do_[^"]+)" \[label="\S+ \S+\\n(\S+)\\n(.+)"\]$')
+    edge = re.compile(r'^"([^"]+)\.(do_[^"]+)" -> "([^"]+)\.(do_[^"]+)"$')
+    nodes = {}
+    edges = []
+    with open(dotfile, "r") as f:
+        for line in f:
+            line = line.strip()
+            m = node.match(line)
+            if m:
+                pn, taskname, version, fn = m.groups()
+                pe, pvpr = version.split(":", 1) if ":" in version else ("", version)
+                pf = "%s-%s%s" % (pn, pe + "_" if pe else "", pvpr)
+                nodes[(pn, taskname)] = (fn + ":" + taskname, pf)
+                continue
+            m = edge.match(line)
+            if m:
+                edges.append(((m.group(1), m.group(2)), (m.group(3), m.group(4))))
+
+    graph = dict((tid, (pf, set())) for tid, pf in nodes.values())
+    for task, dep in edges:
+        if task in nodes and dep in nodes:
+            graph[nodes[task][0]][1].add(nodes[dep][0])
+    return graph
+
+def make_rqdata(graph):
+    rqdata = types.SimpleNamespace(runtaskentries={}, taskgraph=None, setscene_enforce=False)
+    for tid in sorted(graph):
+        entry = bb.runqueue.RunTaskEntry()
+        entry.depends = set(graph[tid][1])
+        rqdata.runtaskentries[tid] = entry
+    rqdata.taskgraph = bb.runqueue.TaskGraph(rqdata.runtaskentries)
+    for i, tid in enumerate(rqdata.taskgraph.tids):
+        rqdata.runtaskentries[tid].revdeps = set(rqdata.taskgraph.tids[r] for r in rqdata.taskgraph.revdeps[i])
+    endpoints = [tid for tid in rqdata.runtaskentries if not rqdata.runtaskentries[tid].revdeps]
+    bb.runqueue.RunQueueData.calculate_task_weights(rqdata, endpoints)
+    return rqdata
+
+def make_scheduler(cls, rqdata, durations):
+    if issubclass(cls, bb.runqueue.RunQueueSchedulerCritical):
+        class ReplayScheduler(cls):
+            def open_history(self):
+                return None
+            def known_durations(self):
+                return durations
+        cls = ReplayScheduler
+    rq = types.SimpleNamespace(runq_buildable=set(), max_cpu_pressure=None, max_io_pressure=None,
+                               max_memory_pressure=None, max_loadfactor=None, memory_budget=None)
+    return cls(rq, rqdata)
+
+def simulate(order, rqdata, durations, threads):
+    prio = dict((tid, i) for i, tid in enumerate(order))
+    deps_left = dict((tid, len(entry.depends)) for tid, entry in rqdata.runtaskentries.items())
+    ready = [(prio[tid], tid) for tid, left in deps_left.items() if not left]
+    heapq.heapify(ready)
+    running = []
+    now = 0.0
+    while ready or running:
+        while ready and len(running) < threads:
+            _, tid = heapq.heappop(ready)
+            heapq.heappush(running, (now + durations.get(tid, 0.0), tid))
+        now, tid = heapq.heappop(running)
+        for revdep in rqdata.runtaskentries[tid].revdeps:
+            deps_left[revdep] -= 1
+            if not deps_left[revdep]:
+                heapq.heappush(ready, (prio[revdep], revdep))
+    return now
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a recorded build under each runqueue scheduler")
+    parser.add_argument("taskdepends", help="task-depends.dot written by 'bitbake -g'")
+    parser.add_argument("buildstats", help="buildstats directory of the recorded build")
+    parser.add_argument("--threads", type=int, default=os.cpu_count(),
+                        help="Number of tasks run in parallel (default: %(default)s)")
+    parser.add_argument("--schedulers", default="basic speed completion critical",
+                        help="Schedulers to compare (default: %(default)s)")
+    args = parser.parse_args()
+
+    # The schedulers look up stamp files, which don't matter here
+    bb.parse.siggen = types.SimpleNamespace(stampfile_mcfn=lambda taskname, taskfn, extrainfo=True: taskfn + "." + taskname)
+
+    graph = read_task_depends(args.taskdepends)
+    buildstats = bb.taskstats.read_buildstats(args.buildstats)
+    durations = {}
+    for tid, (pf, _) in graph.items():
+        taskname = tid.rsplit(":", 1)[1]
+        if taskname in buildstats.get(pf, {}):
+            durations[tid] = buildstats[pf][taskname]
+
+    rqdata = make_rqdata(graph)
+    schedulers = dict((cls.name, cls) for cls in vars(bb.runqueue).values()
+                          if type(cls) is type and issubclass(cls, bb.runqueue.RunQueueScheduler))
+
+    lengths = rqdata.taskgraph.critical_path([durations.get(tid, 0.0) for tid in rqdata.taskgraph.tids])
+    total = sum(durations.values())
+    print("%d tasks, %d with recorded durations, %.0fs of work, %d threads" % (len(graph), len(durations), total, args.threads))
+    print("Lower bound: %.0fs (critical path %.0fs)" % (max(max(lengths, default=0.0), total / args.threads), max(lengths, default=0.0)))
+    print("%-12s %12s" % ("scheduler", "makespan (s)"))
+    for name in args.schedulers.split():
+        if name not in schedulers:
+            print("Unknown scheduler %s" % name)
+            return 1
+        sched = make_scheduler(schedulers[name], rqdata, durations)
+        order = sched.prio_map
+        if name == "basic":
+            # The basic scheduler's priority map is the task order itself
+            order = list(rqdata.runtaskentries)
+        print("%-12s %12.0f" % (name, simulate(order, rqdata, durations, args.threads)))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
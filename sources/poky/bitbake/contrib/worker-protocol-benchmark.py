@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+#
+# Copyright BitBake Contributors
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+# Compare the original <tag>...</tag> cooker/worker message framing against
+# the length prefixed framing in bb.workerproto using the message mix of a
+# synthetic world build: one large workerdata and newtaskhashes message
+# followed by runtask messages going to the worker and event and exitcode
+# messages coming back for every task.
+#
+# The encoded stream is handed to the reader in the same sized chunks the
+# cooker reads from the worker pipe so the search cost of the tag framing on
+# large messages shows up. Times are CPU time of this (cooker side) process.
+#
+
+import argparse
+import os
+import pickle
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.abspath(os.path.dirname(sys.argv[0])), '../lib'))
+from bb import workerproto
+
+CHUNK = 102400
+
+def make_messages(tasks):
+    tids = ["/layers/meta/recipes/recipe%d/recipe%d_1.0.bb:do_%s" % (i // 10, i // 10, i % 10) for i in range(tasks)]
+    hashes = dict((tid, ("%064x" % i, "%064x" % (i * 7))) for i, tid in enumerate(tids))
+    yield "workerdata", {
+        "taskdeps": dict((tid, ["%s-%d" % (tid, j) for j in range(4)]) for tid in tids),
+        "hashes": hashes,
+        "sigdata": dict((tid, "x" * 64) for tid in tids),
+    }
+    yield "newtaskhashes", {"hashes": hashes}
+    for i, tid in enumerate(tids):
+        yield "runtask", {"fn": tid.rsplit(":", 1)[0], "task": i, "taskname": tid.rsplit(":", 1)[1],
+                          "taskhash": hashes[tid][0], "unihash": hashes[tid][1],
+                          "quieterrors": False, "appends": [], "layername": "meta",
+                          "taskdepdata": None, "dry_run": False}
+        yield "event", {"class": "TaskStarted", "taskfile": tid, "taskname": "do_%s" % (i % 10), "pid": 1000 + i}
+        yield "event", {"class": "TaskSucceeded", "taskfile": tid, "taskname": "do_%s" % (i % 10), "pid": 1000 + i}
+        yield "exitcode", (tid, 0)
+
+def encode_tags(messages):
+    out = bytearray()
+    for name, data in messages:
+        pickled = pickle.dumps(data)
+        out.extend(b"<" + name.encode() + b">")
+        out.extend(len(pickled).to_bytes(4, 'big'))
+        out.extend(pickled)
+        out.extend(b"</" + name.encode() + b">")
+    return out
+
+def encode_frames(messages, compress):
+    out = bytearray()
+    for name, data in messages:
+        out.extend(workerproto.encode_pickled(name, data, compress))
+    return out
+
+def decode_tags(stream, names):
+    # Mirrors the previous handle_item()/runQueuePipe.read() parsing
+    queue = bytearray()
+    count = 0
+    for i in range(0, len(stream), CHUNK):
+        queue.extend(stream[i:i + CHUNK])
+        found = True
+        while found and queue:
+            found = False
+            for name in names:
+                opening = b"<" + name + b">"
+                if not queue.startswith(opening):
+                    continue
+                index = queue.find(b"</" + name + b">")
+                if index == -1:
+                    continue
+                pickle.loads(queue[len(opening) + 4:index])
+                queue = queue[index + len(opening) + 1:]
+                count += 1
+                found = True
+    return count
+
+def decode_frames(stream):
+    reader = workerproto.FrameReader()
+    count = 0
+    for i in range(0, len(stream), CHUNK):
+        reader.feed(stream[i:i + CHUNK])
+        for name, payload in reader.frames():
+            pickle.loads(payload)
+            count += 1
+    return count
+
+def measure(func, *args):
+    start = time.process_time()
+    result = func(*args)
+    return result, time.process_time() - start
+
+def main():
+    parser = argparse.ArgumentParser(description="cooker/worker message framing benchmark")
+    parser.add_argument("--tasks", type=int, default=50000,
+                        help="Number of synthetic tasks (default: %(default)s)")
+    parser.add_argument("--runs", type=int, default=3,
+                        help="Number of runs for each measurement (default: %(default)s)")
+    args = parser.parse_args()
+
+    messages = list(make_messages(args.tasks))
+    names = sorted(set(name.encode() for name, _ in messages))
+
+    results = []
+    for label, encode, decode in (
+            ("tags", lambda: encode_tags(messages), lambda s: decode_tags(s, names)),
+            ("frames", lambda: encode_frames(messages, False), decode_frames),
+            ("frames+zlib", lambda: encode_frames(messages, True), decode_frames)):
+        stream, enc = min((measure(encode) for _ in range(args.runs)), key=lambda r: r[1])
+        count, dec = min((measure(decode, stream) for _ in range(args.runs)), key=lambda r: r[1])
+        assert count == len(messages)
+        results.append((label, len(stream), enc, dec, count / (enc + dec)))
+
+    print("%d tasks, %d messages" % (args.tasks, len(messages)))
+    print("%-12s %12s %10s %10s %12s" % ("framing", "bytes", "encode (s)", "decode (s)", "msgs/s"))
+    for label, size, enc, dec, rate in results:
+        print("%-12s %12d %10.3f %10.3f %12.0f" % (label, size, enc, dec, rate))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -194,7 +194,7 @@ class Client(object):
         # required (but harmless) with it.
         asyncio.set_event_loop(self.loop)
 
-        self._add_methods("connect_tcp", "ping")
+        self._add_methods("connect_tcp", "connect", "ping")
 
     @abc.abstractmethod
     def _get_async_client(self):
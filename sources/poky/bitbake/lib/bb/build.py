@@ -918,6 +918,7 @@ def add_tasks(tasklist, d):
         getTask('fakeroot')
         getTask('noexec')
         getTask('umask')
+        getTask('memory')
         task_deps['parents'][task] = []
         if 'deps' in flags:
             for dep in flags['deps']:
@@ -16,11 +16,16 @@
 # SPDX-License-Identifier: GPL-2.0-only
 #
 
+import concurrent.futures
+import fcntl
 import os
 import logging
+import mmap
 import pickle
+import struct
 from collections import defaultdict
-from collections.abc import Mapping
+from collections.abc import Mapping, MutableMapping
+import bb.monitordisk
 import bb.utils
 from bb import PrefixLoggerAdapter
 import re
@@ -28,7 +33,7 @@ import shutil
 
 logger = logging.getLogger("BitBake.Cache")
 
-__cache_version__ = "155"
+__cache_version__ = "156"
 
 def getCacheFile(path, filename, mc, data_hash):
     mcspec = ''
@@ -378,6 +383,274 @@ def variant2virtual(realfn, variant):
         return "mc:" + elems[1] + ":" + realfn
     return "virtual:" + variant + ":" + realfn
 
+#
+# Indexed cache file format
+#
+# The original cache files are a single pickle stream which has to be read
+# from start to end before any entry can be used. The indexed format stores
+# each entry as an independent pickle so entries can be deserialized on demand
+# from an mmap of the file:
+#
+#   INDEXED_CACHE_MAGIC
+#   index offset (8 bytes, little endian)
+#   entry pickles...
+#   pickle of (cache version, bitbake version, {key: (offset, length)})
+#
+# Since entries are loaded independently, SiggenRecipeInfo references can't
+# point back into earlier entries so each one is written self-contained.
+#
+# When BB_CACHE_JOURNAL_MAXSIZE is set, reparsed and removed entries are
+# appended to a journal file next to each cache file instead of rewriting it:
+#
+#   CACHE_JOURNAL_MAGIC
+#   records of (op, key length, data length), key, entry pickle
+#
+# The journal is replayed on top of the base file when loading and is folded
+# back into it (compacted) once it grows beyond the configured size.
+#
+INDEXED_CACHE_MAGIC = b"BBCACHE\x01"
+INDEXED_CACHE_HEADER = struct.Struct("<8sQ")
+
+CACHE_JOURNAL_MAGIC = b"BBCJRNL\x01"
+CACHE_JOURNAL_RECORD = struct.Struct("<BII")
+CACHE_JOURNAL_SET = 1
+CACHE_JOURNAL_REMOVE = 2
+
+def getJournalFile(cachefile):
+    return cachefile + ".journal"
+
+def is_indexed_cachefile(cachefile):
+    try:
+        with open(cachefile, "rb") as f:
+            return f.read(len(INDEXED_CACHE_MAGIC)) == INDEXED_CACHE_MAGIC
+    except OSError:
+        return False
+
+def dump_cache_entry(info):
+    SiggenRecipeInfo.save_map = {}
+    SiggenRecipeInfo.save_count = 1
+    return pickle.dumps(info, pickle.HIGHEST_PROTOCOL)
+
+def load_cache_entry(data):
+    restore_map = SiggenRecipeInfo.restore_map
+    SiggenRecipeInfo.restore_map = {}
+    try:
+        return pickle.loads(data)
+    finally:
+        SiggenRecipeInfo.restore_map = restore_map
+
+def write_indexed_cachefile(cachefile, entries):
+    """
+    Write an indexed cache file. entries is an iterable of (key, data) where
+    data is either a RecipeInfoCommon object or already pickled bytes (e.g.
+    copied unchanged from a previous cache file).
+    """
+    index = {}
+    tmpfile = "%s.tmp.%s" % (cachefile, os.getpid())
+    try:
+        with open(tmpfile, "wb") as f:
+            f.write(INDEXED_CACHE_HEADER.pack(INDEXED_CACHE_MAGIC, 0))
+            for key, data in entries:
+                if not isinstance(data, (bytes, memoryview)):
+                    data = dump_cache_entry(data)
+                index[key] = (f.tell(), len(data))
+                f.write(data)
+            index_offset = f.tell()
+            pickle.dump((__cache_version__, bb.__version__, index), f, pickle.HIGHEST_PROTOCOL)
+            f.seek(0)
+            f.write(INDEXED_CACHE_HEADER.pack(INDEXED_CACHE_MAGIC, index_offset))
+        os.replace(tmpfile, cachefile)
+    except:
+        bb.utils.remove(tmpfile)
+        raise
+    bb.utils.remove(getJournalFile(cachefile))
+    return len(index)
+
+def append_cache_journal(journalfile, entries, removed):
+    """
+    Append entries (as for write_indexed_cachefile()) and removals of the
+    keys in removed to a cache journal. Returns the new journal size.
+    """
+    journal = CacheJournal(journalfile)
+    journal.close()
+    with open(journalfile, "ab") as f:
+        # Drop anything after the last complete record, e.g. from an
+        # interrupted write
+        f.truncate(journal.size)
+        if not journal.size:
+            f.write(CACHE_JOURNAL_MAGIC)
+        for key in removed:
+            key = key.encode("utf-8")
+            f.write(CACHE_JOURNAL_RECORD.pack(CACHE_JOURNAL_REMOVE, len(key), 0) + key)
+        for key, data in entries:
+            if not isinstance(data, (bytes, memoryview)):
+                data = dump_cache_entry(data)
+            key = key.encode("utf-8")
+            f.write(CACHE_JOURNAL_RECORD.pack(CACHE_JOURNAL_SET, len(key), len(data)) + key)
+            f.write(data)
+        return f.tell()
+
+class CacheJournal(object):
+    """
+    The replayed state of a cache journal: index maps keys to the location of
+    their latest entry and removed holds keys deleted since the base was
+    written.
+    """
+    def __init__(self, journalfile):
+        self.mm = None
+        self.index = {}
+        self.removed = set()
+        self.size = 0
+        try:
+            with open(journalfile, "rb") as f:
+                if os.fstat(f.fileno()).st_size <= len(CACHE_JOURNAL_MAGIC):
+                    return
+                self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            return
+
+        if self.mm[:len(CACHE_JOURNAL_MAGIC)] != CACHE_JOURNAL_MAGIC:
+            return
+
+        size = len(self.mm)
+        pos = len(CACHE_JOURNAL_MAGIC)
+        while pos + CACHE_JOURNAL_RECORD.size <= size:
+            op, keylen, datalen = CACHE_JOURNAL_RECORD.unpack_from(self.mm, pos)
+            keystart = pos + CACHE_JOURNAL_RECORD.size
+            end = keystart + keylen + datalen
+            if end > size or op not in (CACHE_JOURNAL_SET, CACHE_JOURNAL_REMOVE):
+                break
+            key = self.mm[keystart:keystart + keylen].decode("utf-8")
+            if op == CACHE_JOURNAL_SET:
+                self.index[key] = (self.mm, keystart + keylen, datalen)
+                self.removed.discard(key)
+            else:
+                self.index.pop(key, None)
+                self.removed.add(key)
+            pos = end
+        self.size = pos
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+
+class IndexedCacheFile(object):
+    """
+    Read only access to an indexed cache file, entries are deserialized
+    from the mmap on request. Any journal next to the file is replayed on
+    top of it.
+    """
+    def __init__(self, cachefile):
+        self.cachefile = cachefile
+        self.mm = None
+        self.index = {}
+        with open(cachefile, "rb") as f:
+            magic, index_offset = INDEXED_CACHE_HEADER.unpack(f.read(INDEXED_CACHE_HEADER.size))
+            if magic != INDEXED_CACHE_MAGIC or not index_offset:
+                raise ValueError("%s is not an indexed cache file" % cachefile)
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.cache_version, self.bitbake_version, index = pickle.loads(self.mm[index_offset:])
+        self.index = {key: (self.mm, offset, length) for key, (offset, length) in index.items()}
+
+        self.journal = CacheJournal(getJournalFile(cachefile))
+        for key in self.journal.removed:
+            self.index.pop(key, None)
+        self.index.update(self.journal.index)
+
+    @property
+    def journal_size(self):
+        return self.journal.size
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def keys(self):
+        return self.index.keys()
+
+    def raw(self, key):
+        mm, offset, length = self.index[key]
+        return mm[offset:offset + length]
+
+    def load(self, key):
+        return load_cache_entry(self.raw(key))
+
+    def close(self):
+        self.journal.close()
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+
+class LazyDependsCache(MutableMapping):
+    """
+    The depends_cache of a Cache backed by indexed cache files, one per
+    entry in caches_array. Values are the same lists of RecipeInfo objects
+    the eager loader builds but they're only unpickled on first access.
+    """
+    def __init__(self, cachefiles):
+        self.cachefiles = cachefiles
+        self.loaded = {}
+        self.removed = set()
+        self.dirty = set()
+        self.loadcount = 0
+
+    def __getitem__(self, key):
+        if key in self.loaded:
+            return self.loaded[key]
+        if key in self.removed:
+            raise KeyError(key)
+        info_array = [c.load(key) for c in self.cachefiles if key in c]
+        if not info_array:
+            raise KeyError(key)
+        self.loadcount += 1
+        self.loaded[key] = info_array
+        return info_array
+
+    def __setitem__(self, key, info_array):
+        self.removed.discard(key)
+        self.dirty.add(key)
+        self.loaded[key] = info_array
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self.loaded.pop(key, None)
+        self.dirty.discard(key)
+        self.removed.add(key)
+
+    def __contains__(self, key):
+        if key in self.loaded:
+            return True
+        if key in self.removed:
+            return False
+        return any(key in c for c in self.cachefiles)
+
+    def __iter__(self):
+        seen = set(self.loaded)
+        yield from self.loaded
+        for c in self.cachefiles:
+            for key in c.keys():
+                if key not in seen and key not in self.removed:
+                    seen.add(key)
+                    yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def unloaded(self, key):
+        """Is key still only present in its on-disk form?"""
+        return key not in self.loaded and key not in self.removed
+
+    def journal_size(self):
+        return sum(c.journal_size for c in self.cachefiles)
+
+    def close(self):
+        for c in self.cachefiles:
+            c.close()
+
 #
 # Cooker calls cacheValid on its recipe list, then either calls loadCached
 # from it's main thread or parse from separate processes to generate an up to
@@ -405,10 +678,22 @@ class Cache(object):
         self.cacheclean = True
         self.data_hash = data_hash
         self.filelist_regex = re.compile(r'(?:(?<=:True)|(?<=:False))\s+')
+        # Results of a batched dependency stat and recipes known to be
+        # unchanged, see MulticonfigCache.prepare_validation()
+        self.dep_mtimes = {}
+        self.dep_exists = {}
+        self.trusted = set()
 
         if self.cachedir in [None, '']:
             bb.fatal("Please ensure CACHE is set to the cache directory for BitBake to use")
 
+        self.journal_maxsize = 0
+        journal_maxsize = self.data.getVar("BB_CACHE_JOURNAL_MAXSIZE")
+        if journal_maxsize:
+            self.journal_maxsize = bb.monitordisk.convertGMK(journal_maxsize)
+            if self.journal_maxsize is None:
+                bb.fatal("Invalid BB_CACHE_JOURNAL_MAXSIZE value '%s'" % journal_maxsize)
+
     def getCacheFile(self, cachefile):
         return getCacheFile(self.cachedir, cachefile, self.mc, self.data_hash)
 
@@ -463,11 +748,37 @@ class Cache(object):
         return cachesize
 
     def load_cachefile(self, progress):
-        previous_progress = 0
+        cachefiles = [self.getCacheFile(cache_class.cachefile) for cache_class in self.caches_array]
 
-        for cache_class in self.caches_array:
-            cachefile = self.getCacheFile(cache_class.cachefile)
+        if all(is_indexed_cachefile(f) for f in cachefiles):
+            return self.load_indexed_cachefiles(cachefiles, progress)
+
+        # At least one file is still in the original single pickle stream
+        # format, load everything and write it back out in the indexed format
+        # on the next sync
+        self.logger.info('Converting cache to indexed format...')
+        self.depends_cache = {}
+        self.cacheclean = False
+        previous_progress = 0
+        for cachefile in cachefiles:
             self.logger.debug('Loading cache file: %s' % cachefile)
+            if is_indexed_cachefile(cachefile):
+                try:
+                    indexed = IndexedCacheFile(cachefile)
+                except Exception:
+                    self.logger.info('Invalid cache, rebuilding...')
+                    return 0
+                try:
+                    if not self.check_cache_version(indexed.cache_version, indexed.bitbake_version):
+                        return 0
+                    for key in indexed.keys():
+                        self.depends_cache.setdefault(key, []).append(indexed.load(key))
+                finally:
+                    indexed.close()
+                previous_progress += os.path.getsize(cachefile)
+                progress(previous_progress)
+                continue
+
             with open(cachefile, "rb") as cachefile:
                 pickled = pickle.Unpickler(cachefile)
                 # Check cache version information
@@ -478,11 +789,7 @@ class Cache(object):
                     self.logger.info('Invalid cache, rebuilding...')
                     return 0
 
-                if cache_ver != __cache_version__:
-                    self.logger.info('Cache version mismatch, rebuilding...')
-                    return 0
-                elif bitbake_ver != bb.__version__:
-                    self.logger.info('Bitbake version mismatch, rebuilding...')
+                if not self.check_cache_version(cache_ver, bitbake_ver):
                     return 0
 
                 # Load the rest of the cache file
@@ -512,6 +819,37 @@ class Cache(object):
 
         return len(self.depends_cache)
 
+    def load_indexed_cachefiles(self, cachefiles, progress):
+        indexed = []
+        loaded = 0
+        for cachefile in cachefiles:
+            self.logger.debug('Mapping cache file: %s' % cachefile)
+            try:
+                c = IndexedCacheFile(cachefile)
+            except Exception:
+                self.logger.info('Invalid cache, rebuilding...')
+                c = None
+            if c is None or not self.check_cache_version(c.cache_version, c.bitbake_version):
+                for c in indexed + [c]:
+                    if c:
+                        c.close()
+                return 0
+            indexed.append(c)
+            loaded += os.path.getsize(cachefile)
+            progress(loaded)
+
+        self.depends_cache = LazyDependsCache(indexed)
+        return len(self.depends_cache)
+
+    def check_cache_version(self, cache_ver, bitbake_ver):
+        if cache_ver != __cache_version__:
+            self.logger.info('Cache version mismatch, rebuilding...')
+            return False
+        elif bitbake_ver != bb.__version__:
+            self.logger.info('Bitbake version mismatch, rebuilding...')
+            return False
+        return True
+
     def parse(self, filename, appends, layername):
         """Parse the specified filename, returning the recipe information"""
         self.logger.debug("Parsing %s", filename)
@@ -575,55 +913,12 @@ class Cache(object):
             self.logger.debug2("%s is not cached", fn)
             return False
 
-        mtime = bb.parse.cached_mtime_noerror(fn)
-
-        # Check file still exists
-        if mtime == 0:
-            self.logger.debug2("%s no longer exists", fn)
-            self.remove(fn)
+        # Recipes the file watcher knows are unchanged don't need their
+        # dependencies checking
+        if fn not in self.trusted and not self.dependencies_valid(fn):
             return False
 
         info_array = self.depends_cache[fn]
-        # Check the file's timestamp
-        if mtime != info_array[0].timestamp:
-            self.logger.debug2("%s changed", fn)
-            self.remove(fn)
-            return False
-
-        # Check dependencies are still valid
-        depends = info_array[0].file_depends
-        if depends:
-            for f, old_mtime in depends:
-                fmtime = bb.parse.cached_mtime_noerror(f)
-                # Check if file still exists
-                if old_mtime != 0 and fmtime == 0:
-                    self.logger.debug2("%s's dependency %s was removed",
-                                         fn, f)
-                    self.remove(fn)
-                    return False
-
-                if (fmtime != old_mtime):
-                    self.logger.debug2("%s's dependency %s changed",
-                                         fn, f)
-                    self.remove(fn)
-                    return False
-
-        if hasattr(info_array[0], 'file_checksums'):
-            for _, fl in info_array[0].file_checksums.items():
-                fl = fl.strip()
-                if not fl:
-                    continue
-                # Have to be careful about spaces and colons in filenames
-                flist = self.filelist_regex.split(fl)
-                for f in flist:
-                    if not f:
-                        continue
-                    f, exist = f.rsplit(":", 1)
-                    if (exist == "True" and not os.path.exists(f)) or (exist == "False" and os.path.exists(f)):
-                        self.logger.debug2("%s's file checksum list file %s changed",
-                                             fn, f)
-                        self.remove(fn)
-                        return False
 
         if tuple(appends) != tuple(info_array[0].appends):
             self.logger.debug2("appends for %s changed", fn)
@@ -657,6 +952,97 @@ class Cache(object):
         self.clean.add(fn)
         return True
 
+    def dependencies_valid(self, fn):
+        """
+        Check the timestamps of fn and its dependencies and the existence of
+        files in its file checksum lists against the cached values
+        """
+        mtime = self.dep_mtime(fn)
+
+        # Check file still exists
+        if mtime == 0:
+            self.logger.debug2("%s no longer exists", fn)
+            self.remove(fn)
+            return False
+
+        info_array = self.depends_cache[fn]
+
+        # Check the file's timestamp
+        if mtime != info_array[0].timestamp:
+            self.logger.debug2("%s changed", fn)
+            self.remove(fn)
+            return False
+
+        # Check dependencies are still valid
+        depends = info_array[0].file_depends
+        if depends:
+            for f, old_mtime in depends:
+                fmtime = self.dep_mtime(f)
+                # Check if file still exists
+                if old_mtime != 0 and fmtime == 0:
+                    self.logger.debug2("%s's dependency %s was removed",
+                                         fn, f)
+                    self.remove(fn)
+                    return False
+
+                if (fmtime != old_mtime):
+                    self.logger.debug2("%s's dependency %s changed",
+                                         fn, f)
+                    self.remove(fn)
+                    return False
+
+        for f, exist in self.checksum_files(info_array[0]):
+            if (exist == "True" and not self.dep_exists_now(f)) or (exist == "False" and self.dep_exists_now(f)):
+                self.logger.debug2("%s's file checksum list file %s changed",
+                                     fn, f)
+                self.remove(fn)
+                return False
+
+        return True
+
+    def checksum_files(self, info):
+        """
+        Yield (path, existed) for the files in a recipe's file checksum lists
+        """
+        if not hasattr(info, 'file_checksums'):
+            return
+        for _, fl in info.file_checksums.items():
+            fl = fl.strip()
+            if not fl:
+                continue
+            # Have to be careful about spaces and colons in filenames
+            flist = self.filelist_regex.split(fl)
+            for f in flist:
+                if not f:
+                    continue
+                yield f.rsplit(":", 1)
+
+    def dependency_paths(self, fn, info=None):
+        """
+        Return the sets of paths cacheValidUpdate() needs the mtime of and
+        the existence of for fn
+        """
+        mtime_paths = set([fn])
+        exists_paths = set()
+        if info is None:
+            if fn not in self.depends_cache:
+                return mtime_paths, exists_paths
+            info = self.depends_cache[fn][0]
+        if info.file_depends:
+            mtime_paths.update(f for f, _ in info.file_depends)
+        exists_paths.update(f for f, _ in self.checksum_files(info))
+        return mtime_paths, exists_paths
+
+    def dep_mtime(self, f):
+        if f in self.dep_mtimes:
+            return self.dep_mtimes[f]
+        return bb.parse.cached_mtime_noerror(f)
+
+    def dep_exists_now(self, f):
+        if f in self.dep_exists:
+            return self.dep_exists[f]
+        return os.path.exists(f)
+
     def remove(self, fn):
         """
         Remove a fn from the cache
@@ -678,21 +1064,51 @@ class Cache(object):
             self.logger.debug2("Cache is clean, not saving.")
             return
 
-        for cache_class in self.caches_array:
-            cache_class_name = cache_class.__name__
+        lazy = isinstance(self.depends_cache, LazyDependsCache)
+
+        if lazy and self.journal_maxsize and self.depends_cache.journal_size() < self.journal_maxsize:
+            self.sync_journal()
+            return
+
+        def entries(idx, cache_class_name):
+            for key in self.depends_cache:
+                # Entries which were never touched are copied across without
+                # being unpickled
+                if lazy and self.depends_cache.unloaded(key):
+                    if key in self.depends_cache.cachefiles[idx]:
+                        yield key, self.depends_cache.cachefiles[idx].raw(key)
+                    continue
+                for info in self.depends_cache[key]:
+                    if isinstance(info, RecipeInfoCommon) and info.__class__.__name__ == cache_class_name:
+                        yield key, info
+
+        for idx, cache_class in enumerate(self.caches_array):
             cachefile = self.getCacheFile(cache_class.cachefile)
             self.logger.debug2("Writing %s", cachefile)
-            with open(cachefile, "wb") as f:
-                p = pickle.Pickler(f, pickle.HIGHEST_PROTOCOL)
-                p.dump(__cache_version__)
-                p.dump(bb.__version__)
+            write_indexed_cachefile(cachefile, entries(idx, cache_class.__name__))
 
-                for key, info_array in self.depends_cache.items():
-                    for info in info_array:
-                        if isinstance(info, RecipeInfoCommon) and info.__class__.__name__ == cache_class_name:
-                            p.dump(key)
-                            p.dump(info)
+        if lazy:
+            self.depends_cache.close()
+        del self.depends_cache
+        SiggenRecipeInfo.reset()
 
+    def sync_journal(self):
+        """
+        Append the entries which changed since the cache was loaded to the
+        cache journals rather than rewriting the whole cache
+        """
+        depends_cache = self.depends_cache
+        for cache_class in self.caches_array:
+            cachefile = self.getCacheFile(cache_class.cachefile)
+            entries = []
+            for key in depends_cache.dirty:
+                for info in depends_cache.loaded[key]:
+                    if isinstance(info, RecipeInfoCommon) and info.__class__.__name__ == cache_class.__name__:
+                        entries.append((key, info))
+            self.logger.debug2("Appending %d entries to %s", len(entries), getJournalFile(cachefile))
+            append_cache_journal(getJournalFile(cachefile), entries, depends_cache.removed)
+
+        depends_cache.close()
         del self.depends_cache
         SiggenRecipeInfo.reset()
 
@@ -766,6 +1182,42 @@ class MulticonfigCache(Mapping):
         # The same file has several caches, still regarded as one item in the cache
         bb.event.fire(bb.event.CacheLoadCompleted(cachesize, loaded), databuilder.data)
 
+    def prepare_validation(self, mcfiles, threads=None, unchanged=None):
+        """
+        Stat every unique dependency of the recipes in mcfiles (a dict of
+        multiconfig to list of filenames) once, in parallel, so the following
+        cacheValid() calls only need to check the shared results.
+
+        unchanged(mc, fn, paths) can tell that a recipe's dependencies are
+        known not to have changed, so they don't need stat'ing at all.
+
+        Returns the number of paths stat'ed and the number of stat calls
+        skipped.
+        """
+        mtime_paths = set()
+        exists_paths = set()
+        skipped = 0
+        for mc, filenames in mcfiles.items():
+            c = self.__caches[mc]
+            for fn in filenames:
+                mtimes, exists = c.dependency_paths(fn)
+                if unchanged and fn in c.depends_cache and unchanged(mc, fn, mtimes | exists):
+                    c.trusted.add(fn)
+                    skipped += len(mtimes) + len(exists)
+                    continue
+                mtime_paths |= mtimes
+                exists_paths |= exists
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+            dep_mtimes = dict(zip(mtime_paths, executor.map(bb.parse.cached_mtime_noerror, mtime_paths)))
+            dep_exists = dict(zip(exists_paths, executor.map(os.path.exists, exists_paths)))
+
+        for c in self.__caches.values():
+            c.dep_mtimes = dep_mtimes
+            c.dep_exists = dep_exists
+
+        return len(mtime_paths) + len(exists_paths), skipped
+
     def __len__(self):
         return len(self.__caches)
 
@@ -824,6 +1276,23 @@ class CacheData(object):
         for info in info_array:
             info.add_cacheData(self, fn)
 
+#
+# MultiProcessCache extras written by the individual processes are appended to
+# a single segment file next to the cache file rather than one file per
+# process:
+#
+#   records of (MULTIPROCESS_SEGMENT_MAGIC, data length), pickle of
+#   [cachedata_extras, CACHE_VERSION]
+#
+# Appends are serialised with a lock on the segment file itself. Segments are
+# replayed on top of the cache file when it is loaded and only folded back
+# into it (compacted) once they grow beyond MULTIPROCESS_SEGMENT_RATIO of its
+# size, so save_merge() no longer rewrites the whole cache every time.
+#
+MULTIPROCESS_SEGMENT_MAGIC = b"BBMPSEG\x01"
+MULTIPROCESS_SEGMENT_RECORD = struct.Struct("<8sI")
+MULTIPROCESS_SEGMENT_RATIO = 0.25
+
 class MultiProcessCache(object):
     """
     BitBake multi-process cache implementation
@@ -835,6 +1304,13 @@ class MultiProcessCache(object):
         self.cachefile = None
         self.cachedata = self.create_cachedata()
         self.cachedata_extras = self.create_cachedata()
+        self.segment_ino = None
+        self.segment_offset = 0
+        self.compact = False
+
+    @property
+    def segmentfile(self):
+        return self.cachefile + ".segments"
 
     def init_cache(self, cachedir, cache_file_name=None):
         if not cachedir:
@@ -848,17 +1324,22 @@ class MultiProcessCache(object):
         glf = bb.utils.lockfile(self.cachefile + ".lock")
 
         try:
-            with open(self.cachefile, "rb") as f:
-                p = pickle.Unpickler(f)
-                data, version = p.load()
-        except:
+            try:
+                with open(self.cachefile, "rb") as f:
+                    p = pickle.Unpickler(f)
+                    data, version = p.load()
+            except:
+                data, version = None, None
+
+            self.compact = version != self.__class__.CACHE_VERSION
+            if self.compact:
+                # Start afresh, the segments may still be usable
+                data = self.create_cachedata()
+
+            self.segment_ino = None
+            self.segment_offset = self.replay_segments(data, 0)
+        finally:
             bb.utils.unlockfile(glf)
-            return
-
-        bb.utils.unlockfile(glf)
-
-        if version != self.__class__.CACHE_VERSION:
-            return
 
         self.cachedata = data
 
@@ -866,6 +1347,40 @@ class MultiProcessCache(object):
         data = [{}]
         return data
 
+    def replay_segments(self, dest, offset):
+        """
+        Merge the segment records from offset onwards into dest. Returns the
+        offset after the last complete record.
+        """
+        try:
+            with open(self.segmentfile, "rb") as f:
+                ino = os.fstat(f.fileno()).st_ino
+                if ino != self.segment_ino:
+                    # Compacted and recreated since we last read it
+                    self.segment_ino = ino
+                    offset = 0
+                f.seek(offset)
+                segments = f.read()
+        except FileNotFoundError:
+            self.segment_ino = None
+            return 0
+
+        pos = 0
+        while pos + MULTIPROCESS_SEGMENT_RECORD.size <= len(segments):
+            magic, length = MULTIPROCESS_SEGMENT_RECORD.unpack_from(segments, pos)
+            start = pos + MULTIPROCESS_SEGMENT_RECORD.size
+            if magic != MULTIPROCESS_SEGMENT_MAGIC or start + length > len(segments):
+                break
+            try:
+                extradata, version = pickle.loads(segments[start:start + length])
+            except Exception:
+                break
+            if version == self.__class__.CACHE_VERSION:
+                self.merge_data(extradata, dest)
+            pos = start + length
+
+        return offset + pos
+
     def save_extras(self):
         if not self.cachefile:
             return
@@ -874,25 +1389,26 @@ class MultiProcessCache(object):
         if not have_data:
             return
 
-        glf = bb.utils.lockfile(self.cachefile + ".lock", shared=True)
+        data = pickle.dumps([self.cachedata_extras, self.__class__.CACHE_VERSION], -1)
+        record = MULTIPROCESS_SEGMENT_RECORD.pack(MULTIPROCESS_SEGMENT_MAGIC, len(data)) + data
 
-        i = os.getpid()
-        lf = None
-        while not lf:
-            lf = bb.utils.lockfile(self.cachefile + ".lock." + str(i), retry=False)
-            if not lf or os.path.exists(self.cachefile + "-" + str(i)):
-                if lf:
-                    bb.utils.unlockfile(lf)
-                    lf = None
-                i = i + 1
-                continue
-
-            with open(self.cachefile + "-" + str(i), "wb") as f:
-                p = pickle.Pickler(f, -1)
-                p.dump([self.cachedata_extras, self.__class__.CACHE_VERSION])
+        glf = bb.utils.lockfile(self.cachefile + ".lock", shared=True)
+        try:
+            fd = os.open(self.segmentfile, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                view = memoryview(record)
+                while view:
+                    view = view[os.write(fd, view):]
+            finally:
+                os.close(fd)
+        finally:
+            bb.utils.unlockfile(glf)
 
-        bb.utils.unlockfile(lf)
-        bb.utils.unlockfile(glf)
+        # These are now on disk, don't write them again from this process
+        self.merge_data(self.cachedata_extras, self.cachedata)
+        for extras in self.cachedata_extras:
+            extras.clear()
 
     def merge_data(self, source, dest):
         for j in range(0,len(dest)):
@@ -901,39 +1417,47 @@ class MultiProcessCache(object):
                     dest[j][h] = source[j][h]
 
     def save_merge(self):
+        """
+        Pick up the extras other processes appended since the cache was
+        loaded and compact the segments into the cache file once they have
+        grown large enough
+        """
         if not self.cachefile:
             return
 
         glf = bb.utils.lockfile(self.cachefile + ".lock")
 
-        data = self.cachedata
-
-        have_data = False
-
-        for f in [y for y in os.listdir(os.path.dirname(self.cachefile)) if y.startswith(os.path.basename(self.cachefile) + '-')]:
-            f = os.path.join(os.path.dirname(self.cachefile), f)
+        try:
+            self.segment_offset = self.replay_segments(self.cachedata, self.segment_offset)
             try:
-                with open(f, "rb") as fd:
-                    p = pickle.Unpickler(fd)
-                    extradata, version = p.load()
-            except (IOError, EOFError):
-                os.unlink(f)
-                continue
-
-            if version != self.__class__.CACHE_VERSION:
-                os.unlink(f)
-                continue
+                segmentsize = os.path.getsize(self.segmentfile)
+            except FileNotFoundError:
+                segmentsize = 0
+            if not segmentsize and not self.compact:
+                return
 
-            have_data = True
-            self.merge_data(extradata, data)
-            os.unlink(f)
+            try:
+                cachesize = os.path.getsize(self.cachefile)
+            except FileNotFoundError:
+                cachesize = 0
+            # Anything after the last complete record is left over from an
+            # interrupted write, nothing can be appending whilst we hold the
+            # lock, so compact to get rid of it
+            if not self.compact and segmentsize == self.segment_offset and \
+                    segmentsize <= cachesize * MULTIPROCESS_SEGMENT_RATIO:
+                return
 
-        if have_data:
-            with open(self.cachefile, "wb") as f:
+            tmpfile = self.cachefile + ".tmp"
+            with open(tmpfile, "wb") as f:
                 p = pickle.Pickler(f, -1)
-                p.dump([data, self.__class__.CACHE_VERSION])
-
-        bb.utils.unlockfile(glf)
+                p.dump([self.cachedata, self.__class__.CACHE_VERSION])
+            os.rename(tmpfile, self.cachefile)
+            bb.utils.remove(self.segmentfile)
+            self.segment_ino = None
+            self.segment_offset = 0
+            self.compact = False
+        finally:
+            bb.utils.unlockfile(glf)
 
 
 class SimpleCache(object):
@@ -28,6 +28,8 @@ import sys
 import codegen
 import logging
 import inspect
+import importlib.util
+import marshal
 import bb.pysh as pysh
 import bb.utils, bb.data
 import hashlib
@@ -206,16 +208,71 @@ class CodeParserCache(MultiProcessCache):
         data = [{}, {}]
         return data
 
+class CompiledCodeCache(MultiProcessCache):
+    """
+    Persistent cache of compiled python code objects, stored marshalled and
+    keyed by a hash of the source, filename and compile mode. Marshalled code
+    is only valid for the interpreter which wrote it so the bytecode magic
+    number forms part of the cache version.
+    """
+    cache_file_name = "bb_compiledcode.dat"
+    CACHE_VERSION = "1-" + importlib.util.MAGIC_NUMBER.hex()
+
+    def __init__(self):
+        MultiProcessCache.__init__(self)
+        self.codecache = self.cachedata[0]
+        self.codecacheextras = self.cachedata_extras[0]
+
+    def init_cache(self, cachedir):
+        # Check if we already have the caches
+        if self.codecache:
+            return
+
+        MultiProcessCache.init_cache(self, cachedir)
+
+        # cachedata gets re-assigned in the parent
+        self.codecache = self.cachedata[0]
+
+    def compile(self, text, filename, mode):
+        h = bbhash("%s\0%s\0%s" % (mode, filename, text))
+        data = self.codecache.get(h) or self.codecacheextras.get(h)
+        if data:
+            try:
+                return marshal.loads(data)
+            except (EOFError, ValueError, TypeError):
+                pass
+
+        code = compile(text, filename, mode)
+        self.codecacheextras[h] = marshal.dumps(code)
+        return code
+
 codeparsercache = CodeParserCache()
+compiledcodecache = CompiledCodeCache()
 
 def parser_cache_init(cachedir):
     codeparsercache.init_cache(cachedir)
+    compiledcodecache.init_cache(cachedir)
 
 def parser_cache_save():
     codeparsercache.save_extras()
+    compiledcodecache.save_extras()
 
 def parser_cache_savemerge():
     codeparsercache.save_merge()
+    compiledcodecache.save_merge()
+
+def compiled_cache_save():
+    # Most tasks only run code which is already in the cache, don't take
+    # the cache lock for them
+    if compiledcodecache.codecacheextras:
+        compiledcodecache.save_extras()
+
+def compile_cached(text, filename, mode = "exec"):
+    """
+    Compile text like compile() would, reusing a previously compiled code
+    object from the persistent cache where possible
+    """
+    return compiledcodecache.compile(text, filename, mode)
 
 Logger = logging.getLoggerClass()
 class BufferedLogger(Logger):
@@ -10,6 +10,7 @@
 #
 
 import sys, os, glob, os.path, re, time
+import gc
 import itertools
 import logging
 import multiprocessing
@@ -17,7 +18,7 @@ import threading
 from io import StringIO, UnsupportedOperation
 from contextlib import closing
 from collections import defaultdict, namedtuple
-import bb, bb.exceptions, bb.command
+import bb, bb.exceptions, bb.command, bb.filewatch
 from bb import utils, data, parse, event, cache, providers, taskdata, runqueue, build
 import queue
 import signal
@@ -156,6 +157,9 @@ class BBCooker:
 
         self.configwatched = {}
         self.parsewatched = {}
+        # Optional inotify based tracking of the above, see BB_CACHE_INOTIFY
+        self.filewatcher = None
+        self.statskipped = 0
 
         # If being called by something like tinfoil, we need to clean cached data
         # which may now be invalid
@@ -221,6 +225,9 @@ class BBCooker:
             mtime = i[1]
             watcher[f] = mtime
 
+        if self.filewatcher:
+            self.filewatcher.add([i[0] for i in deps])
+
     def sigterm_exception(self, signum, stackframe):
         if signum == signal.SIGTERM:
             bb.warn("Cooker received SIGTERM, shutting down...")
@@ -350,8 +357,20 @@ class BBCooker:
     def revalidateCaches(self):
         bb.parse.clear_cache()
 
+        configwatched = self.configwatched
+        parsewatched = self.parsewatched
+        self.statskipped = 0
+        if self.filewatcher:
+            # Only files the watcher saw change (or doesn't know about) need
+            # their mtimes checking
+            changed = set(self.filewatcher.changed_files(itertools.chain(configwatched, parsewatched)))
+            configwatched = [f for f in configwatched if f in changed]
+            parsewatched = [f for f in parsewatched if f in changed]
+            self.statskipped = len(self.configwatched) + len(self.parsewatched) - len(changed)
+            bb.server.process.serverlog("File watcher skipped %d mtime checks" % self.statskipped)
+
         clean = True
-        for f in self.configwatched:
+        for f in configwatched:
             if not bb.parse.check_mtime(f, self.configwatched[f]):
                 bb.server.process.serverlog("Found %s changed, invalid cache" % f)
                 self._baseconfig_set(False)
@@ -360,7 +379,7 @@ class BBCooker:
                 break
 
         if clean:
-            for f in self.parsewatched:
+            for f in parsewatched:
                 if not bb.parse.check_mtime(f, self.parsewatched[f]):
                     bb.server.process.serverlog("Found %s changed, invalid cache" % f)
                     self._parsecache_set(False)
@@ -1599,6 +1618,14 @@ class BBCooker:
             bb.server.process.serverlog("Parsing started")
             self.parsewatched = {}
 
+            if bb.utils.to_boolean(self.data.getVar("BB_CACHE_INOTIFY")):
+                if not self.filewatcher:
+                    self.filewatcher = bb.filewatch.FileWatcher()
+                self.filewatcher.add(self.configwatched)
+            elif self.filewatcher:
+                self.filewatcher.close()
+                self.filewatcher = None
+
             bb.parse.siggen.reset(self.data)
             self.parseConfiguration ()
             if CookerFeatures.SEND_SANITYEVENTS in self.featureset:
@@ -1707,6 +1734,8 @@ class BBCooker:
         if self.hashserv:
             self.hashserv.process.terminate()
             self.hashserv.process.join()
+        if self.filewatcher:
+            self.filewatcher.close()
         if hasattr(self, "data"):
             bb.event.fire(CookerExit(), self.data)
 
@@ -1993,10 +2022,12 @@ class ParsingFailure(Exception):
         Exception.__init__(self, realexception, recipe)
 
 class Parser(multiprocessing.Process):
-    def __init__(self, jobs, results, quit, profile):
+    def __init__(self, jobs, results, quit, profile, databuilder=None, snapshots=None):
         self.jobs = jobs
         self.results = results
         self.quit = quit
+        self.databuilder = databuilder
+        self.snapshots = snapshots
         multiprocessing.Process.__init__(self)
         self.context = bb.utils.get_context().copy()
         self.handlers = bb.event.get_class_handlers().copy()
@@ -2051,6 +2082,10 @@ class Parser(multiprocessing.Process):
         multiprocessing.util.Finalize(None, bb.codeparser.parser_cache_save, exitpriority=1)
         multiprocessing.util.Finalize(None, bb.fetch.fetcher_parse_save, exitpriority=1)
 
+        if self.snapshots:
+            self.databuilder.useSnapshots(self.snapshots)
+        bb.data_smart.ExpandCacheStats.reset()
+
         pending = []
         havejobs = True
         try:
@@ -2075,6 +2110,9 @@ class Parser(multiprocessing.Process):
                         self.results.put(result, timeout=0.05)
                     except queue.Full:
                         pending.append(result)
+
+            stats = bb.data_smart.ExpandCacheStats
+            parselog.debug("%s: expansion cache %d hits, %d misses", multiprocessing.current_process().name, stats.hits, stats.misses)
         finally:
             self.results.close()
             self.results.join_thread()
@@ -2130,6 +2168,15 @@ class CookerParser(object):
         self.bb_caches = bb.cache.MulticonfigCache(self.cfgbuilder, self.cfghash, cooker.caches_array)
         self.fromcache = set()
         self.willparse = set()
+
+        unchanged = None
+        self.filewatcher = self.cooker.filewatcher
+        if self.filewatcher:
+            self.filewatch_seq = self.filewatcher.start_validation(self.cfghash)
+            unchanged = lambda mc, fn, paths: self.filewatcher.unchanged((mc, fn), paths, self.cfghash)
+        _, self.statskipped = self.bb_caches.prepare_validation({mc: self.mcfilelist[mc] for mc in self.cooker.multiconfigs},
+                                                                unchanged=unchanged)
+        self.statskipped += self.cooker.statskipped
         for mc in self.cooker.multiconfigs:
             for filename in self.mcfilelist[mc]:
                 appends = self.cooker.collections[mc].get_file_appends(filename)
@@ -2164,11 +2211,21 @@ class CookerParser(object):
                 return [lst[i::n] for i in range(n)]
             self.jobs = chunkify(list(self.willparse), self.num_processes)
 
-            for i in range(0, self.num_processes):
-                parser = Parser(self.jobs[i], self.result_queue, self.parser_quit, self.cooker.configuration.profile)
-                parser.start()
-                self.process_names.append(parser.name)
-                self.processes.append(parser)
+            # The parser processes share the configuration data through fork.
+            # Compact it first so each recipe copy only has one level to look
+            # through and move everything out of the garbage collector's view
+            # so collections in the parsers don't dirty the shared pages.
+            snapshots = self.cooker.databuilder.createSnapshots()
+            gc.freeze()
+            try:
+                for i in range(0, self.num_processes):
+                    parser = Parser(self.jobs[i], self.result_queue, self.parser_quit, self.cooker.configuration.profile,
+                                    self.cooker.databuilder, snapshots)
+                    parser.start()
+                    self.process_names.append(parser.name)
+                    self.processes.append(parser)
+            finally:
+                gc.unfreeze()
 
             self.results = itertools.chain(self.results, self.parse_generator())
 
@@ -2183,7 +2240,7 @@ class CookerParser(object):
             event = bb.event.ParseCompleted(self.cached, self.parsed,
                                             self.skipped, self.masked,
                                             self.virtuals, self.error,
-                                            self.total)
+                                            self.total, self.statskipped)
 
             bb.event.fire(event, self.cfgdata)
         else:
@@ -2345,6 +2402,9 @@ class CookerParser(object):
                 self.cooker.skiplist[virtualfn] = SkippedPackage(info_array[0])
             self.bb_caches[mc].add_info(virtualfn, info_array, self.cooker.recipecaches[mc],
                                         parsed=parsed, watcher = self.cooker.add_filewatch)
+            if self.filewatcher and virtualfn == bb.cache.virtualfn2realfn(virtualfn)[0]:
+                mtimes, exists = self.bb_caches[mc].dependency_paths(virtualfn, info_array[0])
+                self.filewatcher.validated_recipe((mc, virtualfn), mtimes | exists, self.filewatch_seq)
         return True
 
     def reparse(self, filename):
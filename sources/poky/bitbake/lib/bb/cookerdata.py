@@ -337,6 +337,21 @@ class CookerDataBuilder(object):
             self.mcdata[mc] = bb.data.createCopy(self.mcorigdata[mc])
         self.data = self.mcdata['']
 
+    def createSnapshots(self):
+        """
+        Return compacted snapshots of the per multiconfig datastores recipes
+        are parsed against, see DataSmart.createSnapshot()
+        """
+        return {mc: self.mcdata[mc].createSnapshot() for mc in self.mcdata}
+
+    def useSnapshots(self, snapshots):
+        """
+        Parse recipes against snapshots from createSnapshots(). Only for use
+        in processes which do nothing but parse recipes.
+        """
+        self.mcdata = snapshots
+        self.data = snapshots['']
+
     def _findLayerConf(self, data):
         return findConfigFile("bblayers.conf", data)
 
@@ -18,6 +18,7 @@ BitBake build tools.
 
 import builtins
 import copy
+import functools
 import re
 import sys
 from collections.abc import MutableMapping
@@ -94,6 +95,25 @@ def infer_caller_details(loginfo, parent = False, varval = True):
         if func not in loginfo:
             loginfo['func'] = func
 
+@functools.lru_cache(maxsize=4096)
+def compile_expression(code, varname):
+    # The same inline python expressions are evaluated over and over again,
+    # both within and across recipes
+    return bb.codeparser.compile_cached(code, varname, "eval")
+
+class ExpandCacheStats(object):
+    """
+    Expansion cache hit and miss counts for the current process, logged at
+    debug level by the parser processes once parsing completes
+    """
+    hits = 0
+    misses = 0
+
+    @classmethod
+    def reset(cls):
+        cls.hits = 0
+        cls.misses = 0
+
 class VariableParse:
     def __init__(self, varname, d, unexpanded_value = None, val = None):
         self.varname = varname
@@ -132,7 +152,7 @@ class VariableParse:
                 varname = 'Var <%s>' % self.varname
             else:
                 varname = '<expansion>'
-            codeobj = compile(code.strip(), varname, "eval")
+            codeobj = compile_expression(code.strip(), varname)
 
             parser = bb.codeparser.PythonParser(self.varname, logger)
             parser.parse_python(code)
@@ -441,6 +461,8 @@ class DataSmart(MutableMapping):
         self.overrides = None
         self.overridevars = set(["OVERRIDES", "FILE"])
         self.inoverride = False
+        self.overrideindex = {}
+        self.overrideresolved = {}
 
     def enableTracking(self):
         self._tracking = True
@@ -483,7 +505,23 @@ class DataSmart(MutableMapping):
         return varparse
 
     def expand(self, s, varname = None):
-        return self.expandWithRefs(s, varname).value
+        if not isinstance(s, str) or '${' not in s:
+            return s
+
+        # expand_cache is replaced whenever the datastore is changed so its
+        # identity serves as the datastore generation. Results are only
+        # stored if nothing changed during the expansion itself.
+        cache = self.expand_cache
+        key = (s, varname)
+        if key in cache:
+            ExpandCacheStats.hits += 1
+            return cache[key]
+        ExpandCacheStats.misses += 1
+
+        value = self.expandWithRefs(s, varname).value
+        if cache is self.expand_cache:
+            cache[key] = value
+        return value
 
     def need_overrides(self):
         if self.overrides is not None:
@@ -496,9 +534,11 @@ class DataSmart(MutableMapping):
             # Can end up here recursively so setup dummy values
             self.overrides = []
             self.overridesset = set()
+            self._reset_override_index()
             self.overrides = (self.getVar("OVERRIDES") or "").split(":") or []
             overrride_stack.append(self.overrides)
             self.overridesset = set(self.overrides)
+            self._reset_override_index()
             self.inoverride = False
             self.expand_cache = {}
             newoverrides = (self.getVar("OVERRIDES") or "").split(":") or []
@@ -506,9 +546,64 @@ class DataSmart(MutableMapping):
                 break
             self.overrides = newoverrides
             self.overridesset = set(self.overrides)
+            self._reset_override_index()
         else:
             bb.fatal("Overrides could not be expanded into a stable state after 5 iterations, overrides must be being referenced by other overridden variables in some recursive fashion. Please provide your configuration to bitbake-devel so we can laugh, er, I mean try and understand how to make it work. The list of failing override expansions: %s" % "\n".join(str(s) for s in overrride_stack))
 
+    def _reset_override_index(self):
+        # Both are only valid for the current value of self.overrides
+        self.overrideindex = {}
+        self.overrideresolved = {}
+
+    def _override_active(self, override):
+        """
+        Return whether all components of an override string such as
+        "arm:qemuall" are currently in OVERRIDES. need_overrides() must
+        have been called.
+        """
+        try:
+            return self.overrideindex[override]
+        except KeyError:
+            pass
+        active = True
+        for o in override.split(":"):
+            if o not in self.overridesset:
+                active = False
+                break
+        self.overrideindex[override] = active
+        return active
+
+    def _resolve_override(self, active):
+        """
+        Given the set of active override strings for a variable, return the
+        one whose value should be used, or None. The result only depends on
+        that set and OVERRIDES so it is computed once per distinct set.
+        """
+        key = frozenset(active)
+        try:
+            return self.overrideresolved[key]
+        except KeyError:
+            pass
+
+        match = None
+        active = dict((o, o) for o in active)
+        mod = True
+        while mod:
+            mod = False
+            for o in self.overrides:
+                for a in active.copy():
+                    if a.endswith(":" + o):
+                        t = active[a]
+                        del active[a]
+                        active[a.replace(":" + o, "")] = t
+                        mod = True
+                    elif a == o:
+                        match = active[a]
+                        del active[a]
+
+        self.overrideresolved[key] = match
+        return match
+
     def initVar(self, var):
         self.expand_cache = {}
         if not var in self.dict:
@@ -605,11 +700,8 @@ class DataSmart(MutableMapping):
                 active = []
                 self.need_overrides()
                 for (r, o) in self.overridedata[var]:
-                    if o in self.overridesset:
+                    if self._override_active(o):
                         active.append(r)
-                    elif ":" in o:
-                        if set(o.split(":")).issubset(self.overridesset):
-                            active.append(r)
                 for a in active:
                     self.delVar(a)
                 del self.overridedata[var]
@@ -780,9 +872,11 @@ class DataSmart(MutableMapping):
             cachename = var + "[" + flag + "]"
 
         if not expand and retparser and cachename in self.expand_cache:
+            ExpandCacheStats.hits += 1
             return self.expand_cache[cachename].unexpanded_value, self.expand_cache[cachename]
 
         if expand and cachename in self.expand_cache:
+            ExpandCacheStats.hits += 1
             return self.expand_cache[cachename].value
 
         local_var = self._findVar(var)
@@ -796,25 +890,13 @@ class DataSmart(MutableMapping):
             self.need_overrides()
             for (r, o) in overridedata:
                 # FIXME What about double overrides both with "_" in the name?
-                if o in self.overridesset:
+                if self._override_active(o):
                     active[o] = r
-                elif ":" in o:
-                    if set(o.split(":")).issubset(self.overridesset):
-                        active[o] = r
-
-            mod = True
-            while mod:
-                mod = False
-                for o in self.overrides:
-                    for a in active.copy():
-                        if a.endswith(":" + o):
-                            t = active[a]
-                            del active[a]
-                            active[a.replace(":" + o, "")] = t
-                            mod = True
-                        elif a == o:
-                            match = active[a]
-                            del active[a]
+
+            if active:
+                o = self._resolve_override(active)
+                if o is not None:
+                    match = active[o]
             if match:
                 value, subparser = self.getVarFlag(match, "_content", False, retparser=True)
                 if hasattr(subparser, "removes"):
@@ -832,11 +914,7 @@ class DataSmart(MutableMapping):
         if flag == "_content" and local_var is not None and ":append" in local_var and not parsing:
             self.need_overrides()
             for (r, o) in local_var[":append"]:
-                match = True
-                if o:
-                    for o2 in o.split(":"):
-                        if not o2 in self.overrides:
-                            match = False                            
+                match = not o or self._override_active(o)
                 if match:
                     if value is None:
                         value = ""
@@ -846,11 +924,7 @@ class DataSmart(MutableMapping):
             self.need_overrides()
             for (r, o) in local_var[":prepend"]:
 
-                match = True
-                if o:
-                    for o2 in o.split(":"):
-                        if not o2 in self.overrides:
-                            match = False                            
+                match = not o or self._override_active(o)
                 if match:
                     if value is None:
                         value = ""
@@ -858,6 +932,7 @@ class DataSmart(MutableMapping):
 
         parser = None
         if expand or retparser:
+            ExpandCacheStats.misses += 1
             parser = self.expandWithRefs(value, cachename)
         if expand:
             value = parser.value
@@ -865,11 +940,7 @@ class DataSmart(MutableMapping):
         if value and flag == "_content" and local_var is not None and ":remove" in local_var and not parsing:
             self.need_overrides()
             for (r, o) in local_var[":remove"]:
-                match = True
-                if o:
-                    for o2 in o.split(":"):
-                        if not o2 in self.overrides:
-                            match = False                            
+                match = not o or self._override_active(o)
                 if match:
                     removes.add(r)
 
@@ -1004,6 +1075,37 @@ class DataSmart(MutableMapping):
 
         return data
 
+    def createSnapshot(self):
+        """
+        Create a compacted copy of self to use as a read-only base for many
+        short lived copies made with createCopy(), e.g. one per parsed recipe.
+        The chain of parent datastores is collapsed into a single level so
+        lookups from those copies walk at most one parent. Variable contents
+        are shared with self, so neither self nor the snapshot should be
+        modified while the snapshot is in use.
+        """
+        data = self.createCopy()
+
+        chain = []
+        dest = self.dict
+        while dest:
+            chain.append(dest)
+            dest = dest.get("_data")
+
+        flat = {}
+        for dest in reversed(chain):
+            for var, vardata in dest.items():
+                if var == "_data":
+                    continue
+                if vardata:
+                    flat[var] = vardata
+                else:
+                    # Deleted in this layer
+                    flat.pop(var, None)
+        data.dict = flat
+
+        return data
+
     def expandVarref(self, variable, parents=False):
         """Find all references to variable in the data and expand it
            in place, optionally descending to parent datastores."""
@@ -1050,11 +1152,8 @@ class DataSmart(MutableMapping):
         self.need_overrides()
         for var in self.overridedata:
             for (r, o) in self.overridedata[var]:
-                if o in self.overridesset:
+                if self._override_active(o):
                     overrides.add(var)
-                elif ":" in o:
-                    if set(o.split(":")).issubset(self.overridesset):
-                        overrides.add(var)
 
         for k in keylist(self.dict):
              yield k
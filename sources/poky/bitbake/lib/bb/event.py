@@ -607,7 +607,7 @@ class ParseStarted(OperationStarted):
 
 class ParseCompleted(OperationCompleted):
     """Recipe parsing for the runqueue has completed"""
-    def __init__(self, cached, parsed, skipped, masked, virtuals, errors, total):
+    def __init__(self, cached, parsed, skipped, masked, virtuals, errors, total, statskipped=0):
         OperationCompleted.__init__(self, total, "Recipe parsing Completed")
         self.cached = cached
         self.parsed = parsed
@@ -615,6 +615,7 @@ class ParseCompleted(OperationCompleted):
         self.virtuals = virtuals
         self.masked = masked
         self.errors = errors
+        self.statskipped = statskipped
         self.sofar = cached + parsed
 
 class ParseProgress(OperationProgress):
@@ -13,6 +13,7 @@ BitBake build tools.
 # Based on functions from the base bb module, Copyright 2003 Holger Schurig
 
 import os, re
+import concurrent.futures
 import signal
 import logging
 import urllib.request, urllib.parse, urllib.error
@@ -21,6 +22,7 @@ if 'git' not in urllib.parse.uses_netloc:
 import operator
 import collections
 import subprocess
+import threading
 import pickle
 import errno
 import bb.persist_data, bb.utils
@@ -711,6 +713,9 @@ def update_stamp(ud, d):
         donestamp is file stamp indicating the whole fetching is done
         this function update the stamp after verifying the checksum
     """
+    # Checksums the fetcher computed while downloading, if it did
+    precomputed, ud.downloaded_checksums = ud.downloaded_checksums, {}
+
     if not ud.needdonestamp:
         return
 
@@ -723,7 +728,7 @@ def update_stamp(ud, d):
             pass
     else:
         try:
-            checksums = verify_checksum(ud, d)
+            checksums = verify_checksum(ud, d, precomputed=precomputed)
             # Store the checksums for later re-verification against the recipe
             with open(ud.donestamp, "wb") as cachefile:
                 p = pickle.Pickler(cachefile, 2)
@@ -1292,6 +1297,7 @@ class FetchData(object):
         # localpath is the location of a downloaded result. If not set, the file is local.
         self.donestamp = None
         self.needdonestamp = True
+        self.downloaded_checksums = {}
         self.localfile = ""
         self.localpath = None
         self.lockfile = None
@@ -1829,105 +1835,157 @@ class Fetch(object):
             urls = self.urls
 
         network = self.d.getVar("BB_NO_NETWORK")
-        premirroronly = bb.utils.to_boolean(self.d.getVar("BB_FETCH_PREMIRRORONLY"))
+        threads = int(self.d.getVar("BB_NUMBER_FETCH_THREADS") or 1)
+
+        if threads > 1 and len(urls) > 1:
+            checksum_missing_messages = self.download_concurrent(urls, network, threads)
+        else:
+            checksum_missing_messages = []
+            for u in urls:
+                message = self.download_url(u, self.d, network)
+                if message:
+                    checksum_missing_messages.append(message)
+
+        if checksum_missing_messages:
+            logger.error("Missing SRC_URI checksum, please add those to the recipe: \n%s", "\n".join(checksum_missing_messages))
+            raise BBFetchException("There was some missing checksums in the recipe")
 
-        checksum_missing_messages = []
+    def download_concurrent(self, urls, network, threads):
+        """
+        Fetch urls using up to threads threads. Once one fails no more are
+        started and, when those in progress have finished, the error of the
+        first in urls to fail is raised. Returns the messages for the URLs
+        without a checksum, as download_url().
+        """
+        # URLs sharing a lock file would only wait for each other, so each
+        # group of them is fetched in turn by one thread
+        groups = {}
         for u in urls:
-            ud = self.ud[u]
-            ud.setup_localpath(self.d)
-            m = ud.method
-            done = False
+            groups.setdefault(self.ud[u].lockfile or u, []).append(u)
+
+        messages = {}
+        errors = {}
+        failed = threading.Event()
+
+        def download_group(group):
+            # Each URL changes BB_NO_NETWORK so each thread needs its own copy
+            d = self.d.createCopy()
+            for u in group:
+                if failed.is_set():
+                    return
+                try:
+                    messages[u] = self.download_url(u, d, network)
+                except BaseException as e:
+                    errors[u] = e
+                    failed.set()
+                    return
 
-            if ud.lockfile:
-                lf = bb.utils.lockfile(ud.lockfile)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+            for f in [executor.submit(download_group, group) for group in groups.values()]:
+                f.result()
 
-            try:
-                self.d.setVar("BB_NO_NETWORK", network)
-                if m.verify_donestamp(ud, self.d) and not m.need_update(ud, self.d):
-                    done = True
-                elif m.try_premirror(ud, self.d):
-                    logger.debug("Trying PREMIRRORS")
-                    mirrors = mirror_from_string(self.d.getVar('PREMIRRORS'))
-                    done = m.try_mirrors(self, ud, self.d, mirrors)
-                    if done:
-                        try:
-                            # early checksum verification so that if the checksum of the premirror
-                            # contents mismatch the fetcher can still try upstream and mirrors
-                            m.update_donestamp(ud, self.d)
-                        except ChecksumError as e:
-                            logger.warning("Checksum failure encountered with premirror download of %s - will attempt other sources." % u)
-                            logger.debug(str(e))
-                            done = False
-
-                if premirroronly:
-                    self.d.setVar("BB_NO_NETWORK", "1")
-
-                firsterr = None
-                verified_stamp = False
+        for u in urls:
+            if u in errors:
+                raise errors[u]
+        return [messages[u] for u in urls if messages.get(u)]
+
+    def download_url(self, u, d, network):
+        """
+        Fetch a single url using the datastore d. Returns the message to
+        report if the url has no checksum.
+        """
+        premirroronly = bb.utils.to_boolean(d.getVar("BB_FETCH_PREMIRRORONLY"))
+        ud = self.ud[u]
+        ud.setup_localpath(d)
+        m = ud.method
+        done = False
+
+        if ud.lockfile:
+            lf = bb.utils.lockfile(ud.lockfile)
+
+        try:
+            d.setVar("BB_NO_NETWORK", network)
+            if m.verify_donestamp(ud, d) and not m.need_update(ud, d):
+                done = True
+            elif m.try_premirror(ud, d):
+                logger.debug("Trying PREMIRRORS")
+                mirrors = mirror_from_string(d.getVar('PREMIRRORS'))
+                done = m.try_mirrors(self, ud, d, mirrors)
                 if done:
-                    verified_stamp = m.verify_donestamp(ud, self.d)
-                if not done and (not verified_stamp or m.need_update(ud, self.d)):
                     try:
-                        if not trusted_network(self.d, ud.url):
-                            raise UntrustedUrl(ud.url)
-                        logger.debug("Trying Upstream")
-                        m.download(ud, self.d)
-                        if hasattr(m, "build_mirror_data"):
-                            m.build_mirror_data(ud, self.d)
-                        done = True
-                        # early checksum verify, so that if checksum mismatched,
-                        # fetcher still have chance to fetch from mirror
-                        m.update_donestamp(ud, self.d)
-
-                    except bb.fetch2.NetworkAccess:
+                        # early checksum verification so that if the checksum of the premirror
+                        # contents mismatch the fetcher can still try upstream and mirrors
+                        m.update_donestamp(ud, d)
+                    except ChecksumError as e:
+                        logger.warning("Checksum failure encountered with premirror download of %s - will attempt other sources." % u)
+                        logger.debug(str(e))
+                        done = False
+
+            if premirroronly:
+                d.setVar("BB_NO_NETWORK", "1")
+
+            firsterr = None
+            verified_stamp = False
+            if done:
+                verified_stamp = m.verify_donestamp(ud, d)
+            if not done and (not verified_stamp or m.need_update(ud, d)):
+                try:
+                    if not trusted_network(d, ud.url):
+                        raise UntrustedUrl(ud.url)
+                    logger.debug("Trying Upstream")
+                    m.download(ud, d)
+                    if hasattr(m, "build_mirror_data"):
+                        m.build_mirror_data(ud, d)
+                    done = True
+                    # early checksum verify, so that if checksum mismatched,
+                    # fetcher still have chance to fetch from mirror
+                    m.update_donestamp(ud, d)
+
+                except bb.fetch2.NetworkAccess:
+                    raise
+
+                except BBFetchException as e:
+                    if isinstance(e, ChecksumError):
+                        logger.warning("Checksum failure encountered with download of %s - will attempt other sources if available" % u)
+                        logger.debug(str(e))
+                        if os.path.exists(ud.localpath):
+                            rename_bad_checksum(ud, e.checksum)
+                    elif isinstance(e, NoChecksumError):
                         raise
+                    else:
+                        logger.warning('Failed to fetch URL %s, attempting MIRRORS if available' % u)
+                        logger.debug(str(e))
+                    firsterr = e
+                    # Remove any incomplete fetch
+                    if not verified_stamp and m.cleanup_upon_failure():
+                        m.clean(ud, d)
+                    logger.debug("Trying MIRRORS")
+                    mirrors = mirror_from_string(d.getVar('MIRRORS'))
+                    done = m.try_mirrors(self, ud, d, mirrors)
+
+            if not done or not m.done(ud, d):
+                if firsterr:
+                    logger.error(str(firsterr))
+                raise FetchError("Unable to fetch URL from any source.", u)
+
+            m.update_donestamp(ud, d)
+
+        except IOError as e:
+            if e.errno in [errno.ESTALE]:
+                logger.error("Stale Error Observed %s." % u)
+                raise ChecksumError("Stale Error Detected")
+
+        except BBFetchException as e:
+            if isinstance(e, NoChecksumError):
+                (message, _) = e.args
+                return message
+            elif isinstance(e, ChecksumError):
+                logger.error("Checksum failure fetching %s" % u)
+            raise
 
-                    except BBFetchException as e:
-                        if isinstance(e, ChecksumError):
-                            logger.warning("Checksum failure encountered with download of %s - will attempt other sources if available" % u)
-                            logger.debug(str(e))
-                            if os.path.exists(ud.localpath):
-                                rename_bad_checksum(ud, e.checksum)
-                        elif isinstance(e, NoChecksumError):
-                            raise
-                        else:
-                            logger.warning('Failed to fetch URL %s, attempting MIRRORS if available' % u)
-                            logger.debug(str(e))
-                        firsterr = e
-                        # Remove any incomplete fetch
-                        if not verified_stamp and m.cleanup_upon_failure():
-                            m.clean(ud, self.d)
-                        logger.debug("Trying MIRRORS")
-                        mirrors = mirror_from_string(self.d.getVar('MIRRORS'))
-                        done = m.try_mirrors(self, ud, self.d, mirrors)
-
-                if not done or not m.done(ud, self.d):
-                    if firsterr:
-                        logger.error(str(firsterr))
-                    raise FetchError("Unable to fetch URL from any source.", u)
-
-                m.update_donestamp(ud, self.d)
-
-            except IOError as e:
-                if e.errno in [errno.ESTALE]:
-                    logger.error("Stale Error Observed %s." % u)
-                    raise ChecksumError("Stale Error Detected")
-
-            except BBFetchException as e:
-                if isinstance(e, NoChecksumError):
-                    (message, _) = e.args
-                    checksum_missing_messages.append(message)
-                    continue
-                elif isinstance(e, ChecksumError):
-                    logger.error("Checksum failure fetching %s" % u)
-                raise
-
-            finally:
-                if ud.lockfile:
-                    bb.utils.unlockfile(lf)
-        if checksum_missing_messages:
-            logger.error("Missing SRC_URI checksum, please add those to the recipe: \n%s", "\n".join(checksum_missing_messages))
-            raise BBFetchException("There was some missing checksums in the recipe")
+        finally:
+            if ud.lockfile:
+                bb.utils.unlockfile(lf)
 
     def checkstatus(self, urls=None):
         """
@@ -16,7 +16,14 @@ import shlex
 import re
 import tempfile
 import os
+import shutil
+import signal
+import sys
 import errno
+import base64
+import hashlib
+import threading
+import time
 import bb
 import bb.progress
 import socket
@@ -50,6 +57,185 @@ class WgetProgressHandler(bb.progress.LineFilterProgressHandler):
         return True
 
 
+class HTTPProgressHandler(bb.progress.ProgressHandler):
+    """
+    Report the progress of a download made with the native HTTP client in
+    the same way as WgetProgressHandler does for wget.
+    """
+    def __init__(self, d):
+        super(HTTPProgressHandler, self).__init__(d)
+        self._start = time.monotonic()
+        self._received = 0
+        # Send an initial progress event so the bar gets shown
+        self._fire_progress(0)
+
+    def received(self, count, size, total):
+        """
+        Record that count more bytes were received, making size bytes out of
+        total (None if the server didn't say)
+        """
+        self._received += count
+        if not total:
+            return
+        elapsed = time.monotonic() - self._start
+        rate = self._received / elapsed if elapsed > 0 else 0
+        for unit in ("B", "K", "M", "G"):
+            if rate < 1024 or unit == "G":
+                break
+            rate /= 1024
+        self.update(int(size * 100 / total), "%.1f%s/s" % (rate, unit))
+
+
+# Settings of the native HTTP client, see BB_FETCH_NATIVE_HTTP
+HTTP_POOL_SIZE = 4
+HTTP_TIMEOUT = 30
+HTTP_TRIES = 2
+HTTP_MAX_REDIRECTS = 10
+HTTP_CHUNK_SIZE = 256 * 1024
+
+class HTTPConnectionPool(object):
+    """
+    Idle HTTP/1.1 connections of the native HTTP client, so that the
+    downloads from a server made by this process share a few connections
+    rather than each paying for a new TCP and TLS handshake. Connections are
+    keyed by (scheme, host, port, proxy, check certificates) and belong to
+    the process which opened them.
+    """
+    def __init__(self, size=HTTP_POOL_SIZE):
+        self.size = size
+        self.lock = threading.Lock()
+        self.idle = {}
+
+    def get(self, key, connect):
+        """
+        Return (connection, reused): an idle connection for key, or else a
+        new one from connect()
+        """
+        with self.lock:
+            if self.idle.get(key):
+                return self.idle[key].pop(), True
+        return connect(), False
+
+    def put(self, key, conn):
+        """Keep conn for the next request, or close it if enough are kept"""
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+            if len(idle) < self.size:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def clear(self):
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    def forget(self):
+        # A forked child mustn't use the connections of its parent
+        self.lock = threading.Lock()
+        self.idle = {}
+
+http_pool = HTTPConnectionPool()
+os.register_at_fork(after_in_child=http_pool.forget)
+
+# The socket of the HTTPDownloadServer making the downloads of this process,
+# if any
+http_server_address = None
+
+class HTTPDownloadServer(object):
+    """
+    Makes the native HTTP client downloads of other processes, which send it
+    the url and the file to write to. bitbake-worker starts one so that the
+    tasks it forks, which each start with an empty http_pool, share the
+    connections kept by this process instead, e.g. consecutive setscene
+    tasks fetching sstate objects from the same mirror.
+    """
+    def __init__(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="bitbake-http-")
+        self.address = os.path.join(self.tmpdir, "socket")
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.sock.bind(self.address)
+            self.sock.listen(100)
+        except OSError:
+            self.close()
+            raise
+
+    def start(self):
+        """
+        Fork the process serving the requests and have the processes forked
+        from this one afterwards use it. The server exits along with this
+        process. Returns its pid.
+        """
+        global http_server_address
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid:
+            self.sock.close()
+            http_server_address = self.address
+            return pid
+
+        ret = 1
+        try:
+            bb.utils.signal_on_parent_exit("SIGTERM")
+            bb.utils.set_process_name("HTTP downloads")
+            # stdout may be a channel to the parent, don't write to it
+            devnull = os.open(os.devnull, os.O_RDWR)
+            os.dup2(devnull, 0)
+            os.dup2(devnull, 1)
+            self.serve()
+        except SystemExit:
+            ret = 0
+        finally:
+            self.close()
+            os._exit(ret)
+
+    def serve(self):
+        def sigterm(signum, frame):
+            sys.exit(0)
+
+        signal.signal(signal.SIGTERM, sigterm)
+        # A process giving up on a download shouldn't stop the others
+        signal.signal(signal.SIGPIPE, signal.SIG_IGN)
+        while True:
+            sock, _ = self.sock.accept()
+            threading.Thread(target=self.handle, args=(sock,), daemon=True).start()
+
+    def handle(self, sock):
+        import multiprocessing.connection
+
+        with sock:
+            _, fds, _, _ = socket.recv_fds(sock, 1, 1)
+            if not fds:
+                return
+            conn = multiprocessing.connection.Connection(sock.detach())
+
+        def progress(count, size, total):
+            conn.send(("progress", count, size, total))
+
+        try:
+            with conn, os.fdopen(fds[0], "r+b") as f:
+                uri, login, env, check_certs = conn.recv()
+                try:
+                    reply = ("done", Wget()._http_download(uri, f, login, env, check_certs, progress))
+                except FetchError as e:
+                    reply = ("error", e)
+                except Exception as e:
+                    reply = ("error", FetchError("Unable to fetch %s: %s" % (uri, e), uri))
+                conn.send(reply)
+        except (OSError, EOFError):
+            # The process went away without waiting for the download
+            pass
+
+    def close(self):
+        self.sock.close()
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+
 class Wget(FetchMethod):
     """Class to fetch urls via 'wget'"""
 
@@ -103,9 +289,18 @@ class Wget(FetchMethod):
         bb.fetch2.check_network_access(d, command, ud.url)
         runfetchcmd(command + ' --progress=dot -v', d, quiet, log=progresshandler, workdir=workdir)
 
+    def native_http(self, ud, d):
+        """
+        Should ud be downloaded with the native HTTP client rather than wget?
+        """
+        return ud.type in ['http', 'https'] and bb.utils.to_boolean(d.getVar("BB_FETCH_NATIVE_HTTP"))
+
     def download(self, ud, d):
         """Fetch urls"""
 
+        if self.native_http(ud, d):
+            return self._download_http(ud, d)
+
         fetchcmd = self.basecmd
 
         dldir = os.path.realpath(d.getVar("DL_DIR"))
@@ -155,6 +350,309 @@ class Wget(FetchMethod):
 
         return True
 
+    def _download_http(self, ud, d):
+        """
+        Fetch urls with the native HTTP client, reusing the connections kept
+        in http_pool and resuming from any partial download left behind.
+        The download is made by the worker's HTTPDownloadServer if there is
+        one, so that it can reuse the connections of earlier tasks.
+        """
+        dldir = os.path.realpath(d.getVar("DL_DIR"))
+        localpath = os.path.join(dldir, ud.localfile) + ".tmp"
+        bb.utils.mkdirhier(os.path.dirname(localpath))
+
+        uri = ud.url.split(";")[0]
+        logger.debug2("Fetching %s using the native HTTP client" % ud.url)
+        bb.fetch2.check_network_access(d, "GET %s" % uri, ud.url)
+
+        login = (ud.user, ud.pswd) if ud.user and ud.pswd else None
+        env = bb.fetch2.get_fetcher_environment(d)
+        check_certs = self.check_certs(d)
+        progress = HTTPProgressHandler(d)
+        with os.fdopen(os.open(localpath, os.O_RDWR | os.O_CREAT, 0o666), "r+b") as f:
+            checksums = self._http_download_with_server(uri, f, login, env, check_certs, progress.received)
+            if checksums is None:
+                checksums = self._http_download(uri, f, login, env, check_certs, progress.received)
+
+        if os.path.getsize(localpath) == 0:
+            os.remove(localpath)
+            raise FetchError("The fetch of %s resulted in a zero size file?! Deleting and failing since this isn't right." % (uri), uri)
+
+        try:
+            bb.fetch2.verify_checksum(ud, d, precomputed=checksums, localpath=localpath, fatal_nochecksum=False)
+        except bb.fetch2.ChecksumError:
+            # Don't resume from a bad file next time
+            os.remove(localpath)
+            raise
+
+        os.rename(localpath, localpath[:-4])
+        # Spare update_stamp() from reading the file again
+        ud.downloaded_checksums = checksums
+
+        return True
+
+    def _http_download_with_server(self, uri, f, login, env, check_certs, progress):
+        """
+        Have the HTTPDownloadServer at http_server_address download uri into
+        the file f as _http_download() would. Returns None if there is no
+        server to ask.
+        """
+        import multiprocessing.connection
+
+        if not http_server_address:
+            return None
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(http_server_address)
+            socket.send_fds(sock, [b"F"], [f.fileno()])
+        except OSError as e:
+            sock.close()
+            logger.debug2("Unable to use the HTTP download server (%s), fetching %s directly" % (e, uri))
+            return None
+
+        with multiprocessing.connection.Connection(sock.detach()) as conn:
+            try:
+                conn.send((uri, login, env, check_certs))
+                while True:
+                    reply = conn.recv()
+                    if reply[0] == "progress":
+                        progress(*reply[1:])
+                    elif reply[0] == "error":
+                        raise reply[1]
+                    else:
+                        return reply[1]
+            except (OSError, EOFError) as e:
+                raise FetchError("Lost the HTTP download server while fetching %s (%s)" % (uri, e), uri)
+
+    def _http_download(self, uri, f, login, env, check_certs, progress):
+        """
+        Download uri into the file f, trying again if it fails, and return
+        the checksums of the file. login is the (user, password) of the url,
+        if any, and progress is called as HTTPProgressHandler.received().
+        """
+        for tries in range(HTTP_TRIES, 0, -1):
+            try:
+                return self._http_get(uri, f, login, env, check_certs, progress)
+            except (OSError, http.client.HTTPException) as e:
+                if tries == 1:
+                    raise FetchError("Unable to fetch %s: %s" % (uri, e), uri)
+                logger.debug2("Fetching %s failed (%s), trying again" % (uri, e))
+
+    def _http_get(self, uri, f, login, env, check_certs, progress):
+        """
+        Download uri into the file f, appending to it if it already holds the
+        start of the file. Returns the checksums of the whole file, computed
+        as it is written.
+        """
+        offset = os.fstat(f.fileno()).st_size
+        url = uri
+        redirected = False
+        for _ in range(HTTP_MAX_REDIRECTS + 1):
+            parts = urllib.parse.urlsplit(url)
+            key, connect, target, headers = self._http_connection(env, parts, check_certs)
+            headers["Accept"] = "*/*"
+            headers["User-Agent"] = self.user_agent
+            auth = self._http_auth(parts, login, redirected, env)
+            if auth:
+                headers["Authorization"] = auth
+            if offset:
+                headers["Range"] = "bytes=%d-" % offset
+
+            conn, response = self._http_request(key, connect, target, headers)
+            status = response.status
+            if status in (301, 302, 303, 307, 308):
+                location = response.getheader("Location")
+                self._http_release(key, conn, response)
+                if not location:
+                    raise FetchError("Redirect without a location when fetching %s" % url, uri)
+                url = urllib.parse.urljoin(url, location)
+                redirected = True
+                continue
+
+            if status == 206 and not (response.getheader("Content-Range") or "").startswith("bytes %d-" % offset):
+                conn.close()
+                offset = 0
+                continue
+            if status == 416 and offset:
+                # The partial file isn't shorter than the file on the server,
+                # so it can't be the start of it
+                self._http_release(key, conn, response)
+                offset = 0
+                continue
+            if status not in (200, 206):
+                self._http_release(key, conn, response)
+                raise FetchError("Fetch of %s failed with HTTP status %d %s" % (url, status, response.reason), uri)
+
+            if status == 200:
+                offset = 0
+            try:
+                checksums = self._http_write(response, f, offset, progress)
+            except BaseException:
+                conn.close()
+                raise
+            self._http_release(key, conn, response)
+            return checksums
+
+        raise FetchError("Too many redirects when fetching %s" % uri, uri)
+
+    def _http_connection(self, env, parts, check_certs):
+        """
+        Return (key, connect, target, headers) for a request for the url
+        parts: the http_pool key and the function opening a connection for
+        it, and the request target and headers to send on it
+        """
+        scheme = parts.scheme
+        host = parts.hostname
+        port = parts.port or (443 if scheme == "https" else 80)
+        target = urllib.parse.quote(parts.path or "/", safe="/%:@!$&'()*+,;=~[]")
+        if parts.query:
+            target += "?" + parts.query
+        headers = {}
+
+        proxy = self._http_proxy(scheme, parts.netloc.rpartition("@")[2], env)
+        if not proxy:
+            if scheme == "https":
+                connect = lambda: http.client.HTTPSConnection(host, port, timeout=HTTP_TIMEOUT,
+                                                              context=self._ssl_context(check_certs, env))
+            else:
+                connect = lambda: http.client.HTTPConnection(host, port, timeout=HTTP_TIMEOUT)
+            return (scheme, host, port, None, check_certs), connect, target, headers
+
+        proxyparts = urllib.parse.urlsplit(proxy if "://" in proxy else "http://" + proxy)
+        proxyheaders = {}
+        if proxyparts.username:
+            login = "%s:%s" % (urllib.parse.unquote(proxyparts.username), urllib.parse.unquote(proxyparts.password or ""))
+            proxyheaders["Proxy-Authorization"] = "Basic " + base64.b64encode(login.encode("utf-8")).decode("utf-8")
+        proxyhost = proxyparts.hostname
+        proxyport = proxyparts.port or 80
+        if scheme == "https":
+            def connect():
+                conn = http.client.HTTPSConnection(proxyhost, proxyport, timeout=HTTP_TIMEOUT,
+                                                   context=self._ssl_context(check_certs, env))
+                conn.set_tunnel(host, port, headers=proxyheaders)
+                return conn
+        else:
+            connect = lambda: http.client.HTTPConnection(proxyhost, proxyport, timeout=HTTP_TIMEOUT)
+            target = "%s://%s:%d%s" % (scheme, host, port, target)
+            headers.update(proxyheaders)
+        return (scheme, host, port, proxy, check_certs), connect, target, headers
+
+    def _http_proxy(self, scheme, netloc, env):
+        """
+        Return the proxy to use for scheme://netloc according to the proxy
+        variables of the fetcher environment env, or None
+        """
+        def proxyvar(name):
+            return env.get("%s_proxy" % name) or env.get("%s_PROXY" % name.upper())
+
+        noproxy = proxyvar("no")
+        if noproxy and urllib.request.proxy_bypass_environment(netloc, {"no": noproxy}):
+            return None
+        return proxyvar(scheme)
+
+    def _ssl_context(self, check_certs, env):
+        import ssl
+
+        if not check_certs:
+            return ssl._create_unverified_context()
+        # As in checkstatus(), the certificates may be in a location only
+        # given by the fetcher environment
+        return ssl.create_default_context(cafile=env.get("SSL_CERT_FILE"), capath=env.get("SSL_CERT_DIR"))
+
+    def _http_auth(self, parts, login, redirected, env):
+        """
+        Return the Authorization header for a request for the url parts, or
+        None. As with wget, the user and password of the url in login are
+        only sent to the first host and not to the hosts it redirects to.
+        Otherwise the .netrc in the HOME of the fetcher environment env is
+        used.
+        """
+        if login and not redirected:
+            login = "%s:%s" % login
+        else:
+            login = None
+            try:
+                import netrc
+                netrcfile = os.path.join(env["HOME"], ".netrc") if env.get("HOME") else None
+                auth_data = netrc.netrc(netrcfile).authenticators(parts.hostname)
+                if auth_data:
+                    login = "%s:%s" % (auth_data[0], auth_data[2])
+            except (FileNotFoundError, netrc.NetrcParseError):
+                pass
+        if login:
+            return "Basic " + base64.b64encode(login.encode("utf-8")).decode("utf-8")
+        return None
+
+    def _http_request(self, key, connect, target, headers):
+        """
+        Send a GET request for target on a connection from http_pool and
+        return (connection, response). The server may have closed an idle
+        connection in the meantime, so the request is then sent again on
+        another one.
+        """
+        while True:
+            conn, reused = http_pool.get(key, connect)
+            try:
+                conn.request("GET", target, headers=headers)
+                return conn, conn.getresponse()
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                if not reused:
+                    raise
+
+    def _http_release(self, key, conn, response):
+        """
+        Read the rest of response and give conn back to http_pool, unless
+        the server is closing it
+        """
+        try:
+            response.read()
+        except BaseException:
+            conn.close()
+            raise
+        if response.will_close:
+            conn.close()
+        else:
+            http_pool.put(key, conn)
+
+    def _http_write(self, response, f, offset, progress):
+        """
+        Write the body of response to the file f from offset, calling progress
+        as it is received, and return the checksums of the file
+        """
+        hashes = [(checksum_id, hashlib.new(checksum_id)) for checksum_id in bb.fetch2.CHECKSUM_LIST]
+        total = offset + response.length if response.length is not None else None
+
+        f.seek(0)
+        if not offset:
+            f.truncate()
+        size = 0
+        try:
+            while size < offset:
+                data = f.read(min(HTTP_CHUNK_SIZE, offset - size))
+                if not data:
+                    break
+                for _, h in hashes:
+                    h.update(data)
+                size += len(data)
+
+            while True:
+                data = response.read(HTTP_CHUNK_SIZE)
+                if not data:
+                    break
+                f.write(data)
+                for _, h in hashes:
+                    h.update(data)
+                size += len(data)
+                progress(len(data), size, total)
+        finally:
+            # Another process may be waiting to look at the file
+            f.flush()
+
+        if total is not None and size < total:
+            raise http.client.IncompleteRead(b"", total - size)
+        return {checksum_id: h.hexdigest() for checksum_id, h in hashes}
+
     def checkstatus(self, fetch, ud, d, try_again=True):
         class HTTPConnectionCache(http.client.HTTPConnection):
             if fetch.connection_cache:
@@ -0,0 +1,162 @@
+"""
+BitBake inotify based file watcher
+
+Keeps track of changes to the files the base configuration and the recipe
+parse cache depend on, so a memory resident server can tell which files
+changed between commands without stat'ing every one of them.
+"""
+
+# Copyright BitBake Contributors
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+
+import logging
+import os
+
+import pyinotify
+
+logger = logging.getLogger("BitBake.FileWatch")
+
+class FileWatcher(object):
+    mask = (pyinotify.IN_MODIFY | pyinotify.IN_ATTRIB | pyinotify.IN_CLOSE_WRITE |
+            pyinotify.IN_CREATE | pyinotify.IN_DELETE | pyinotify.IN_DELETE_SELF |
+            pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO | pyinotify.IN_MOVE_SELF)
+
+    class EventHandler(pyinotify.ProcessEvent):
+        def my_init(self, watcher):
+            self.watcher = watcher
+
+        def process_IN_Q_OVERFLOW(self, event):
+            logger.debug("inotify event queue overflowed")
+            self.watcher.valid = False
+
+        def process_default(self, event):
+            self.watcher.mark_dirty(event.pathname)
+
+    def __init__(self):
+        self.wm = pyinotify.WatchManager()
+        self.notifier = pyinotify.Notifier(self.wm, self.EventHandler(watcher=self), timeout=0)
+        # Files (and directories) whose state is known through a watch on
+        # their parent directory (and on themselves for directories), along
+        # with the sequence number they were first watched at
+        self.files = {}
+        self.dirs = set()
+        # Event sequence number of the last change to each path
+        self.seq = 0
+        self.dirty = {}
+        # Event sequence number each recipe was last validated at, for the
+        # configuration hash in data_hash
+        self.validated = {}
+        self.data_hash = None
+        # Event sequence number at the last changed_files() call
+        self.checked_seq = 0
+        # False when events may have been lost due to a queue overflow so
+        # nothing can be trusted until everything is checked again
+        self.valid = True
+
+    def watch_dir(self, path):
+        if path in self.dirs:
+            return True
+        wd = self.wm.add_watch(path, self.mask, quiet=True).get(path, -1)
+        if wd < 0:
+            return False
+        self.dirs.add(path)
+        return True
+
+    def add(self, paths):
+        for f in paths:
+            if f in self.files:
+                continue
+
+            # Watch the closest existing parent so creation of the file (or
+            # of any missing directories leading to it) is noticed
+            d = os.path.dirname(f)
+            while not os.path.isdir(d) and d != os.path.dirname(d):
+                d = os.path.dirname(d)
+
+            if not self.watch_dir(d) or (os.path.isdir(f) and not self.watch_dir(f)):
+                # Probably out of watches, the file stays unknown and so is
+                # always treated as changed
+                logger.debug("Unable to watch %s", f)
+            else:
+                # Changes between a caller checking f and the watch being set
+                # up would be missed, so f only becomes trustworthy for
+                # validations after this point
+                self.seq += 1
+                self.files[f] = self.seq
+
+    def mark_dirty(self, path):
+        self.seq += 1
+        self.dirty[path] = self.seq
+        # Files being created or removed change the directory too
+        parent = os.path.dirname(path)
+        if parent in self.files:
+            self.dirty[parent] = self.seq
+
+    def update(self):
+        """Process pending inotify events, returns the current sequence number"""
+        while self.notifier.check_events(timeout=0):
+            self.notifier.read_events()
+            self.notifier.process_events()
+        return self.seq
+
+    def changed(self, f, since):
+        """
+        Has f (or a directory leading to it) changed after event sequence
+        number since? Files which weren't watched yet at that point count as
+        changed since their state is unknown.
+        """
+        if not self.valid or self.files.get(f, since + 1) > since:
+            return True
+        while True:
+            if self.dirty.get(f, 0) > since:
+                return True
+            parent = os.path.dirname(f)
+            if parent == f:
+                return False
+            f = parent
+
+    def changed_files(self, files):
+        """
+        Return the files which may have changed since the previous call and
+        so need their mtimes checking
+        """
+        seq = self.update()
+        if self.valid:
+            changed = [f for f in files if self.changed(f, self.checked_seq)]
+        else:
+            # Events were lost, everything needs checking and no earlier
+            # recipe validation can be trusted
+            changed = list(files)
+            self.valid = True
+            self.validated = {}
+        self.checked_seq = seq
+        return changed
+
+    def start_validation(self, data_hash):
+        """
+        Called before recipe cache validation, returns the sequence number
+        to pass to validated_recipe()
+        """
+        if data_hash != self.data_hash:
+            self.validated = {}
+            self.data_hash = data_hash
+        return self.update()
+
+    def unchanged(self, key, paths, data_hash):
+        """
+        Can the cached state of the recipe key, validated earlier for
+        data_hash, still be trusted given it depends on paths?
+        """
+        if not self.valid or data_hash != self.data_hash or key not in self.validated:
+            return False
+        since = self.validated[key]
+        return not any(self.changed(f, since) for f in paths)
+
+    def validated_recipe(self, key, paths, seq):
+        self.add(paths)
+        self.validated[key] = seq
+
+    def close(self):
+        self.notifier.stop()
@@ -9,6 +9,7 @@ Handles preparation and execution of a queue of tasks
 # SPDX-License-Identifier: GPL-2.0-only
 #
 
+import collections
 import copy
 import os
 import sys
@@ -19,6 +20,8 @@ import re
 import bb
 from bb import msg, event
 from bb import monitordisk
+from bb import workerproto
+from bb import taskstats
 import subprocess
 import pickle
 from multiprocessing import Process
@@ -162,6 +165,52 @@ class RunQueueScheduler(object):
         self.rev_prio_map = None
         self.is_pressure_usable()
 
+        self.history = None
+        self.memory = {}
+        if self.rq.memory_budget:
+            self.history = self.open_history()
+            self.memory = self.estimate_memory()
+
+    def open_history(self):
+        """
+        Return the TaskStats holding measurements of previous builds
+        """
+        if self.rq.cooker.configuration.dry_run or self.rqdata.setscene_enforce:
+            return None
+        filename = taskstats.taskstats_file(self.rq.cfgData)
+        if not filename:
+            return None
+        return taskstats.TaskStats(filename)
+
+    def history_key(self, tid):
+        (mc, fn, taskname, taskfn) = split_tid_mcfn(tid)
+        return "%s:%s" % (self.rqdata.dataCaches[mc].pkg_fn[taskfn], taskname)
+
+    def estimate_memory(self):
+        """
+        Return a dict of tid to the predicted peak memory use in kB of each
+        task, from the task's memory flag or else the peak recorded by
+        previous builds
+        """
+        flagged = {}
+        recorded = self.history.values("maxrss") if self.history else {}
+        known = {}
+        for tid in self.rqdata.runtaskentries:
+            (mc, fn, taskname, taskfn) = split_tid_mcfn(tid)
+            taskdep = self.rqdata.dataCaches[mc].task_deps[taskfn]
+            if 'memory' in taskdep and taskname in taskdep['memory']:
+                value = monitordisk.convertGMK(taskdep['memory'][taskname])
+                if value is not None:
+                    flagged[tid] = value // 1024
+                    continue
+                bb.warn("Ignoring invalid memory flag '%s' of %s" % (taskdep['memory'][taskname], tid))
+            key = self.history_key(tid)
+            if key in recorded:
+                known[tid] = recorded[key]
+        estimate = taskstats.estimate_missing(known, self.rqdata.runtaskentries, taskname_from_tid, default=0)
+        estimate.update(flagged)
+        return estimate
+
     def is_pressure_usable(self):
         """
         If monitoring pressure, return True if pressure files can be open and read. For example
@@ -252,7 +301,14 @@ class RunQueueScheduler(object):
 
         # Filter out tasks that have a max number of threads that have been exceeded
         skip_buildable = {}
+        memory_left = None
+        if self.memory and self.rq.stats.active:
+            memory_left = self.rq.memory_budget
+            # Failed tasks are never complete but no longer use any memory
+            failed = set(self.rq.failed_tids)
         for running in self.rq.runq_running.difference(self.rq.runq_complete):
+            if memory_left is not None and running not in failed:
+                memory_left -= self.memory.get(running, 0)
             rtaskname = taskname_from_tid(running)
             if rtaskname not in self.skip_maxthread:
                 self.skip_maxthread[rtaskname] = self.rq.cfgData.getVarFlag(rtaskname, "number_threads")
@@ -268,6 +324,8 @@ class RunQueueScheduler(object):
             taskname = taskname_from_tid(tid)
             if taskname in skip_buildable and skip_buildable[taskname] >= int(self.skip_maxthread[taskname]):
                 return None
+            if memory_left is not None and self.memory.get(tid, 0) > memory_left:
+                return None
             stamp = self.stamps[tid]
             if stamp not in self.rq.build_stamps.values():
                 return tid
@@ -285,6 +343,8 @@ class RunQueueScheduler(object):
                 taskname = taskname_from_tid(tid)
                 if taskname in skip_buildable and skip_buildable[taskname] >= int(self.skip_maxthread[taskname]):
                     continue
+                if memory_left is not None and self.memory.get(tid, 0) > memory_left:
+                    continue
                 stamp = self.stamps[tid]
                 if stamp in self.rq.build_stamps.values():
                     continue
@@ -306,6 +366,27 @@ class RunQueueScheduler(object):
     def removebuildable(self, task):
         self.buildable.remove(task)
 
+    def task_started(self, task):
+        """
+        Called when task has been sent to a worker to execute
+        """
+        return
+
+    def task_completed(self, task, peakrss=None):
+        """
+        Called when an executed task has completed successfully, with the
+        peak memory use of the task in kB if the worker measured it
+        """
+        if self.history is not None and peakrss:
+            self.history.record(self.history_key(task), "maxrss", peakrss)
+
+    def build_finished(self):
+        """
+        Called once the runqueue has finished executing
+        """
+        if self.history is not None:
+            self.history.save()
+
     def describe_task(self, taskid):
         result = 'ID %s' % taskid
         if self.rev_prio_map:
@@ -442,6 +523,79 @@ class RunQueueSchedulerCompletion(RunQueueSchedulerSpeed):
                     task_index += 1
         self.dump_prio('completion priorities')
 
+class RunQueueSchedulerCritical(RunQueueScheduler):
+    """
+    A scheduler which runs the tasks on the longest remaining chain of work
+    first. Each task is given its expected duration, from the durations
+    recorded by previous builds using this scheduler, or from the buildstats
+    listed in BB_SCHEDULER_BUILDSTATS, or else the median of the known
+    durations of the same task in other recipes. The priority map is sorted
+    by the expected duration of the longest path from each task to the end
+    of the build.
+    """
+    name = "critical"
+
+    def __init__(self, runqueue, rqdata):
+        super(RunQueueSchedulerCritical, self).__init__(runqueue, rqdata)
+
+        self.starttimes = {}
+        if self.history is None:
+            self.history = self.open_history()
+
+        graph = self.rqdata.taskgraph or TaskGraph(self.rqdata.runtaskentries)
+        expected = taskstats.estimate_missing(self.known_durations(), graph.tids, taskname_from_tid)
+        lengths = graph.critical_path([expected[tid] for tid in graph.tids])
+        self.pathlength = dict(zip(graph.tids, lengths))
+
+        # Break ties by the number of dependent tasks
+        runtaskentries = self.rqdata.runtaskentries
+        self.prio_map = sorted(graph.tids, key=lambda tid: (-self.pathlength[tid], -runtaskentries[tid].weight))
+        self.rev_prio_map = dict((tid, prio) for prio, tid in enumerate(self.prio_map))
+        self.dump_prio('critical path priorities')
+
+    def known_durations(self):
+        """
+        Return a dict of tid to expected duration in seconds for the tasks
+        which have a recorded duration
+        """
+        buildstats = {}
+        for path in (self.rq.cfgData.getVar("BB_SCHEDULER_BUILDSTATS") or "").split():
+            try:
+                buildstats.update(taskstats.read_buildstats(path))
+            except OSError as e:
+                bb.warn("Unable to read buildstats from %s: %s" % (path, e))
+
+        recorded = self.history.values("duration") if self.history else {}
+
+        durations = {}
+        for tid in self.rqdata.runtaskentries:
+            key = self.history_key(tid)
+            if key in recorded:
+                durations[tid] = recorded[key]
+                continue
+            if not buildstats:
+                continue
+            (mc, fn, taskname, taskfn) = split_tid_mcfn(tid)
+            pn = self.rqdata.dataCaches[mc].pkg_fn[taskfn]
+            (pe, pv, pr) = self.rqdata.dataCaches[mc].pkg_pepvpr[taskfn]
+            pf = "%s-%s%s-%s" % (pn, pe + "_" if pe else "", pv, pr)
+            if taskname in buildstats.get(pf, {}):
+                durations[tid] = buildstats[pf][taskname]
+        logger.debug("Critical path scheduler has durations for %s of %s tasks", len(durations), len(self.rqdata.runtaskentries))
+        return durations
+
+    def task_started(self, task):
+        self.starttimes[task] = time.monotonic()
+
+    def task_completed(self, task, peakrss=None):
+        super(RunQueueSchedulerCritical, self).task_completed(task, peakrss)
+        if self.history is not None and task in self.starttimes:
+            self.history.record(self.history_key(task), "duration", time.monotonic() - self.starttimes.pop(task))
+
+    def describe_task(self, taskid):
+        result = super(RunQueueSchedulerCritical, self).describe_task(taskid)
+        return result + (' path %.1fs' % self.pathlength[taskid])
+
 class RunTaskEntry(object):
     def __init__(self):
         self.depends = set()
@@ -451,6 +605,77 @@ class RunTaskEntry(object):
         self.task = None
         self.weight = 1
 
+class TaskGraph(object):
+    """
+    Compact, integer indexed form of the dependency graph in runtaskentries
+    used for the whole graph walks during runqueue preparation. Task i has
+    the tid tids[i] and index maps tids back to their task number. depends[i]
+    and revdeps[i] are lists of task numbers. It is a snapshot, runtaskentries
+    remains the string based view of the graph used everywhere else.
+    """
+    def __init__(self, runtaskentries):
+        self.tids = list(runtaskentries)
+        self.index = dict((tid, i) for i, tid in enumerate(self.tids))
+
+        index = self.index
+        self.depends = [[index[dep] for dep in runtaskentries[tid].depends] for tid in self.tids]
+        self.revdeps = [[] for tid in self.tids]
+        for i, depends in enumerate(self.depends):
+            for dep in depends:
+                self.revdeps[dep].append(i)
+
+    def __len__(self):
+        return len(self.tids)
+
+    def levels(self):
+        """
+        Yield lists of task numbers such that the dependencies of each task
+        are all in earlier lists, starting with the tasks which have no
+        dependencies. Tasks in or depending on circular dependencies are never
+        returned.
+        """
+        deps_left = [len(depends) for depends in self.depends]
+        ready = [i for i, left in enumerate(deps_left) if not left]
+        while ready:
+            yield ready
+            next_ready = []
+            for i in ready:
+                for revdep in self.revdeps[i]:
+                    deps_left[revdep] -= 1
+                    if not deps_left[revdep]:
+                        next_ready.append(revdep)
+            ready = next_ready
+
+    def critical_path(self, durations):
+        """
+        Given the duration of each task number, return a list of the total
+        duration of the longest chain of tasks starting with each task and
+        following its reverse dependencies
+        """
+        lengths = [0.0] * len(self)
+        for level in reversed(list(self.levels())):
+            for i in level:
+                longest = 0.0
+                for revdep in self.revdeps[i]:
+                    if lengths[revdep] > longest:
+                        longest = lengths[revdep]
+                lengths[i] = durations[i] + longest
+        return lengths
+
+def iter_bits(mask):
+    """
+    Yield the positions of the bits set in the integer bitmask mask
+    """
+    if not mask:
+        return
+    # Skip the clear low bits so sparse masks with high bits set stay cheap
+    offset = (mask & -mask).bit_length() - 1
+    bits = bin(mask >> offset)[:1:-1]
+    i = 0
+    while i != -1:
+        yield offset + i
+        i = bits.find("1", i + 1)
+
 class RunQueueData:
     """
     BitBake Run Queue implementation
@@ -473,6 +698,7 @@ class RunQueueData:
 
     def reset(self):
         self.runtaskentries = {}
+        self.taskgraph = None
 
     def runq_depends_names(self, ids):
         import re
@@ -600,41 +826,35 @@ class RunQueueData:
         possible to execute due to circular dependencies.
         """
 
-        numTasks = len(self.runtaskentries)
-        weight = {}
-        deps_left = {}
-        task_done = {}
+        graph = self.taskgraph
+        weight = [1] * len(graph)
+        deps_left = [len(revdeps) for revdeps in graph.revdeps]
+        task_done = [False] * len(graph)
 
-        for tid in self.runtaskentries:
-            task_done[tid] = False
-            weight[tid] = 1
-            deps_left[tid] = len(self.runtaskentries[tid].revdeps)
+        endpoints = [graph.index[tid] for tid in endpoints]
+        for i in endpoints:
+            weight[i] = 10
+            task_done[i] = True
 
-        for tid in endpoints:
-            weight[tid] = 10
-            task_done[tid] = True
-
-        while True:
+        while endpoints:
             next_points = []
-            for tid in endpoints:
-                for revdep in self.runtaskentries[tid].depends:
-                    weight[revdep] = weight[revdep] + weight[tid]
-                    deps_left[revdep] = deps_left[revdep] - 1
-                    if deps_left[revdep] == 0:
-                        next_points.append(revdep)
-                        task_done[revdep] = True
+            for i in endpoints:
+                for dep in graph.depends[i]:
+                    weight[dep] += weight[i]
+                    deps_left[dep] -= 1
+                    if deps_left[dep] == 0:
+                        next_points.append(dep)
+                        task_done[dep] = True
             endpoints = next_points
-            if not next_points:
-                break
 
         # Circular dependency sanity check
         problem_tasks = []
-        for tid in self.runtaskentries:
-            if task_done[tid] is False or deps_left[tid] != 0:
+        for i, tid in enumerate(graph.tids):
+            if task_done[i] is False or deps_left[i] != 0:
                 problem_tasks.append(tid)
                 logger.debug2("Task %s is not buildable", tid)
-                logger.debug2("(Complete marker was %s and the remaining dependency count was %s)\n", task_done[tid], deps_left[tid])
-            self.runtaskentries[tid].weight = weight[tid]
+                logger.debug2("(Complete marker was %s and the remaining dependency count was %s)\n", task_done[i], deps_left[i])
+            self.runtaskentries[tid].weight = weight[i]
 
         if problem_tasks:
             message = "%s unbuildable tasks were found.\n" % len(problem_tasks)
@@ -649,7 +869,7 @@ class RunQueueData:
                 message = message + msg
             bb.msg.fatal("RunQueue", message)
 
-        return weight
+        return dict(zip(graph.tids, weight))
 
     def prepare(self):
         """
@@ -836,43 +1056,29 @@ class RunQueueData:
 
         # Generating/interating recursive lists of dependencies is painful and potentially slow
         # Precompute recursive task dependencies here by:
-        #     a) create a temp list of reverse dependencies (revdeps)
+        #     a) create an integer indexed copy of the task graph including reverse dependencies
         #     b) walk up the ends of the chains (when a given task no longer has dependencies i.e. len(deps) == 0)
         #     c) combine the total list of dependencies in cumulativedeps
-        #     d) optimise by pre-truncating 'task' off the items in cumulativedeps (keeps items in sets lower)
-
-
-        revdeps = {}
-        deps = {}
-        cumulativedeps = {}
-        for tid in self.runtaskentries:
-            deps[tid] = set(self.runtaskentries[tid].depends)
-            revdeps[tid] = set()
-            cumulativedeps[tid] = set()
-        # Generate a temp list of reverse dependencies
-        for tid in self.runtaskentries:
-            for dep in self.runtaskentries[tid].depends:
-                revdeps[dep].add(tid)
-        # Find the dependency chain endpoints
-        endpoints = set()
-        for tid in self.runtaskentries:
-            if not deps[tid]:
-                endpoints.add(tid)
+        #     d) optimise by pre-truncating 'task' off the items in cumulativedeps and storing them as
+        #        bitmasks of recipe numbers (keeps them small and the unions cheap)
+
+        graph = TaskGraph(self.runtaskentries)
+        fns = []
+        fnindex = {}
+        fnbits = []
+        for tid in graph.tids:
+            fn = fn_from_tid(tid)
+            if fn not in fnindex:
+                fnindex[fn] = len(fns)
+                fns.append(fn)
+            fnbits.append(1 << fnindex[fn])
         # Iterate the chains collating dependencies
-        while endpoints:
-            next = set()
-            for tid in endpoints:
-                for dep in revdeps[tid]:
-                    cumulativedeps[dep].add(fn_from_tid(tid))
-                    cumulativedeps[dep].update(cumulativedeps[tid])
-                    if tid in deps[dep]:
-                        deps[dep].remove(tid)
-                    if not deps[dep]:
-                        next.add(dep)
-            endpoints = next
-        #for tid in deps:
-        #    if deps[tid]:
-        #        bb.warn("Sanity test failure, dependencies left for %s (%s)" % (tid, deps[tid]))
+        cumulativedeps = [0] * len(graph)
+        for level in graph.levels():
+            for i in level:
+                mask = cumulativedeps[i] | fnbits[i]
+                for revdep in graph.revdeps[i]:
+                    cumulativedeps[revdep] |= mask
 
         # Loop here since recrdeptasks can depend upon other recrdeptasks and we have to
         # resolve these recursively until we aren't adding any further extra dependencies
@@ -890,12 +1096,13 @@ class RunQueueData:
                             continue
                         totaldeps.update(self.runtaskentries[dep].depends)
 
-                deps = set()
+                deps = 0
                 for dep in totaldeps:
-                    if dep in cumulativedeps:
-                        deps.update(cumulativedeps[dep])
+                    if dep in graph.index:
+                        deps |= cumulativedeps[graph.index[dep]]
 
-                for t in deps:
+                for t in iter_bits(deps):
+                    t = fns[t]
                     for taskname in tasknames:
                         newtid = t + ":" + taskname
                         if newtid == tid:
@@ -1096,9 +1303,9 @@ class RunQueueData:
         bb.event.check_for_interrupts(self.cooker.data)
 
         # Generate a list of reverse dependencies to ease future calculations
-        for tid in self.runtaskentries:
-            for dep in self.runtaskentries[tid].depends:
-                self.runtaskentries[dep].revdeps.add(tid)
+        self.taskgraph = graph = TaskGraph(self.runtaskentries)
+        for i, tid in enumerate(graph.tids):
+            self.runtaskentries[tid].revdeps = set(graph.tids[revdep] for revdep in graph.revdeps[i])
 
         self.init_progress_reporter.next_stage()
         bb.event.check_for_interrupts(self.cooker.data)
@@ -1106,13 +1313,13 @@ class RunQueueData:
         # Identify tasks at the end of dependency chains
         # Error on circular dependency loops (length two)
         endpoints = []
-        for tid in self.runtaskentries:
-            revdeps = self.runtaskentries[tid].revdeps
+        for i, tid in enumerate(graph.tids):
+            revdeps = graph.revdeps[i]
             if not revdeps:
                 endpoints.append(tid)
-            for dep in revdeps:
-                if dep in self.runtaskentries[tid].depends:
-                    bb.msg.fatal("RunQueue", "Task %s has circular dependency on %s" % (tid, dep))
+            elif graph.depends[i]:
+                for dep in set(graph.depends[i]).intersection(revdeps):
+                    bb.msg.fatal("RunQueue", "Task %s has circular dependency on %s" % (tid, graph.tids[dep]))
 
 
         logger.verbose("Compute totals (have %s endpoint(s))", len(endpoints))
@@ -1273,41 +1480,66 @@ class RunQueueData:
 
         bb.parse.siggen.set_setscene_tasks(self.runq_setscene_tids)
 
+        self.compute_task_hashes()
+
+        bb.parse.siggen.writeout_file_checksum_cache()
+
+        #self.dump_data()
+        return len(self.runtaskentries)
+
+    def compute_task_hashes(self):
+        """
+        Set the hash and unihash of every task in runtaskentries
+        """
+        graph = self.taskgraph
+
         starttime = time.time()
         lasttime = starttime
 
-        # Iterate over the task list and call into the siggen code
-        dealtwith = set()
-        todeal = set(self.runtaskentries)
+        # Iterate over the task list and call into the siggen code. A task's hash
+        # depends on the unihashes of its dependencies so it is computed once
+        # they are all known. The unihash lookups are queued as soon as the
+        # taskhashes are final so the hash equivalence server round trips overlap
+        # with computing the hashes of the rest of the graph.
+        todeal = len(graph)
+        deps_left = [len(depends) for depends in graph.depends]
+        ready = collections.deque(i for i, left in enumerate(deps_left) if not left)
         while todeal:
-            ready = set()
-            for tid in todeal.copy():
-                if not (self.runtaskentries[tid].depends - dealtwith):
+            if ready:
+                # Handing over to the lookup thread for every task costs more than it saves
+                tids = []
+                while ready and len(tids) < 16:
+                    tid = graph.tids[ready.popleft()]
                     self.runtaskentries[tid].taskhash_deps = bb.parse.siggen.prep_taskhash(tid, self.runtaskentries[tid].depends, self.dataCaches)
                     # get_taskhash for a given tid *must* be called before get_unihash* below
                     self.runtaskentries[tid].hash = bb.parse.siggen.get_taskhash(tid, self.runtaskentries[tid].depends, self.dataCaches)
-                    ready.add(tid)
-            unihashes = bb.parse.siggen.get_unihashes(ready)
-            for tid in ready:
-                dealtwith.add(tid)
-                todeal.remove(tid)
-                self.runtaskentries[tid].unihash = unihashes[tid]
+                    tids.append(tid)
+                unihashes = bb.parse.siggen.queue_unihashes(tids)
+                unihashes.update(bb.parse.siggen.collect_unihashes(wait=False))
+            else:
+                unihashes = bb.parse.siggen.collect_unihashes()
+                if not unihashes:
+                    # Only tasks in dependency loops are left, which are rejected earlier
+                    break
+
+            for tid, unihash in unihashes.items():
+                self.runtaskentries[tid].unihash = unihash
+                for revdep in graph.revdeps[graph.index[tid]]:
+                    deps_left[revdep] -= 1
+                    if not deps_left[revdep]:
+                        ready.append(revdep)
+            todeal -= len(unihashes)
 
             bb.event.check_for_interrupts(self.cooker.data)
 
             if time.time() > (lasttime + 30):
                 lasttime = time.time()
-                hashequiv_logger.verbose("Initial setup loop progress: %s of %s in %s" % (len(todeal), len(self.runtaskentries), lasttime - starttime))
+                hashequiv_logger.verbose("Initial setup loop progress: %s of %s in %s" % (todeal, len(self.runtaskentries), lasttime - starttime))
 
         endtime = time.time()
         if (endtime-starttime > 60):
             hashequiv_logger.verbose("Initial setup loop took: %s" % (endtime-starttime))
 
-        bb.parse.siggen.writeout_file_checksum_cache()
-
-        #self.dump_data()
-        return len(self.runtaskentries)
-
     def dump_data(self):
         """
         Dump some debug information on the internal data structures
@@ -1350,14 +1582,8 @@ class RunQueue:
         self.fakeworker = {}
 
     @staticmethod
-    def send_pickled_data(worker, data, name):
-        msg = bytearray()
-        msg.extend(b"<" + name.encode() + b">")
-        pickled_data = pickle.dumps(data)
-        msg.extend(len(pickled_data).to_bytes(4, 'big'))
-        msg.extend(pickled_data)
-        msg.extend(b"</" + name.encode() + b">")
-        worker.stdin.write(msg)
+    def send_pickled_data(worker, data, name, compress=False):
+        worker.stdin.write(workerproto.encode_pickled(name, data, compress))
 
     def _start_worker(self, mc, fakeroot = False, rqexec = None):
         logger.debug("Starting bitbake-worker")
@@ -1627,6 +1853,8 @@ class RunQueue:
 
         if build_done and self.rqexe:
             bb.parse.siggen.save_unitaskhashes()
+            bb.parse.siggen.build_finished()
+            self.rqexe.sched.build_finished()
             self.teardown_workers()
             if self.rqexe:
                 if self.rqexe.stats.failed:
@@ -1847,6 +2075,7 @@ class RunQueueExecute:
         self.max_io_pressure = self.cfgData.getVar("BB_PRESSURE_MAX_IO")
         self.max_memory_pressure = self.cfgData.getVar("BB_PRESSURE_MAX_MEMORY")
         self.max_loadfactor = self.cfgData.getVar("BB_LOADFACTOR_MAX")
+        self.memory_budget = self.cfgData.getVar("BB_MEMORY_BUDGET")
 
         self.sq_buildable = set()
         self.sq_running = set()
@@ -1905,6 +2134,13 @@ class RunQueueExecute:
             self.max_loadfactor = float(self.max_loadfactor)
             if self.max_loadfactor <= 0:
                 bb.fatal("Invalid BB_LOADFACTOR_MAX %s, needs to be greater than zero." % (self.max_loadfactor))
+
+        if self.memory_budget:
+            budget = monitordisk.convertGMK(self.memory_budget)
+            if not budget:
+                bb.fatal("Invalid BB_MEMORY_BUDGET %s, needs to be a size such as 64G." % (self.memory_budget))
+            # In kB, as the memory use of tasks is measured
+            self.memory_budget = budget // 1024
             
         # List of setscene tasks which we've covered
         self.scenequeue_covered = set()
@@ -1929,6 +2165,11 @@ class RunQueueExecute:
         self.sqdata = SQData()
         build_scenequeue_data(self.sqdata, self.rqdata, self)
 
+        # Tasks covered by the covered, notcovered and not yet processed setscene tasks
+        self.covered_union = SQCoverage(self.sqdata, self.rqdata.taskgraph)
+        self.notcovered_union = SQCoverage(self.sqdata, self.rqdata.taskgraph)
+        self.holdoff_union = SQCoverage(self.sqdata, self.rqdata.taskgraph)
+
         update_scenequeue_data(self.sqdata.sq_revdeps, self.sqdata, self.rqdata, self.rq, self.cooker, self.stampcache, self, summary=True)
 
         # Compute a list of 'stale' sstate tasks where the current hash does not match the one
@@ -1947,7 +2188,7 @@ class RunQueueExecute:
 
         self.build_taskdepdata_cache()
 
-    def runqueue_process_waitpid(self, task, status, fakerootlog=None):
+    def runqueue_process_waitpid(self, task, status, fakerootlog=None, peakrss=None):
 
         # self.build_stamps[pid] may not exist when use shared work directory.
         if task in self.build_stamps:
@@ -1965,7 +2206,7 @@ class RunQueueExecute:
             if status != 0:
                 self.task_fail(task, status, fakerootlog=fakerootlog)
             else:
-                self.task_complete(task)
+                self.task_complete(task, peakrss=peakrss)
         return True
 
     def finish_now(self):
@@ -2091,9 +2332,10 @@ class RunQueueExecute:
                     bb.debug(1, "Deferring %s after %s" % (t, found))
                     self.sq_deferred[t] = found
 
-    def task_complete(self, task):
+    def task_complete(self, task, peakrss=None):
         self.stats.taskCompleted()
-        bb.event.fire(runQueueTaskCompleted(task, self.stats, self.rq), self.cfgData)
+        bb.event.fire(runQueueTaskCompleted(task, self.stats, self.rq, peakrss=peakrss), self.cfgData)
+        self.sched.task_completed(task, peakrss)
         self.task_completeoutright(task)
         self.runq_tasksrun.add(task)
 
@@ -2373,7 +2615,8 @@ class RunQueueExecute:
                 'quieterrors' : False,
                 'appends' : self.cooker.collections[mc].get_file_appends(taskfn),
                 'layername' : self.cooker.collections[mc].calc_bbfile_priority(realfn)[2],
-                'taskdepdata' : self.build_taskdepdata(task),
+                # The worker assembles this from its copy of the taskdepdata table
+                'taskdepdata' : None,
                 'dry_run' : self.rqdata.setscene_enforce,
                 'taskdep': taskdep,
                 'fakerootenv' : self.rqdata.dataCaches[mc].fakerootenv[taskfn],
@@ -2390,9 +2633,11 @@ class RunQueueExecute:
                         self.rq.state = runQueueFailed
                         self.stats.taskFailed()
                         return True
+                self.send_taskdepdata(self.rq.fakeworker[mc])
                 RunQueue.send_pickled_data(self.rq.fakeworker[mc].process, runtask, "runtask")
                 self.rq.fakeworker[mc].process.stdin.flush()
             else:
+                self.send_taskdepdata(self.rq.worker[mc])
                 RunQueue.send_pickled_data(self.rq.worker[mc].process, runtask, "runtask")
                 self.rq.worker[mc].process.stdin.flush()
 
@@ -2400,6 +2645,7 @@ class RunQueueExecute:
             self.build_stamps2.append(self.build_stamps[task])
             self.runq_running.add(task)
             self.stats.taskActive()
+            self.sched.task_started(task)
             if self.can_start_task():
                 return True
 
@@ -2447,7 +2693,9 @@ class RunQueueExecute:
             ret.add(dep)
         return ret
 
-    # Build the individual cache entries in advance once to save time
+    # Build the individual cache entries in advance once to save time. We filter
+    # out multiconfig dependencies from taskdepdata we pass to the tasks as most
+    # code can't handle them
     def build_taskdepdata_cache(self):
         taskdepdata_cache = {}
         for task in self.rqdata.runtaskentries:
@@ -2465,29 +2713,39 @@ class RunQueueExecute:
             )
 
         self.taskdepdata_cache = taskdepdata_cache
+        # Each worker is sent the whole table once and is then kept up to date
+        # by sending the entries changed since. taskdepdata_updates lists the
+        # changed tids in order and taskdepdata_sent holds how far along that
+        # list each worker is.
+        self.taskdepdata_updates = []
+        self.taskdepdata_sent = {}
+
+    def update_taskdepdata(self, tids):
+        """
+        Refresh the taskdepdata entries for tids after their unihashes changed
+        """
+        for tid in tids:
+            if tid not in self.taskdepdata_cache:
+                continue
+            self.taskdepdata_cache[tid] = self.taskdepdata_cache[tid]._replace(
+                unihash=self.rqdata.runtaskentries[tid].unihash
+            )
+            self.taskdepdata_updates.append(tid)
 
-    # We filter out multiconfig dependencies from taskdepdata we pass to the tasks
-    # as most code can't handle them
-    def build_taskdepdata(self, task):
-        taskdepdata = {}
-        mc = mc_from_tid(task)
-        next = self.rqdata.runtaskentries[task].depends.copy()
-        next.add(task)
-        next = self.filtermcdeps(task, mc, next)
-        while next:
-            additional = []
-            for revdep in next:
-                self.taskdepdata_cache[revdep] = self.taskdepdata_cache[revdep]._replace(
-                    unihash=self.rqdata.runtaskentries[revdep].unihash
-                )
-                taskdepdata[revdep] = self.taskdepdata_cache[revdep]
-                for revdep2 in self.taskdepdata_cache[revdep].deps:
-                    if revdep2 not in taskdepdata:
-                        additional.append(revdep2)
-            next = additional
-
-        #bb.note("Task %s: " % task + str(taskdepdata).replace("], ", "],\n"))
-        return taskdepdata
+    def send_taskdepdata(self, worker):
+        """
+        Bring the worker's copy of the taskdepdata table up to date
+        """
+        sent = self.taskdepdata_sent.get(worker.process)
+        if sent is None:
+            data = (True, self.taskdepdata_cache)
+        elif sent < len(self.taskdepdata_updates):
+            changed = set(self.taskdepdata_updates[sent:])
+            data = (False, dict((tid, self.taskdepdata_cache[tid]) for tid in changed))
+        else:
+            return
+        RunQueue.send_pickled_data(worker.process, data, "taskdepdata")
+        self.taskdepdata_sent[worker.process] = len(self.taskdepdata_updates)
 
     def update_holdofftasks(self):
 
@@ -2496,18 +2754,17 @@ class RunQueueExecute:
 
         notcovered = set(self.scenequeue_notcovered)
         notcovered |= self.sqdata.cantskip
-        for tid in self.scenequeue_notcovered:
-            notcovered |= self.sqdata.sq_covered_tasks[tid]
+        notcovered |= self.notcovered_union.update(self.scenequeue_notcovered)
         notcovered |= self.sqdata.unskippable.difference(self.rqdata.runq_setscene_tids)
         notcovered.intersection_update(self.tasks_scenequeue_done)
 
         covered = set(self.scenequeue_covered)
-        for tid in self.scenequeue_covered:
-            covered |= self.sqdata.sq_covered_tasks[tid]
+        covered |= self.covered_union.update(self.scenequeue_covered)
         covered.difference_update(notcovered)
         covered.intersection_update(self.tasks_scenequeue_done)
 
-        for tid in notcovered | covered:
+        # Tasks already buildable stay so, no need to check them again
+        for tid in (notcovered | covered).difference(self.runq_buildable):
             if not self.rqdata.runtaskentries[tid].depends:
                 self.setbuildable(tid)
             elif self.rqdata.runtaskentries[tid].depends.issubset(self.runq_complete):
@@ -2516,16 +2773,8 @@ class RunQueueExecute:
         self.tasks_covered = covered
         self.tasks_notcovered = notcovered
 
-        self.holdoff_tasks = set()
-
-        for tid in self.rqdata.runq_setscene_tids:
-            if tid not in self.scenequeue_covered and tid not in self.scenequeue_notcovered:
-                self.holdoff_tasks.add(tid)
-
-        for tid in self.holdoff_tasks.copy():
-            for dep in self.sqdata.sq_covered_tasks[tid]:
-                if dep not in self.runq_complete:
-                    self.holdoff_tasks.add(dep)
+        self.holdoff_tasks = self.rqdata.runq_setscene_tids.difference(self.scenequeue_covered, self.scenequeue_notcovered)
+        self.holdoff_tasks |= self.holdoff_union.update(self.holdoff_tasks).difference(self.runq_complete)
 
         self.holdoff_need_update = False
 
@@ -2550,6 +2799,7 @@ class RunQueueExecute:
                     self.rqdata.runtaskentries[hashtid].unihash = unihash
                     bb.parse.siggen.set_unihash(hashtid, unihash)
                     toprocess.add(hashtid)
+                self.update_taskdepdata(torehash)
                 if torehash:
                     # Need to save after set_unihash above
                     bb.parse.siggen.save_unitaskhashes()
@@ -2627,6 +2877,8 @@ class RunQueueExecute:
         if (endtime-starttime > 60):
             hashequiv_logger.verbose("Rehash loop took more than 60s: %s" % (endtime-starttime))
 
+        self.update_taskdepdata(changed)
+
         if changed:
             for mc in self.rq.worker:
                 RunQueue.send_pickled_data(self.rq.worker[mc].process, bb.parse.siggen.get_taskhashes(), "newtaskhashes")
@@ -2910,12 +3162,42 @@ class SQData(object):
         self.outrightfail = set()
         # A list of normal tasks a setscene task covers
         self.sq_covered_tasks = {}
+        # The same as task numbers in rqdata.taskgraph
+        self.sq_covered_ids = {}
 
-def build_scenequeue_data(sqdata, rqdata, sqrq):
+class SQCoverage(object):
+    """
+    The tasks covered by any of a set of setscene tasks which changes as the
+    build progresses. A count of the setscene tasks covering each task is kept
+    so an update only has to look at the setscene tasks added to or removed
+    from the set since the previous one.
+    """
+    def __init__(self, sqdata, graph):
+        self.covered_ids = sqdata.sq_covered_ids
+        self.tids = graph.tids
+        self.refs = [0] * len(graph)
+        self.setscene = set()
+        self.tasks = set()
+
+    def update(self, setscene):
+        """
+        Return the tasks covered by the setscene tasks in setscene
+        """
+        refs = self.refs
+        for tid in setscene.difference(self.setscene):
+            for i in self.covered_ids[tid]:
+                if not refs[i]:
+                    self.tasks.add(self.tids[i])
+                refs[i] += 1
+        for tid in self.setscene.difference(setscene):
+            for i in self.covered_ids[tid]:
+                refs[i] -= 1
+                if not refs[i]:
+                    self.tasks.remove(self.tids[i])
+        self.setscene = set(setscene)
+        return self.tasks
 
-    sq_revdeps = {}
-    sq_revdeps_squash = {}
-    sq_collated_deps = {}
+def build_scenequeue_data(sqdata, rqdata, sqrq):
 
     # We can't skip specified target tasks which aren't setscene tasks
     sqdata.cantskip = set(rqdata.target_tids)
@@ -2926,97 +3208,86 @@ def build_scenequeue_data(sqdata, rqdata, sqrq):
     # dependencies between the setscene tasks only complicate the code. This code
     # therefore aims to collapse the huge runqueue dependency tree into a smaller one
     # only containing the setscene functions.
+    #
+    # This is done over the task numbers of rqdata.taskgraph. Each setscene task is
+    # given a bit and reach[i] is the mask of the setscene tasks found first when
+    # following the reverse dependencies of task i, i.e. the setscene tasks which
+    # would replace task i.
 
     rqdata.init_progress_reporter.next_stage()
 
-    # First process the chains up to the first setscene task.
-    endpoints = {}
-    for tid in rqdata.runtaskentries:
-        sq_revdeps[tid] = copy.copy(rqdata.runtaskentries[tid].revdeps)
-        sq_revdeps_squash[tid] = set()
-        if not sq_revdeps[tid] and tid not in rqdata.runq_setscene_tids:
-            #bb.warn("Added endpoint %s" % (tid))
-            endpoints[tid] = set()
-
-    rqdata.init_progress_reporter.next_stage()
-
-    # Secondly process the chains between setscene tasks.
-    for tid in rqdata.runq_setscene_tids:
-        sq_collated_deps[tid] = set()
-        #bb.warn("Added endpoint 2 %s" % (tid))
-        for dep in rqdata.runtaskentries[tid].depends:
-                if tid in sq_revdeps[dep]:
-                    sq_revdeps[dep].remove(tid)
-                if dep not in endpoints:
-                    endpoints[dep] = set()
-                #bb.warn("  Added endpoint 3 %s" % (dep))
-                endpoints[dep].add(tid)
+    graph = rqdata.taskgraph
+    setscene = bytearray(len(graph))
+    sqtids = []
+    sqbit = {}
+    for i, tid in enumerate(graph.tids):
+        if tid in rqdata.runq_setscene_tids:
+            setscene[i] = 1
+            sqbit[i] = len(sqtids)
+            sqtids.append(tid)
 
     rqdata.init_progress_reporter.next_stage()
 
-    def process_endpoints(endpoints):
-        newendpoints = {}
-        for point, task in endpoints.items():
-            tasks = set()
-            if task:
-                tasks |= task
-            if sq_revdeps_squash[point]:
-                tasks |= sq_revdeps_squash[point]
-            if point not in rqdata.runq_setscene_tids:
-                for t in tasks:
-                    sq_collated_deps[t].add(point)
-            sq_revdeps_squash[point] = set()
-            if point in rqdata.runq_setscene_tids:
-                sq_revdeps_squash[point] = tasks
-                continue
-            for dep in rqdata.runtaskentries[point].depends:
-                if point in sq_revdeps[dep]:
-                    sq_revdeps[dep].remove(point)
-                if tasks:
-                    sq_revdeps_squash[dep] |= tasks
-                if not sq_revdeps[dep] and dep not in rqdata.runq_setscene_tids:
-                    newendpoints[dep] = task
-        if newendpoints:
-            process_endpoints(newendpoints)
-
-    process_endpoints(endpoints)
+    # Walk from the end of the chains so the reverse dependencies of a task are
+    # processed before it, dropping each mask once all its dependencies have used it
+    reach = [0] * len(graph)
+    deps_left = [len(depends) for depends in graph.depends]
+    covered = [[] for tid in sqtids]
+    squashed = [None] * len(sqtids)
+    processed = 0
+    for level in reversed(list(graph.levels())):
+        for i in level:
+            mask = 0
+            for revdep in graph.revdeps[i]:
+                if setscene[revdep]:
+                    mask |= 1 << sqbit[revdep]
+                else:
+                    mask |= reach[revdep]
+                deps_left[revdep] -= 1
+                if not deps_left[revdep]:
+                    reach[revdep] = 0
+            if setscene[i]:
+                squashed[sqbit[i]] = set(sqtids[b] for b in iter_bits(mask))
+            else:
+                reach[i] = mask
+                for b in iter_bits(mask):
+                    covered[b].append(i)
+            processed += 1
 
     rqdata.init_progress_reporter.next_stage()
 
     # Build a list of tasks which are "unskippable"
     # These are direct endpoints referenced by the build upto and including setscene tasks
     # Take the build endpoints (no revdeps) and find the sstate tasks they depend upon
-    new = True
-    for tid in rqdata.runtaskentries:
-        if not rqdata.runtaskentries[tid].revdeps:
-            sqdata.unskippable.add(tid)
-    sqdata.unskippable |= sqdata.cantskip
-    while new:
-        new = False
-        orig = sqdata.unskippable.copy()
-        for tid in sorted(orig, reverse=True):
-            if tid in rqdata.runq_setscene_tids:
-                continue
-            if not rqdata.runtaskentries[tid].depends:
-                # These are tasks which have no setscene tasks in their chain, need to mark as directly buildable
-                sqrq.setbuildable(tid)
-            sqdata.unskippable |= rqdata.runtaskentries[tid].depends
-            if sqdata.unskippable != orig:
-                new = True
+    unskippable = bytearray(len(graph))
+    tovisit = [i for i, revdeps in enumerate(graph.revdeps) if not revdeps]
+    tovisit.extend(graph.index[tid] for tid in sqdata.cantskip)
+    while tovisit:
+        i = tovisit.pop()
+        if unskippable[i]:
+            continue
+        unskippable[i] = 1
+        if setscene[i]:
+            continue
+        if not graph.depends[i]:
+            # These are tasks which have no setscene tasks in their chain, need to mark as directly buildable
+            sqrq.setbuildable(graph.tids[i])
+        tovisit.extend(graph.depends[i])
+    sqdata.unskippable = set(tid for i, tid in enumerate(graph.tids) if unskippable[i])
 
     sqrq.tasks_scenequeue_done |= sqdata.unskippable.difference(rqdata.runq_setscene_tids)
 
-    rqdata.init_progress_reporter.next_stage(len(rqdata.runtaskentries))
+    rqdata.init_progress_reporter.next_stage()
 
     # Sanity check all dependencies could be changed to setscene task references
-    for taskcounter, tid in enumerate(rqdata.runtaskentries):
-        if tid in rqdata.runq_setscene_tids:
-            pass
-        elif sq_revdeps_squash[tid]:
-            bb.msg.fatal("RunQueue", "Something went badly wrong during scenequeue generation, halting. Please report this problem.")
-        else:
-            del sq_revdeps_squash[tid]
-        rqdata.init_progress_reporter.update(taskcounter)
+    if processed != len(graph):
+        bb.msg.fatal("RunQueue", "Something went badly wrong during scenequeue generation, halting. Please report this problem.")
+
+    sq_revdeps_squash = dict(zip(sqtids, squashed))
+    sqdata.sq_covered_ids = dict(zip(sqtids, covered))
+    sq_collated_deps = dict((tid, set(graph.tids[i] for i in covered[b])) for b, tid in enumerate(sqtids))
+
+    rqdata.init_progress_reporter.next_stage()
 
     rqdata.init_progress_reporter.next_stage()
 
@@ -3256,8 +3527,12 @@ class sceneQueueComplete(sceneQueueEvent):
 
 class runQueueTaskCompleted(runQueueEvent):
     """
-    Event notifying a task completed
+    Event notifying a task completed. peakrss is the peak memory use of the
+    task in kB when the worker measured it (BB_MEMORY_BUDGET is set).
     """
+    def __init__(self, task, stats, rq, peakrss=None):
+        runQueueEvent.__init__(self, task, stats, rq)
+        self.peakrss = peakrss
 
 class sceneQueueTaskCompleted(sceneQueueEvent):
     """
@@ -3290,7 +3565,7 @@ class runQueuePipe():
         if pipeout:
             pipeout.close()
         bb.utils.nonblockingfd(self.input)
-        self.queue = bytearray()
+        self.queue = workerproto.FrameReader()
         self.d = d
         self.rq = rq
         self.rqexec = rqexec
@@ -3304,54 +3579,38 @@ class runQueuePipe():
                     bb.error("%s process (%s) exited unexpectedly (%s), shutting down..." % (name, worker.process.pid, str(worker.process.returncode)))
                     self.rq.finish_runqueue(True)
 
-        start = len(self.queue)
+        data = b""
         try:
-            self.queue.extend(self.input.read(102400) or b"")
+            data = self.input.read(102400) or b""
         except (OSError, IOError) as e:
             if e.errno != errno.EAGAIN:
                 raise
-        end = len(self.queue)
-        found = True
-        while found and self.queue:
-            found = False
-            index = self.queue.find(b"</event>")
-            while index != -1 and self.queue.startswith(b"<event>"):
-                try:
-                    event = pickle.loads(self.queue[7:index])
-                except (ValueError, pickle.UnpicklingError, AttributeError, IndexError) as e:
-                    if isinstance(e, pickle.UnpicklingError) and "truncated" in str(e):
-                        # The pickled data could contain "</event>" so search for the next occurance
-                        # unpickling again, this should be the only way an unpickle error could occur
-                        index = self.queue.find(b"</event>", index + 1)
-                        continue
-                    bb.msg.fatal("RunQueue", "failed load pickle '%s': '%s'" % (e, self.queue[7:index]))
-                bb.event.fire_from_worker(event, self.d)
-                if isinstance(event, taskUniHashUpdate):
-                    self.rqexec.updated_taskhash_queue.append((event.taskid, event.unihash))
-                found = True
-                self.queue = self.queue[index+8:]
-                index = self.queue.find(b"</event>")
-            index = self.queue.find(b"</exitcode>")
-            while index != -1 and self.queue.startswith(b"<exitcode>"):
-                try:
-                    task, status = pickle.loads(self.queue[10:index])
-                except (ValueError, pickle.UnpicklingError, AttributeError, IndexError) as e:
-                    bb.msg.fatal("RunQueue", "failed load pickle '%s': '%s'" % (e, self.queue[10:index]))
+        self.queue.feed(data)
+        for name, payload in self.queue.frames():
+            try:
+                msg = pickle.loads(payload)
+            except (ValueError, pickle.UnpicklingError, AttributeError, IndexError) as e:
+                bb.msg.fatal("RunQueue", "failed load pickle '%s': '%s'" % (e, payload))
+            if name == "event":
+                bb.event.fire_from_worker(msg, self.d)
+                if isinstance(msg, taskUniHashUpdate):
+                    self.rqexec.updated_taskhash_queue.append((msg.taskid, msg.unihash))
+            elif name == "exitcode":
+                task, status, peakrss = msg
                 (_, _, _, taskfn) = split_tid_mcfn(task)
                 fakerootlog = None
                 if self.fakerootlogs and taskfn and taskfn in self.fakerootlogs:
                     fakerootlog = self.fakerootlogs[taskfn]
-                self.rqexec.runqueue_process_waitpid(task, status, fakerootlog=fakerootlog)
-                found = True
-                self.queue = self.queue[index+11:]
-                index = self.queue.find(b"</exitcode>")
-        return (end > start)
+                self.rqexec.runqueue_process_waitpid(task, status, fakerootlog=fakerootlog, peakrss=peakrss)
+            else:
+                bb.msg.fatal("RunQueue", "Unknown message '%s' from worker" % name)
+        return len(data) > 0
 
     def close(self):
         while self.read():
             continue
-        if self.queue:
-            print("Warning, worker left partial message: %s" % self.queue)
+        if len(self.queue):
+            print("Warning, worker left partial message: %s" % self.queue.buffer)
         self.input.close()
 
 def get_setscene_enforce_ignore_tasks(d, targets):
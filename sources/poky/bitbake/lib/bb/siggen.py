@@ -4,12 +4,16 @@
 # SPDX-License-Identifier: GPL-2.0-only
 #
 
+import asyncio
+import collections
 import hashlib
 import logging
 import os
 import re
 import tempfile
 import pickle
+import queue
+import threading
 import bb.data
 import difflib
 import simplediff
@@ -18,6 +22,7 @@ import types
 from contextlib import contextmanager
 import bb.compress.zstd
 from bb.checksum import FileChecksumCache
+import bb.unihashcache
 from bb import runqueue
 import hashserv
 import hashserv.client
@@ -123,6 +128,23 @@ class SignatureGenerator(object):
     def get_unihashes(self, tids):
         return {tid: self.get_unihash(tid) for tid in tids}
 
+    def queue_unihashes(self, tids):
+        """
+        Start looking up the unihashes of tids. Returns a dictionary mapping
+        the tids whose unihash is known straight away to it, the others are
+        returned by later calls to collect_unihashes()
+        """
+        return self.get_unihashes(tids)
+
+    def collect_unihashes(self, wait=True):
+        """
+        Return a dictionary mapping the tids of lookups started by
+        queue_unihashes() which have finished to their unihashes. If wait is
+        set and none have, waits for some to finish. Returns an empty
+        dictionary if no lookups are outstanding.
+        """
+        return {}
+
     def prep_taskhash(self, tid, deps, dataCaches):
         return
 
@@ -207,6 +229,9 @@ class SignatureGenerator(object):
     def set_setscene_tasks(self, setscene_tasks):
         return
 
+    def build_finished(self):
+        return
+
     def exit(self):
         return
 
@@ -544,6 +569,14 @@ class SignatureGeneratorUniHashMixIn(object):
         # hashes to appear over time, but much less likely for them to
         # disappear
         self.unihash_exists_cache = set()
+        # Lookups started by queue_unihashes() are made from a separate thread
+        self.unihash_query_thread = None
+        self.unihash_queries_pending = 0
+        # Answers from the server are also kept on disk if a size is set
+        self.unihash_disk_cache = None
+        self.unihash_disk_cache_file = bb.unihashcache.unihash_cache_file(data)
+        self.unihash_disk_cache_size = int(data.getVar("BB_HASHSERVE_CACHE_SIZE") or 0)
+        self.unihash_disk_cache_ttl = int(data.getVar("BB_HASHSERVE_CACHE_TTL") or 86400)
         self.username = None
         self.password = None
         self.env = {}
@@ -611,6 +644,10 @@ class SignatureGeneratorUniHashMixIn(object):
         return super().exit()
 
     def __close_clients(self):
+        self.__stop_query_thread()
+        if getattr(self, 'unihash_disk_cache', None) is not None:
+            self.unihash_disk_cache.close()
+            self.unihash_disk_cache = None
         with self._client_env():
             if getattr(self, '_client', None) is not None:
                 self._client.close()
@@ -674,6 +711,18 @@ class SignatureGeneratorUniHashMixIn(object):
 
         return method
 
+    def get_unihash_disk_cache(self):
+        """
+        Return the on disk cache of answers from the server, or None if it
+        isn't enabled
+        """
+        if not self.unihash_disk_cache_size or not self.unihash_disk_cache_file or not self.server:
+            return None
+        if self.unihash_disk_cache is None:
+            self.unihash_disk_cache = bb.unihashcache.UnihashCache(self.unihash_disk_cache_file, self.server,
+                                                                   self.unihash_disk_cache_size, self.unihash_disk_cache_ttl)
+        return self.unihash_disk_cache
+
     def unihashes_exist(self, query):
         if len(query) == 0:
             return {}
@@ -686,6 +735,14 @@ class SignatureGeneratorUniHashMixIn(object):
             else:
                 uncached_query[key] = unihash
 
+        unihash_disk_cache = self.get_unihash_disk_cache()
+        if unihash_disk_cache and uncached_query:
+            found = unihash_disk_cache.unihashes_exist(set(uncached_query.values()))
+            self.unihash_exists_cache |= found
+            for key in [k for k, unihash in uncached_query.items() if unihash in found]:
+                result[key] = True
+                del uncached_query[key]
+
         if self.max_parallel <= 1 or len(uncached_query) <= 1:
             # No parallelism required. Make the query serially with the single client
             with self.client() as client:
@@ -701,6 +758,9 @@ class SignatureGeneratorUniHashMixIn(object):
                 self.unihash_exists_cache.add(query[key])
             result[key] = exists
 
+        if unihash_disk_cache:
+            unihash_disk_cache.add_unihashes_exist(set(query[key] for key, exists in uncached_result.items() if exists))
+
         return result
 
     def get_unihash(self, tid):
@@ -722,11 +782,38 @@ class SignatureGeneratorUniHashMixIn(object):
             else:
                 queries[tid] = (self._get_method(tid), self.taskhash[tid])
 
+        result.update(self._get_disk_cached_unihashes(queries))
         if len(queries) == 0:
             return result
 
+        result.update(self._resolve_unihashes(self._query_unihashes(queries)))
+        return result
+
+    def _get_disk_cached_unihashes(self, queries):
+        """
+        Look up queries, a dictionary mapping tids to (method, taskhash), in
+        the on disk cache. The tids found are removed from queries and
+        returned mapped to their unihashes.
+        """
+        unihash_disk_cache = self.get_unihash_disk_cache()
+        if not unihash_disk_cache:
+            return {}
+
+        result = unihash_disk_cache.get_unihashes(queries)
+        for tid, unihash in result.items():
+            hashequiv_logger.debug2('Found unihash %s in place of %s for %s in the local cache' % (unihash, self.taskhash[tid], tid))
+            self.set_unihash(tid, unihash)
+            del queries[tid]
+        return result
+
+    def _query_unihashes(self, queries):
+        """
+        Ask the server for the unihashes of queries, a dictionary mapping tids
+        to (method, taskhash)
+        """
         if self.max_parallel <= 1 or len(queries) <= 1:
             # No parallelism required. Make the query using a single client
+            query_result = {}
             with self.client() as client:
                 keys = list(queries.keys())
                 unihashes = client.get_unihash_batch(queries[k] for k in keys)
@@ -736,7 +823,11 @@ class SignatureGeneratorUniHashMixIn(object):
         else:
             with self.client_pool() as client_pool:
                 query_result = client_pool.get_unihashes(queries)
+        return query_result
 
+    def _resolve_unihashes(self, query_result):
+        result = {}
+        found = []
         for tid, unihash in query_result.items():
             # In the absence of being able to discover a unique hash from the
             # server, make it be equivalent to the taskhash. The unique "hash" only
@@ -757,6 +848,7 @@ class SignatureGeneratorUniHashMixIn(object):
                 # so it is reported it at debug level 2. If they differ, that
                 # is much more interesting, so it is reported at debug level 1
                 hashequiv_logger.bbdebug((1, 2)[unihash == taskhash], 'Found unihash %s in place of %s for %s from %s' % (unihash, taskhash, tid, self.server))
+                found.append((self._get_method(tid), taskhash, unihash))
             else:
                 hashequiv_logger.debug2('No reported unihash for %s:%s from %s' % (tid, taskhash, self.server))
                 unihash = taskhash
@@ -766,8 +858,123 @@ class SignatureGeneratorUniHashMixIn(object):
             self.unihash[tid] = unihash
             result[tid] = unihash
 
+        unihash_disk_cache = self.get_unihash_disk_cache()
+        if unihash_disk_cache:
+            unihash_disk_cache.add_unihashes(found)
+        return result
+
+    def queue_unihashes(self, tids):
+        result = {}
+        queries = {}
+
+        for tid in tids:
+            unihash = self.get_cached_unihash(tid)
+            if unihash:
+                result[tid] = unihash
+            else:
+                queries[tid] = (self._get_method(tid), self.taskhash[tid])
+
+        result.update(self._get_disk_cached_unihashes(queries))
+        if queries:
+            if self.unihash_query_thread is None:
+                # The thread gets its own client so it never shares the main
+                # one, and the environment is only changed while connecting
+                with self._client_env():
+                    client = hashserv.create_client(self.server, **self.get_hashserv_creds())
+                    try:
+                        client.connect()
+                    except:
+                        client.close()
+                        raise
+                self.unihash_query_queue = queue.Queue()
+                self.unihash_result_queue = queue.Queue()
+                self.unihash_query_thread = threading.Thread(target=self.__query_thread_main, args=(client,))
+                self.unihash_query_thread.start()
+            self.unihash_query_queue.put(queries)
+            self.unihash_queries_pending += len(queries)
+
         return result
 
+    def collect_unihashes(self, wait=True):
+        if not self.unihash_queries_pending:
+            return {}
+
+        query_result = {}
+        try:
+            item = self.unihash_result_queue.get(block=wait)
+        except queue.Empty:
+            return {}
+        while True:
+            if isinstance(item, Exception):
+                self.__stop_query_thread()
+                raise item
+            query_result.update(item)
+            try:
+                item = self.unihash_result_queue.get_nowait()
+            except queue.Empty:
+                break
+
+        self.unihash_queries_pending -= len(query_result)
+        if not self.unihash_queries_pending:
+            self.__stop_query_thread()
+        return self._resolve_unihashes(query_result)
+
+    def __query_thread_main(self, client):
+        keys = collections.deque()
+
+        async def queries():
+            loop = asyncio.get_running_loop()
+            while True:
+                items = [await loop.run_in_executor(None, self.unihash_query_queue.get)]
+                # Take anything else queued in the meantime straight away
+                try:
+                    while True:
+                        items.append(self.unihash_query_queue.get_nowait())
+                except queue.Empty:
+                    pass
+                for queries in items:
+                    if queries is None:
+                        return
+                    for tid, query in queries.items():
+                        keys.append(tid)
+                        yield query
+
+        def received(unihash):
+            self.unihash_result_queue.put({keys.popleft(): unihash})
+
+        # A single connection is used as the queries are pipelined rather than
+        # waiting for each answer in turn
+        try:
+            client.get_unihash_stream(queries(), received)
+        except Exception as e:
+            self.unihash_result_queue.put(e)
+        finally:
+            client.close()
+
+    def __stop_query_thread(self):
+        if getattr(self, 'unihash_query_thread', None) is not None:
+            self.unihash_query_queue.put(None)
+            self.unihash_query_thread.join()
+            self.unihash_query_thread = None
+            self.unihash_queries_pending = 0
+
+    def build_finished(self):
+        unihash_disk_cache = self.get_unihash_disk_cache()
+        if not unihash_disk_cache:
+            return
+        unihash_disk_cache.trim()
+        unihash_disk_cache.close()
+
+        stats = unihash_disk_cache.stats
+        lookups = stats["unihash_hits"] + stats["unihash_misses"]
+        checks = stats["exists_hits"] + stats["exists_misses"]
+        if lookups or checks:
+            hashequiv_logger.info("Hash equivalence cache: %d of %d unihash lookups (%d%%) and %d of %d existence checks (%d%%) answered locally",
+                                  stats["unihash_hits"], lookups, 100 * stats["unihash_hits"] // max(lookups, 1),
+                                  stats["exists_hits"], checks, 100 * stats["exists_hits"] // max(checks, 1))
+        for key in stats:
+            stats[key] = 0
+
     def report_unihash(self, path, task, d):
         import importlib
 
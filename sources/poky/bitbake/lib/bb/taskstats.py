@@ -0,0 +1,187 @@
+"""
+BitBake task statistics
+
+Keeps a persistent record of measurements of previous task executions,
+such as how long each task took, keyed by "<pn>:<taskname>" so that the
+history survives recipe version changes. Schedulers use these to predict
+the cost of the tasks in the current build.
+"""
+
+# Copyright BitBake Contributors
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+
+import json
+import logging
+import os
+import statistics
+import tempfile
+
+import bb.utils
+
+logger = logging.getLogger("BitBake.RunQueue")
+
+TASKSTATS_VERSION = 1
+
+# Weight given to a new measurement against the recorded value
+TASKSTATS_DECAY = 0.5
+
+def taskstats_file(d):
+    """
+    Return the path of the task statistics file for the configuration d
+    """
+    cachedir = d.getVar("PERSISTENT_DIR") or d.getVar("CACHE")
+    if not cachedir:
+        return None
+    return os.path.join(cachedir, "bb_taskstats.json")
+
+class TaskStats(object):
+    """
+    Per task measurements loaded from (and saved back to) filename. Each
+    entry is a dict of field name to value, e.g. {"duration": 12.5}.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = self._load()
+        self.updates = {}
+
+    def _load(self):
+        try:
+            with open(self.filename, "r") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.warning("Unable to read task statistics from %s: %s" % (self.filename, e))
+            return {}
+        if data.get("version") != TASKSTATS_VERSION:
+            return {}
+        return data.get("tasks", {})
+
+    def get(self, key, field):
+        return self.entries.get(key, {}).get(field)
+
+    def values(self, field):
+        """
+        Return a dict of key to value for every entry with field recorded
+        """
+        return dict((key, entry[field]) for key, entry in self.entries.items() if field in entry)
+
+    def record(self, key, field, value):
+        """
+        Add a new measurement, averaged with the recorded one when saved
+        """
+        self.updates.setdefault(key, {})[field] = value
+        self.entries[key] = merge_entry(self.entries.get(key), {field: value})
+
+    def save(self):
+        """
+        Merge this build's measurements into the file. Other builds may have
+        updated it in the meantime so it is read again under the lock.
+        """
+        if not self.updates:
+            return
+        dirname = os.path.dirname(self.filename)
+        bb.utils.mkdirhier(dirname)
+        lf = bb.utils.lockfile(self.filename + ".lock")
+        try:
+            entries = self._load()
+            for key, update in self.updates.items():
+                entries[key] = merge_entry(entries.get(key), update)
+            with tempfile.NamedTemporaryFile("w", dir=dirname, delete=False) as f:
+                json.dump({"version": TASKSTATS_VERSION, "tasks": entries}, f, sort_keys=True)
+            os.replace(f.name, self.filename)
+            self.entries = entries
+            self.updates = {}
+        except OSError as e:
+            logger.warning("Unable to save task statistics to %s: %s" % (self.filename, e))
+        finally:
+            bb.utils.unlockfile(lf)
+
+def merge_entry(entry, update):
+    entry = dict(entry or {})
+    for field, value in update.items():
+        if field in entry:
+            value = entry[field] + (value - entry[field]) * TASKSTATS_DECAY
+        entry[field] = value
+    return entry
+
+def read_buildstats(path):
+    """
+    Read the task durations from a buildstats directory of a single build,
+    which contains a directory named after the recipe's PF with a file per
+    task. Returns a dict of PF to a dict of taskname to seconds.
+    """
+    durations = {}
+    for pf in os.listdir(path):
+        recipedir = os.path.join(path, pf)
+        if not os.path.isdir(recipedir):
+            continue
+        for taskname in os.listdir(recipedir):
+            if not taskname.startswith("do_"):
+                continue
+            elapsed = None
+            started = ended = None
+            try:
+                with open(os.path.join(recipedir, taskname), "r") as f:
+                    for line in f:
+                        if line.startswith("Elapsed time:"):
+                            elapsed = float(line.split()[2])
+                        elif line.startswith("Started:"):
+                            started = float(line.split()[1])
+                        elif line.startswith("Ended:"):
+                            ended = float(line.split()[1])
+            except (OSError, ValueError, IndexError):
+                continue
+            if elapsed is None and started is not None and ended is not None:
+                elapsed = ended - started
+            if elapsed is not None:
+                durations.setdefault(pf, {})[taskname] = elapsed
+    return durations
+
+def estimate_missing(known, tids, taskname_from_tid, default=1.0):
+    """
+    Return known (tid to value) extended with an estimate for each of tids
+    it does not include: the median for the same task in other recipes, or
+    failing that the median of all known values.
+    """
+    bytask = {}
+    for tid, value in known.items():
+        bytask.setdefault(taskname_from_tid(tid), []).append(value)
+    medians = dict((taskname, statistics.median(values)) for taskname, values in bytask.items())
+    if known:
+        default = statistics.median(known.values())
+
+    result = {}
+    for tid in tids:
+        if tid in known:
+            result[tid] = known[tid]
+        else:
+            result[tid] = medians.get(taskname_from_tid(tid), default)
+    return result
+
+def sample_session_rss(sessions):
+    """
+    Return a dict of session id to the total resident memory in kB of the
+    processes currently in each of the sessions, read from /proc
+    """
+    pagesize = os.sysconf("SC_PAGE_SIZE") // 1024
+    totals = dict((sid, 0) for sid in sessions)
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            with open("/proc/%s/stat" % pid, "rb") as f:
+                data = f.read()
+        except OSError:
+            continue
+        # The command name is in brackets and may contain spaces
+        fields = data[data.rfind(b")") + 2:].split()
+        try:
+            sid = int(fields[3])
+            if sid in totals:
+                totals[sid] += int(fields[21]) * pagesize
+        except (IndexError, ValueError):
+            continue
+    return totals
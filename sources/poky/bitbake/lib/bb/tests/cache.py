@@ -0,0 +1,374 @@
+#
+# BitBake Tests for the recipe cache (cache.py)
+#
+# Copyright BitBake Contributors
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+
+import os
+import pickle
+import tempfile
+import types
+import unittest
+
+import bb
+import bb.cache
+import bb.data
+import bb.filewatch
+import bb.parse
+from bb.cache import CoreRecipeInfo, SiggenRecipeInfo
+
+def make_info(cls, **values):
+    info = cls.__new__(cls)
+    info.__dict__.update(values)
+    return info
+
+class CacheFormatTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.d = bb.data.init()
+        self.d.setVar("CACHE", self.tempdir.name)
+        self.databuilder = types.SimpleNamespace(data=self.d)
+        self.caches_array = [CoreRecipeInfo, SiggenRecipeInfo]
+        SiggenRecipeInfo.reset()
+
+    def tearDown(self):
+        SiggenRecipeInfo.reset()
+        self.tempdir.cleanup()
+
+    def new_cache(self):
+        return bb.cache.Cache(self.databuilder, "", "hash", self.caches_array)
+
+    def entries(self, count):
+        shared = frozenset(["CC", "CFLAGS"])
+        for i in range(count):
+            fn = "/recipes/r%d.bb" % i
+            yield fn, [make_info(CoreRecipeInfo, pn="r%d" % i, variants=[""], skipped=False),
+                       make_info(SiggenRecipeInfo, siggen_gendeps={"do_compile": shared},
+                                 siggen_varvals={"do_compile": "make r%d" % i},
+                                 siggen_taskdeps={"do_compile": shared})]
+
+    def write_legacy(self, cache, entries):
+        for idx, cache_class in enumerate(self.caches_array):
+            SiggenRecipeInfo.reset()
+            with open(cache.getCacheFile(cache_class.cachefile), "wb") as f:
+                p = pickle.Pickler(f, pickle.HIGHEST_PROTOCOL)
+                p.dump(bb.cache.__cache_version__)
+                p.dump(bb.__version__)
+                for key, infos in entries:
+                    p.dump(key)
+                    p.dump(infos[idx])
+
+    def assertCacheEqual(self, depends_cache, entries):
+        self.assertEqual(set(depends_cache), set(k for k, _ in entries))
+        for key, infos in entries:
+            self.assertEqual(depends_cache[key][0].pn, infos[0].pn)
+            self.assertEqual(depends_cache[key][1].siggen_varvals, infos[1].siggen_varvals)
+            self.assertEqual(depends_cache[key][1].siggen_gendeps, infos[1].siggen_gendeps)
+
+    def test_indexed_roundtrip(self):
+        entries = list(self.entries(20))
+        cache = self.new_cache()
+        cache.depends_cache = dict(entries)
+        cache.cacheclean = False
+        cache.sync()
+
+        for cache_class in self.caches_array:
+            self.assertTrue(bb.cache.is_indexed_cachefile(cache.getCacheFile(cache_class.cachefile)))
+
+        cache = self.new_cache()
+        self.assertEqual(cache.load_cachefile(lambda p: None), 20)
+        self.assertIsInstance(cache.depends_cache, bb.cache.LazyDependsCache)
+        self.assertEqual(cache.depends_cache.loadcount, 0)
+
+        self.assertEqual(cache.depends_cache["/recipes/r3.bb"][0].pn, "r3")
+        self.assertEqual(cache.depends_cache.loadcount, 1)
+        self.assertCacheEqual(cache.depends_cache, entries)
+
+    def test_untouched_entries_copied(self):
+        entries = list(self.entries(10))
+        cache = self.new_cache()
+        cache.depends_cache = dict(entries)
+        cache.cacheclean = False
+        cache.sync()
+
+        cache = self.new_cache()
+        cache.load_cachefile(lambda p: None)
+        cache.remove("/recipes/r1.bb")
+        cache.depends_cache["/recipes/new.bb"] = [make_info(CoreRecipeInfo, pn="new"),
+                                                  make_info(SiggenRecipeInfo, siggen_gendeps={}, siggen_varvals={}, siggen_taskdeps={})]
+        cache.cacheclean = False
+        cache.sync()
+
+        cache = self.new_cache()
+        self.assertEqual(cache.load_cachefile(lambda p: None), 10)
+        self.assertNotIn("/recipes/r1.bb", cache.depends_cache)
+        self.assertEqual(cache.depends_cache["/recipes/new.bb"][0].pn, "new")
+        self.assertCacheEqual(cache.depends_cache, [e for e in entries if e[0] != "/recipes/r1.bb"] + [("/recipes/new.bb", cache.depends_cache["/recipes/new.bb"])])
+
+    def test_legacy_migration(self):
+        entries = list(self.entries(10))
+        cache = self.new_cache()
+        self.write_legacy(cache, entries)
+
+        cache = self.new_cache()
+        self.assertEqual(cache.load_cachefile(lambda p: None), 10)
+        self.assertNotIsInstance(cache.depends_cache, bb.cache.LazyDependsCache)
+        self.assertFalse(cache.cacheclean)
+        self.assertCacheEqual(cache.depends_cache, entries)
+        SiggenRecipeInfo.reset()
+        cache.sync()
+
+        cache = self.new_cache()
+        self.assertEqual(cache.load_cachefile(lambda p: None), 10)
+        self.assertIsInstance(cache.depends_cache, bb.cache.LazyDependsCache)
+        self.assertCacheEqual(cache.depends_cache, entries)
+
+    def test_version_mismatch(self):
+        cache = self.new_cache()
+        for cache_class in self.caches_array:
+            bb.cache.write_indexed_cachefile(cache.getCacheFile(cache_class.cachefile), [])
+        with open(cache.getCacheFile(CoreRecipeInfo.cachefile), "r+b") as f:
+            magic, offset = bb.cache.INDEXED_CACHE_HEADER.unpack(f.read(bb.cache.INDEXED_CACHE_HEADER.size))
+            f.seek(offset)
+            pickle.dump(("0", bb.__version__, {}), f)
+
+        cache = self.new_cache()
+        self.assertEqual(cache.load_cachefile(lambda p: None), 0)
+
+    def test_journal(self):
+        self.d.setVar("BB_CACHE_JOURNAL_MAXSIZE", "1M")
+        entries = list(self.entries(10))
+        cache = self.new_cache()
+        cache.depends_cache = dict(entries)
+        cache.cacheclean = False
+        cache.sync()
+
+        basefile = cache.getCacheFile(CoreRecipeInfo.cachefile)
+        basesize = os.path.getsize(basefile)
+
+        cache = self.new_cache()
+        cache.load_cachefile(lambda p: None)
+        cache.remove("/recipes/r1.bb")
+        cache.depends_cache["/recipes/r2.bb"] = [make_info(CoreRecipeInfo, pn="r2-new"),
+                                                 make_info(SiggenRecipeInfo, siggen_gendeps={}, siggen_varvals={}, siggen_taskdeps={})]
+        cache.cacheclean = False
+        cache.sync()
+
+        # The base file is untouched, changes only went to the journal
+        self.assertEqual(os.path.getsize(basefile), basesize)
+        self.assertTrue(os.path.exists(bb.cache.getJournalFile(basefile)))
+
+        cache = self.new_cache()
+        self.assertEqual(cache.load_cachefile(lambda p: None), 9)
+        self.assertNotIn("/recipes/r1.bb", cache.depends_cache)
+        self.assertEqual(cache.depends_cache["/recipes/r2.bb"][0].pn, "r2-new")
+        self.assertEqual(cache.depends_cache["/recipes/r3.bb"][0].pn, "r3")
+
+        # Crossing the size threshold compacts the journal into the base file
+        self.d.setVar("BB_CACHE_JOURNAL_MAXSIZE", "1")
+        cache = self.new_cache()
+        cache.load_cachefile(lambda p: None)
+        cache.remove("/recipes/r4.bb")
+        cache.cacheclean = False
+        cache.sync()
+        self.assertFalse(os.path.exists(bb.cache.getJournalFile(basefile)))
+
+        cache = self.new_cache()
+        self.assertEqual(cache.load_cachefile(lambda p: None), 8)
+        self.assertEqual(cache.depends_cache["/recipes/r2.bb"][0].pn, "r2-new")
+        self.assertNotIn("/recipes/r4.bb", cache.depends_cache)
+
+    def test_journal_truncated(self):
+        cache = self.new_cache()
+        for cache_class in self.caches_array:
+            bb.cache.write_indexed_cachefile(cache.getCacheFile(cache_class.cachefile), [])
+        journalfile = bb.cache.getJournalFile(cache.getCacheFile(CoreRecipeInfo.cachefile))
+
+        bb.cache.append_cache_journal(journalfile, [("/recipes/a.bb", make_info(CoreRecipeInfo, pn="a"))], [])
+        with open(journalfile, "ab") as f:
+            f.write(bb.cache.CACHE_JOURNAL_RECORD.pack(bb.cache.CACHE_JOURNAL_SET, 100, 100))
+        bb.cache.append_cache_journal(journalfile, [("/recipes/b.bb", make_info(CoreRecipeInfo, pn="b"))], [])
+
+        journal = bb.cache.CacheJournal(journalfile)
+        self.assertEqual(set(journal.index), {"/recipes/a.bb", "/recipes/b.bb"})
+        self.assertEqual(journal.size, os.path.getsize(journalfile))
+        journal.close()
+
+class TestMultiProcessCache(bb.cache.MultiProcessCache):
+    cache_file_name = "test_multiprocess.dat"
+    CACHE_VERSION = 1
+
+class MultiProcessCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.cachedir = self.tempdir.name
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def new_cache(self):
+        cache = TestMultiProcessCache()
+        cache.init_cache(self.cachedir)
+        return cache
+
+    def test_segments(self):
+        expected = {}
+        cooker = self.new_cache()
+        workers = [self.new_cache() for i in range(3)]
+        for i, worker in enumerate(workers):
+            for j in range(100):
+                worker.cachedata_extras[0]["key%d-%d" % (i, j)] = j
+            expected.update(worker.cachedata_extras[0])
+            worker.save_extras()
+            self.assertEqual(worker.cachedata_extras[0], {})
+            # Nothing new to write
+            worker.save_extras()
+
+        # All the extras are picked up, and as there was no cache file yet
+        # the segments are compacted into it
+        cooker.save_merge()
+        self.assertEqual(cooker.cachedata[0], expected)
+        self.assertFalse(os.path.exists(cooker.segmentfile))
+
+        # Small additions stay in the segment file but are seen when loading
+        worker = self.new_cache()
+        worker.cachedata_extras[0]["new"] = 1
+        expected["new"] = 1
+        worker.save_extras()
+        cooker.save_merge()
+        self.assertTrue(os.path.exists(cooker.segmentfile))
+        self.assertEqual(cooker.cachedata[0], expected)
+        self.assertEqual(self.new_cache().cachedata[0], expected)
+
+    def test_segments_truncated(self):
+        worker = self.new_cache()
+        worker.cachedata_extras[0]["key0"] = 0
+        worker.save_extras()
+        with open(worker.segmentfile, "ab") as f:
+            f.write(bb.cache.MULTIPROCESS_SEGMENT_RECORD.pack(bb.cache.MULTIPROCESS_SEGMENT_MAGIC, 100))
+
+        cooker = self.new_cache()
+        self.assertEqual(cooker.cachedata[0], {"key0": 0})
+        cooker.save_merge()
+        self.assertFalse(os.path.exists(cooker.segmentfile))
+        self.assertEqual(self.new_cache().cachedata[0], {"key0": 0})
+
+    def test_version_mismatch(self):
+        cache = self.new_cache()
+        with open(cache.cachefile, "wb") as f:
+            pickle.dump([[{"stale": 0}], 0], f)
+        cache = self.new_cache()
+        self.assertEqual(cache.cachedata[0], {})
+        cache.save_merge()
+        with open(cache.cachefile, "rb") as f:
+            self.assertEqual(pickle.load(f), [[{}], 1])
+
+class CacheValidationTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.d = bb.data.init()
+        self.d.setVar("CACHE", self.tempdir.name)
+        self.caches_array = [CoreRecipeInfo]
+        bb.parse.clear_cache()
+
+    def tearDown(self):
+        bb.parse.clear_cache()
+        self.tempdir.cleanup()
+
+    def touch(self, name):
+        path = os.path.join(self.tempdir.name, name)
+        with open(path, "w") as f:
+            f.write(name)
+        return path
+
+    def test_prepare_validation(self):
+        recipe = self.touch("a.bb")
+        inc = self.touch("a.inc")
+        patch = self.touch("a.patch")
+        missing = os.path.join(self.tempdir.name, "missing.patch")
+
+        info = make_info(CoreRecipeInfo, timestamp=bb.parse.cached_mtime(recipe), variants=[""],
+                         appends=[], file_depends=[(inc, bb.parse.cached_mtime(inc))],
+                         file_checksums={"do_patch": "%s:True %s:False" % (patch, missing)})
+        bb.parse.clear_cache()
+
+        cache = bb.cache.Cache(types.SimpleNamespace(data=self.d), "", "hash", self.caches_array)
+        cache.depends_cache = {recipe: [info]}
+        self.assertEqual(cache.dependency_paths(recipe), ({recipe, inc}, {patch, missing}))
+
+        mccache = bb.cache.MulticonfigCache.__new__(bb.cache.MulticonfigCache)
+        mccache._MulticonfigCache__caches = {"": cache}
+        self.assertEqual(mccache.prepare_validation({"": [recipe]}), (4, 0))
+        self.assertEqual(cache.dep_exists, {patch: True, missing: False})
+
+        # The shared results are used rather than the filesystem
+        os.unlink(patch)
+        self.assertTrue(cache.cacheValid(recipe, []))
+
+        cache.dep_exists[patch] = False
+        cache.checked.clear()
+        self.assertFalse(cache.cacheValid(recipe, []))
+
+class FileWatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.watcher = bb.filewatch.FileWatcher()
+
+    def tearDown(self):
+        self.watcher.close()
+        self.tempdir.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.tempdir.name, name)
+
+    def write(self, name, contents="x"):
+        with open(self.path(name), "w") as f:
+            f.write(contents)
+        return self.path(name)
+
+    def test_changed_files(self):
+        a = self.write("a.inc")
+        b = self.write("b.inc")
+        missing = self.path("sub/dir/c.inc")
+        self.watcher.add([a, b, missing])
+
+        # Newly watched files need checking once
+        self.assertEqual(set(self.watcher.changed_files([a, b, missing])), {a, b, missing})
+        self.assertEqual(self.watcher.changed_files([a, b, missing]), [])
+
+        self.write("a.inc", "y")
+        self.assertEqual(self.watcher.changed_files([a, b, missing]), [a])
+        self.assertEqual(self.watcher.changed_files([a, b, missing]), [])
+
+        # Creating missing parent directories is noticed too
+        os.makedirs(self.path("sub/dir"))
+        self.assertEqual(self.watcher.changed_files([a, b, missing]), [missing])
+
+        # Unknown files always need checking
+        self.assertEqual(self.watcher.changed_files([self.path("other")]), [self.path("other")])
+
+    def test_recipe_validation(self):
+        recipe = self.write("a.bb")
+        inc = self.write("a.inc")
+        key = ("", recipe)
+
+        seq = self.watcher.start_validation("hash1")
+        self.assertFalse(self.watcher.unchanged(key, [recipe, inc], "hash1"))
+        self.watcher.validated_recipe(key, [recipe, inc], seq)
+        # The watches were set up after the validation so it isn't trusted yet
+        self.assertFalse(self.watcher.unchanged(key, [recipe, inc], "hash1"))
+
+        seq = self.watcher.start_validation("hash1")
+        self.watcher.validated_recipe(key, [recipe, inc], seq)
+        self.assertTrue(self.watcher.unchanged(key, [recipe, inc], "hash1"))
+        self.assertFalse(self.watcher.unchanged(key, [recipe, inc], "hash2"))
+
+        self.write("a.inc", "y")
+        self.watcher.update()
+        self.assertFalse(self.watcher.unchanged(key, [recipe, inc], "hash1"))
+
+        # A different configuration drops all validations
+        seq = self.watcher.start_validation("hash2")
+        self.assertFalse(self.watcher.validated)
@@ -7,8 +7,11 @@
 # SPDX-License-Identifier: GPL-2.0-only
 #
 
+import os
 import unittest
+import unittest.mock
 import logging
+import tempfile
 import bb
 
 logger = logging.getLogger('BitBake.TestCodeParser')
@@ -470,3 +473,53 @@ esac
     #    self.assertEqual(deps, set(["oe_libinstall"]))
 
 
+
+class CompiledCodeCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory(prefix="bitbake-codecache-")
+        self.cachedir = self.tempdir.name
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_compile_cached(self):
+        cache = bb.codeparser.CompiledCodeCache()
+        cache.init_cache(self.cachedir)
+        code = cache.compile("x = 1 + 2", "test.py", "exec")
+        namespace = {}
+        exec(code, namespace)
+        self.assertEqual(namespace["x"], 3)
+        self.assertEqual(len(cache.codecacheextras), 1)
+        cache.save_extras()
+        cache.save_merge()
+
+        cache = bb.codeparser.CompiledCodeCache()
+        cache.init_cache(self.cachedir)
+        self.assertEqual(len(cache.codecache), 1)
+        code = cache.compile("x = 1 + 2", "test.py", "exec")
+        self.assertEqual(code.co_filename, "test.py")
+        self.assertEqual(len(cache.codecacheextras), 0)
+
+        # The filename is embedded in the code object so must form part of the key
+        code = cache.compile("x = 1 + 2", "other.py", "exec")
+        self.assertEqual(code.co_filename, "other.py")
+        self.assertEqual(len(cache.codecacheextras), 1)
+
+    def test_compile_error(self):
+        cache = bb.codeparser.CompiledCodeCache()
+        with self.assertRaises(SyntaxError):
+            cache.compile("x = (", "test.py", "exec")
+        self.assertEqual(len(cache.codecacheextras), 0)
+
+    def test_compiled_cache_save(self):
+        cache = bb.codeparser.CompiledCodeCache()
+        cache.init_cache(self.cachedir)
+        with unittest.mock.patch("bb.codeparser.compiledcodecache", cache):
+            # Nothing new, nothing written and the lock isn't taken
+            bb.codeparser.compiled_cache_save()
+            self.assertEqual(os.listdir(self.cachedir), [])
+
+            cache.compile("x = 1 + 2", "test.py", "exec")
+            bb.codeparser.compiled_cache_save()
+            self.assertTrue(os.path.exists(cache.segmentfile))
+            self.assertEqual(len(cache.codecacheextras), 0)
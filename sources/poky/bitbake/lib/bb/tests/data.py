@@ -233,6 +233,32 @@ class TestMemoize(unittest.TestCase):
         self.assertEqual(d.getVar("foo", False),
                          d.getVar("bar", False))
 
+    def test_expand_memoized(self):
+        d = bb.data.init()
+        d.setVar("foo", "value of foo")
+        bb.data_smart.ExpandCacheStats.reset()
+        self.assertEqual(d.expand("${foo} bar"), "value of foo bar")
+        self.assertEqual(d.expand("${foo} bar"), "value of foo bar")
+        self.assertEqual(bb.data_smart.ExpandCacheStats.hits, 1)
+
+    def test_expand_changed_after_memoized(self):
+        d = bb.data.init()
+        d.setVar("foo", "value of foo")
+        self.assertEqual(d.expand("${foo} bar"), "value of foo bar")
+        d.setVar("foo", "second value of foo")
+        self.assertEqual(d.expand("${foo} bar"), "second value of foo bar")
+        d.delVar("foo")
+        self.assertEqual(d.expand("${foo} bar"), "${foo} bar")
+
+    def test_expand_override_changed_after_memoized(self):
+        d = bb.data.init()
+        d.setVar("OVERRIDES", "a")
+        d.setVar("foo", "default")
+        d.setVar("foo:b", "overridden")
+        self.assertEqual(d.expand("${foo}"), "default")
+        d.setVar("OVERRIDES", "a:b")
+        self.assertEqual(d.expand("${foo}"), "overridden")
+
 class TestConcat(unittest.TestCase):
     def setUp(self):
         self.d = bb.data.init()
@@ -413,6 +439,20 @@ class TestOverrides(unittest.TestCase):
         self.d.setVar("OVERRIDES", "foo:bar:some_val")
         self.assertEqual(self.d.getVar("TEST"), " testvalue5")
 
+    def test_override_index_rebuilt(self):
+        self.d.setVar("TEST:bar", "testvalue2")
+        self.d.setVar("TEST:local", "testvalue3")
+        self.d.setVar("TEST:append:bar", " appended")
+        self.d.setVar("TEST2", "testvalue4")
+        self.d.setVar("TEST2:local", "testvalue5")
+        self.assertEqual(self.d.getVar("TEST"), "testvalue3 appended")
+        self.assertEqual(self.d.getVar("TEST2"), "testvalue5")
+        self.d.setVar("OVERRIDES", "foo:bar")
+        self.assertEqual(self.d.getVar("TEST"), "testvalue2 appended")
+        self.assertEqual(self.d.getVar("TEST2"), "testvalue4")
+        self.d.setVar("OVERRIDES", "foo")
+        self.assertEqual(self.d.getVar("TEST"), "testvalue")
+
     def test_append_and_override_1(self):
         self.d.setVar("TEST:append", "testvalue2")
         self.d.setVar("TEST:bar", "testvalue3")
@@ -548,6 +588,45 @@ class TaskHash(unittest.TestCase):
         nexthash = gettask_bashhash("mytask", d)
         self.assertEqual(orighash, nexthash)
 
+class Snapshot(unittest.TestCase):
+    def setUp(self):
+        self.d = bb.data.init()
+        self.d.setVar("OVERRIDES", "foo:bar")
+        self.d.setVar("A", "a")
+        self.d.setVar("B", "b")
+        self.d.setVarFlag("B", "flag", "f")
+        self.d.setVar("C", "${A}c")
+        middle = bb.data.createCopy(self.d)
+        middle.setVar("A", "a2")
+        middle.delVar("B")
+        middle.setVar("D:bar", "d")
+        self.top = bb.data.createCopy(middle)
+        self.top.setVar("E", "e")
+
+    def test_snapshot(self):
+        snapshot = self.top.createSnapshot()
+        self.assertNotIn("_data", snapshot.dict)
+        self.assertCountEqual(list(snapshot.keys()), list(self.top.keys()))
+        for var in self.top.keys():
+            self.assertEqual(snapshot.getVar(var), self.top.getVar(var))
+            self.assertEqual(snapshot.getVarFlags(var), self.top.getVarFlags(var))
+        self.assertEqual(snapshot.getVar("B"), None)
+        self.assertEqual(snapshot.getVar("C"), "a2c")
+        self.assertEqual(snapshot.getVar("D"), "d")
+
+    def test_snapshot_copy(self):
+        snapshot = self.top.createSnapshot()
+        newd = bb.data.createCopy(snapshot)
+        newd.setVar("A", "a3")
+        newd.setVarFlag("E", "flag", "g")
+        newd.setVar("D:bar", "d2")
+        self.assertEqual(newd.getVar("C"), "a3c")
+        self.assertEqual(newd.getVar("D"), "d2")
+        self.assertEqual(snapshot.getVar("A"), "a2")
+        self.assertEqual(snapshot.getVarFlag("E", "flag"), None)
+        self.assertEqual(snapshot.getVar("D"), "d")
+        self.assertEqual(self.top.getVar("D"), "d")
+
 class Serialize(unittest.TestCase):
 
     def test_serialize(self):
@@ -14,6 +14,9 @@ import collections
 import os
 import signal
 import tarfile
+import threading
+import http.server
+import re
 from bb.fetch2 import URI
 from bb.fetch2 import FetchMethod
 import bb
@@ -3363,3 +3366,216 @@ class FetchPremirroronlyBrokenTarball(FetcherTest):
             fetcher.download()
         output = "".join(logs.output)
         self.assertFalse(" not a git repository (or any parent up to mount point /)" in output)
+
+class FetchConcurrentTest(FetcherTest):
+    def setUp(self):
+        super().setUp()
+        self.srcdir = os.path.join(self.tempdir, "httpsrc")
+        os.mkdir(self.srcdir)
+        self.checksums = {}
+        for i in range(8):
+            data = ("file %d\n" % i).encode("utf-8")
+            with open(os.path.join(self.srcdir, "file%d" % i), "wb") as f:
+                f.write(data)
+            self.checksums["file%d" % i] = hashlib.sha256(data).hexdigest()
+
+        self.server = HTTPService(self.srcdir, host="127.0.0.1")
+        self.server.start()
+        self.addCleanup(self.server.stop)
+        self.d.setVar("BB_NUMBER_FETCH_THREADS", "4")
+
+    def url(self, name, checksum=True):
+        url = "http://127.0.0.1:%s/%s" % (self.server.port, name)
+        if checksum:
+            url += ";sha256sum=%s" % self.checksums.get(name, "0" * 64)
+        return url
+
+    def test_download(self):
+        urls = [self.url("file%d" % i) for i in range(8)]
+        fetcher = bb.fetch2.Fetch(urls, self.d)
+        fetcher.download()
+        for i in range(8):
+            with open(os.path.join(self.dldir, "file%d" % i), "r") as f:
+                self.assertEqual(f.read(), "file %d\n" % i)
+            self.assertTrue(os.path.exists(os.path.join(self.dldir, "file%d.done" % i)))
+
+    def test_download_failure(self):
+        # The error is the one for the first URL which failed, as it would be
+        # when downloading one at a time
+        urls = [self.url("file0"), self.url("missing1"), self.url("file2"), self.url("missing3")]
+        fetcher = bb.fetch2.Fetch(urls, self.d)
+        with self.assertRaises(bb.fetch2.FetchError) as cm, self.assertLogs() as logs:
+            fetcher.download()
+        self.assertEqual(cm.exception.url, urls[1])
+        self.assertIn("Failed to fetch URL %s" % urls[1], "".join(logs.output))
+
+    def test_download_missing_checksums(self):
+        self.d.setVar("BB_STRICT_CHECKSUM", "1")
+        urls = [self.url("file%d" % i, checksum=(i % 2 == 0)) for i in range(8)]
+        fetcher = bb.fetch2.Fetch(urls, self.d)
+        with self.assertRaises(bb.fetch2.BBFetchException), self.assertLogs() as logs:
+            fetcher.download()
+        # Every URL without a checksum is reported, in order
+        output = "".join(logs.output)
+        positions = [output.index('SRC_URI[sha256sum] = "%s"' % self.checksums["file%d" % i]) for i in (1, 3, 5, 7)]
+        self.assertEqual(positions, sorted(positions))
+
+class NativeHTTPRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serve the files of the server from memory with keep-alive and ranges
+    """
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format_str, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def do_GET(self):
+        if self.path.startswith("/redirect/"):
+            self.send_response(302)
+            self.send_header("Location", self.path[len("/redirect"):])
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        data = self.server.files.get(self.path[1:])
+        if data is None:
+            self.send_error(404)
+            return
+
+        self.server.ranges.append(self.headers.get("Range"))
+        m = re.match(r"bytes=(\d+)-$", self.headers.get("Range") or "")
+        if m and int(m.group(1)) >= len(data):
+            self.send_error(416)
+            return
+        if m:
+            start = int(m.group(1))
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (start, len(data) - 1, len(data)))
+        else:
+            start = 0
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(data) - start))
+        self.end_headers()
+        self.wfile.write(data[start:])
+
+class FetchNativeHTTPTest(FetcherTest):
+    def setUp(self):
+        super().setUp()
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), NativeHTTPRequestHandler)
+        self.server.files = {}
+        self.server.connections = 0
+        self.server.ranges = []
+        self.checksums = {}
+        for i in range(4):
+            self.add_file("file%d" % i, ("file %d\n" % i).encode("utf-8") * 1000)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.addCleanup(bb.fetch2.wget.http_pool.clear)
+        self.d.setVar("BB_FETCH_NATIVE_HTTP", "1")
+
+    def add_file(self, name, data):
+        self.server.files[name] = data
+        self.checksums[name] = hashlib.sha256(data).hexdigest()
+
+    def url(self, name, path=None):
+        return "http://127.0.0.1:%d/%s;sha256sum=%s" % (self.server.server_port, path or name,
+                                                         self.checksums.get(name, "0" * 64))
+
+    def assertDownloaded(self, name):
+        with open(os.path.join(self.dldir, name), "rb") as f:
+            self.assertEqual(f.read(), self.server.files[name])
+        self.assertTrue(os.path.exists(os.path.join(self.dldir, name + ".done")))
+
+    def test_download(self):
+        fetcher = bb.fetch2.Fetch([self.url("file%d" % i) for i in range(4)], self.d)
+        fetcher.download()
+        for i in range(4):
+            self.assertDownloaded("file%d" % i)
+        # One connection is used for all the downloads
+        self.assertEqual(self.server.connections, 1)
+
+        # and kept for later fetches
+        self.add_file("file4", b"file 4\n")
+        fetcher = bb.fetch2.Fetch([self.url("file4")], self.d)
+        fetcher.download()
+        self.assertDownloaded("file4")
+        self.assertEqual(self.server.connections, 1)
+
+    def fork_download(self, name):
+        pid = os.fork()
+        if pid == 0:
+            ret = 1
+            try:
+                bb.fetch2.Fetch([self.url(name)], self.d).download()
+                ret = 0
+            finally:
+                os._exit(ret)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(status, 0)
+        self.assertDownloaded(name)
+
+    def test_download_server(self):
+        # Processes forked from the worker, like setscene tasks, start with
+        # an empty pool but share the connections of its download server
+        pid = bb.fetch2.wget.HTTPDownloadServer().start()
+        self.addCleanup(os.waitpid, pid, 0)
+        self.addCleanup(os.kill, pid, signal.SIGTERM)
+        self.addCleanup(setattr, bb.fetch2.wget, "http_server_address", None)
+        self.fork_download("file0")
+        self.fork_download("file1")
+        self.assertEqual(self.server.connections, 1)
+
+    def test_download_server_missing(self):
+        # Without the server each process opens its own connection
+        bb.fetch2.wget.http_server_address = os.path.join(self.tempdir, "missing")
+        self.addCleanup(setattr, bb.fetch2.wget, "http_server_address", None)
+        self.fork_download("file0")
+        self.fork_download("file1")
+        self.assertEqual(self.server.connections, 2)
+
+    def test_download_redirect(self):
+        fetcher = bb.fetch2.Fetch([self.url("file0", "redirect/file0")], self.d)
+        fetcher.download()
+        self.assertDownloaded("file0")
+
+    def test_download_resume(self):
+        with open(os.path.join(self.dldir, "file0.tmp"), "wb") as f:
+            f.write(self.server.files["file0"][:1000])
+        fetcher = bb.fetch2.Fetch([self.url("file0")], self.d)
+        fetcher.download()
+        self.assertDownloaded("file0")
+        self.assertEqual(self.server.ranges, ["bytes=1000-"])
+
+    def test_download_resume_complete(self):
+        # A partial file as long as the file is downloaded again
+        with open(os.path.join(self.dldir, "file0.tmp"), "wb") as f:
+            f.write(b"x" * len(self.server.files["file0"]))
+        fetcher = bb.fetch2.Fetch([self.url("file0")], self.d)
+        fetcher.download()
+        self.assertDownloaded("file0")
+        self.assertEqual(self.server.ranges, ["bytes=%d-" % len(self.server.files["file0"]), None])
+
+    def test_download_resume_bad_checksum(self):
+        tmpfile = os.path.join(self.dldir, "file0.tmp")
+        with open(tmpfile, "wb") as f:
+            f.write(b"x" * 1000)
+        fetcher = bb.fetch2.Fetch([self.url("file0")], self.d)
+        with self.assertRaises(bb.fetch2.FetchError), self.assertLogs():
+            fetcher.download()
+        # The bad partial file isn't resumed from again
+        self.assertFalse(os.path.exists(tmpfile))
+        fetcher.download()
+        self.assertDownloaded("file0")
+
+    def test_download_missing(self):
+        fetcher = bb.fetch2.Fetch([self.url("missing")], self.d)
+        with self.assertRaises(bb.fetch2.FetchError), self.assertLogs() as logs:
+            fetcher.download()
+        self.assertIn("HTTP status 404", "".join(logs.output))
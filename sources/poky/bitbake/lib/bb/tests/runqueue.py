@@ -8,10 +8,12 @@
 
 import unittest
 import os
+import json
 import tempfile
 import subprocess
 import sys
 import time
+import types
 
 #
 # TODO:
@@ -61,6 +63,79 @@ class RunQueueTests(unittest.TestCase):
 
             self.shutdown(tempdir)
 
+    def test_worker_recipe_cache(self):
+        with tempfile.TemporaryDirectory(prefix="runqueuetest") as tempdir:
+            extraenv = {
+                "BBMULTICONFIG" : "mc-1",
+                "BB_WORKER_RECIPE_CACHE" : "1"
+            }
+            cmd = ["bitbake", "b1", "mc:mc-1:a1"]
+            tasks = self.run_bitbakecmd(cmd, tempdir, extraenv=extraenv)
+            expected = ['a1:' + x for x in self.alltasks] + ['b1:' + x for x in self.alltasks] + \
+                       ['mc-1:a1:' + x for x in self.alltasks]
+            for x in ['a1:build', 'a1:package_qa']:
+                expected.remove(x)
+            self.assertEqual(set(tasks), set(expected))
+
+            self.shutdown(tempdir)
+
+    def test_worker_recipe_cache_reuse(self):
+        with tempfile.TemporaryDirectory(prefix="runqueuetest") as tempdir:
+            extraenv = {
+                "BBMULTICONFIG" : "mc-1",
+                "BB_WORKER_RECIPE_CACHE" : "8"
+            }
+            cmd = ["bitbake", "b1", "mc:mc-1:a1"]
+            tasks = self.run_bitbakecmd(cmd, tempdir, extraenv=extraenv)
+
+            # Each recipe is parsed once by the worker of its multiconfig,
+            # with the variables of the first of its tasks set
+            with open(tempdir + "/parse.log", "r") as f:
+                parses = [line.rstrip().rsplit(":", 1) for line in f]
+            self.assertEqual(sorted(recipe for recipe, _ in parses), ["default:a1", "default:b1", "mc-1:a1"])
+            for recipe, task in parses:
+                self.assertIn(task, self.alltasks)
+
+            # The event handler of a1 only ever sees a1 being parsed
+            with open(tempdir + "/a1-handler.log", "r") as f:
+                seen = [line.rstrip() for line in f]
+            self.assertEqual(seen, ["a1", "a1"])
+
+            self.shutdown(tempdir)
+
+    def test_critical_scheduler(self):
+        with tempfile.TemporaryDirectory(prefix="runqueuetest") as tempdir:
+            extraenv = {
+                "BB_SCHEDULER" : "critical"
+            }
+            cmd = ["bitbake", "a1"]
+            tasks = self.run_bitbakecmd(cmd, tempdir, extraenv=extraenv)
+            expected = ['a1:' + x for x in self.alltasks]
+            self.assertEqual(set(tasks), set(expected))
+
+            with open(os.path.join(tempdir, "cache", "bb_taskstats.json")) as f:
+                recorded = json.load(f)["tasks"]
+            self.assertIn("a1:do_compile", recorded)
+            self.assertIn("duration", recorded["a1:do_compile"])
+
+            self.shutdown(tempdir)
+
+    def test_memory_budget(self):
+        with tempfile.TemporaryDirectory(prefix="runqueuetest") as tempdir:
+            extraenv = {
+                "BB_MEMORY_BUDGET" : "1G"
+            }
+            cmd = ["bitbake", "a1"]
+            tasks = self.run_bitbakecmd(cmd, tempdir, extraenv=extraenv)
+            expected = ['a1:' + x for x in self.alltasks]
+            self.assertEqual(set(tasks), set(expected))
+
+            with open(os.path.join(tempdir, "cache", "bb_taskstats.json")) as f:
+                recorded = json.load(f)["tasks"]
+            self.assertGreater(recorded["a1:do_compile"]["maxrss"], 0)
+
+            self.shutdown(tempdir)
+
     def test_single_setscenevalid(self):
         with tempfile.TemporaryDirectory(prefix="runqueuetest") as tempdir:
             cmd = ["bitbake", "a1"]
@@ -341,6 +416,36 @@ class RunQueueTests(unittest.TestCase):
 
             self.shutdown(tempdir)
 
+    def test_hashserv_cache(self):
+        with tempfile.TemporaryDirectory(prefix="runqueuetest") as tempdir:
+            extraenv = {
+                "BB_HASHSERVE" : "auto",
+                "BB_HASHSERVE_CACHE_SIZE" : "1000",
+                "BB_SIGNATURE_HANDLER" : "TestEquivHash"
+            }
+            cmd = ["bitbake", "a1", "b1"]
+            sstatevalid = ""
+            tasks = self.run_bitbakecmd(cmd, tempdir, sstatevalid, extraenv=extraenv, cleanup=True)
+            expected = ['a1:' + x for x in self.alltasks] + ['b1:' + x for x in self.alltasks]
+            self.assertEqual(set(tasks), set(expected))
+            cmd = ["bitbake", "a1", "-c", "install", "-f"]
+            tasks = self.run_bitbakecmd(cmd, tempdir, sstatevalid, extraenv=extraenv, cleanup=True)
+            expected = ['a1:install']
+            self.assertEqual(set(tasks), set(expected))
+            cmd = ["bitbake", "a1", "b1"]
+            tasks = self.run_bitbakecmd(cmd, tempdir, sstatevalid, extraenv=extraenv, cleanup=True)
+            expected = ['a1:populate_sysroot', 'a1:package', 'a1:package_write_rpm_setscene', 'a1:packagedata_setscene',
+                        'a1:package_write_ipk_setscene', 'a1:package_qa_setscene', 'a1:build']
+            self.assertEqual(set(tasks), set(expected))
+            self.assertTrue(os.path.exists(os.path.join(tempdir, "cache", "bb_unihash_cache.sqlite3")))
+            # Without the unihashes saved for each task, the answers cached on
+            # disk must give the same result as asking the server
+            os.remove(os.path.join(tempdir, "cache", "bb_unihashes.dat"))
+            tasks = self.run_bitbakecmd(cmd, tempdir, sstatevalid, extraenv=extraenv, cleanup=True)
+            self.assertEqual(tasks, [])
+
+            self.shutdown(tempdir)
+
     def test_hashserv_double(self):
         with tempfile.TemporaryDirectory(prefix="runqueuetest") as tempdir:
             extraenv = {
@@ -399,3 +504,108 @@ class RunQueueTests(unittest.TestCase):
         while (os.path.exists(tempdir + "/hashserve.sock") or os.path.exists(tempdir + "cache/hashserv.db-wal") or os.path.exists(tempdir + "/bitbake.lock")):
             time.sleep(0.5)
 
+
+class TaskGraphTests(unittest.TestCase):
+    def make_graph(self, depends):
+        import bb.runqueue
+        entries = {}
+        for tid in depends:
+            entries[tid] = bb.runqueue.RunTaskEntry()
+            entries[tid].depends = set(depends[tid])
+        return bb.runqueue.TaskGraph(entries)
+
+    def test_levels(self):
+        graph = self.make_graph({
+            "a.bb:do_fetch": [],
+            "a.bb:do_compile": ["a.bb:do_fetch"],
+            "b.bb:do_fetch": [],
+            "b.bb:do_compile": ["b.bb:do_fetch", "a.bb:do_compile"],
+            "c.bb:do_x": ["c.bb:do_y"],
+            "c.bb:do_y": ["c.bb:do_x"],
+        })
+        levels = [sorted(graph.tids[i] for i in level) for level in graph.levels()]
+        self.assertEqual(levels, [["a.bb:do_fetch", "b.bb:do_fetch"], ["a.bb:do_compile"], ["b.bb:do_compile"]])
+        self.assertEqual(sorted(graph.tids[i] for i in graph.revdeps[graph.index["a.bb:do_compile"]]), ["b.bb:do_compile"])
+
+    def test_iter_bits(self):
+        import bb.runqueue
+        self.assertEqual(list(bb.runqueue.iter_bits(0)), [])
+        self.assertEqual(list(bb.runqueue.iter_bits(0b100101)), [0, 2, 5])
+        self.assertEqual(list(bb.runqueue.iter_bits(1 << 1000)), [1000])
+        self.assertEqual(list(bb.runqueue.iter_bits((1 << 1000) | (1 << 1003))), [1000, 1003])
+
+    def test_critical_path(self):
+        graph = self.make_graph({
+            "a.bb:do_fetch": [],
+            "a.bb:do_compile": ["a.bb:do_fetch"],
+            "b.bb:do_fetch": [],
+            "b.bb:do_compile": ["b.bb:do_fetch", "a.bb:do_compile"],
+            "c.bb:do_compile": ["a.bb:do_fetch"],
+        })
+        durations = {"a.bb:do_fetch": 1, "a.bb:do_compile": 10, "b.bb:do_fetch": 2, "b.bb:do_compile": 5, "c.bb:do_compile": 20}
+        lengths = graph.critical_path([durations[tid] for tid in graph.tids])
+        lengths = dict(zip(graph.tids, lengths))
+        self.assertEqual(lengths["b.bb:do_compile"], 5)
+        self.assertEqual(lengths["a.bb:do_compile"], 15)
+        self.assertEqual(lengths["b.bb:do_fetch"], 7)
+        self.assertEqual(lengths["a.bb:do_fetch"], 21)
+
+    def test_sqcoverage(self):
+        import bb.runqueue
+        graph = self.make_graph({
+            "a.bb:do_fetch": [],
+            "a.bb:do_compile": ["a.bb:do_fetch"],
+            "a.bb:do_populate_sysroot": ["a.bb:do_compile"],
+            "a.bb:do_package": ["a.bb:do_compile"],
+        })
+        sqdata = bb.runqueue.SQData()
+        index = graph.index
+        sqdata.sq_covered_ids = {
+            "a.bb:do_populate_sysroot": [index["a.bb:do_fetch"], index["a.bb:do_compile"]],
+            "a.bb:do_package": [index["a.bb:do_fetch"], index["a.bb:do_compile"]],
+        }
+        coverage = bb.runqueue.SQCoverage(sqdata, graph)
+        self.assertEqual(coverage.update(set()), set())
+        self.assertEqual(coverage.update({"a.bb:do_populate_sysroot", "a.bb:do_package"}), {"a.bb:do_fetch", "a.bb:do_compile"})
+        # Still covered by the other setscene task
+        self.assertEqual(coverage.update({"a.bb:do_package"}), {"a.bb:do_fetch", "a.bb:do_compile"})
+        self.assertEqual(coverage.update(set()), set())
+
+class RunQueueSchedulerMemoryTests(unittest.TestCase):
+    def make_scheduler(self, memory, running, failed=()):
+        import bb.data
+        import bb.runqueue
+
+        rq = types.SimpleNamespace(
+            runq_running=set(running), runq_complete=set(), failed_tids=list(failed),
+            holdoff_tasks=set(), tasks_covered=set(), tasks_notcovered=set(memory),
+            stats=types.SimpleNamespace(active=len(set(running) - set(failed))),
+            memory_budget=40 * 1024 * 1024, build_stamps={}, cfgData=bb.data.init(),
+            max_loadfactor=None)
+        sched = bb.runqueue.RunQueueScheduler.__new__(bb.runqueue.RunQueueScheduler)
+        sched.rq = rq
+        sched.rqdata = types.SimpleNamespace(runtaskentries=dict.fromkeys(memory))
+        sched.prio_map = list(memory)
+        sched.rev_prio_map = None
+        sched.buildable = set(memory) - set(running)
+        sched.skip_maxthread = {}
+        sched.stamps = dict((tid, tid) for tid in memory)
+        sched.check_pressure = False
+        sched.memory = memory
+        return sched
+
+    def test_memory_budget(self):
+        memory = {"/a.bb:do_compile": 30 * 1024 * 1024, "/b.bb:do_compile": 30 * 1024 * 1024,
+                  "/c.bb:do_compile": 5 * 1024 * 1024}
+        # b doesn't fit alongside a but c does
+        sched = self.make_scheduler(memory, ["/a.bb:do_compile"])
+        self.assertEqual(sched.next_buildable_task(), "/c.bb:do_compile")
+        sched.buildable.discard("/c.bb:do_compile")
+        self.assertIsNone(sched.next_buildable_task())
+
+    def test_memory_budget_failed(self):
+        # With -k a failed task stays running but its memory is available again
+        memory = {"/a.bb:do_compile": 30 * 1024 * 1024, "/b.bb:do_compile": 30 * 1024 * 1024,
+                  "/c.bb:do_compile": 5 * 1024 * 1024}
+        sched = self.make_scheduler(memory, ["/a.bb:do_compile", "/c.bb:do_compile"], failed=["/a.bb:do_compile"])
+        self.assertEqual(sched.next_buildable_task(), "/b.bb:do_compile")
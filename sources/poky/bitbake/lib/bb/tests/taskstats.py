@@ -0,0 +1,69 @@
+#
+# BitBake Tests for task statistics
+#
+# Copyright BitBake Contributors
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+
+import os
+import tempfile
+import unittest
+
+import bb.taskstats
+
+class TaskStatsTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory(prefix="bitbake-taskstats-")
+        self.addCleanup(self.tmpdir.cleanup)
+        self.filename = os.path.join(self.tmpdir.name, "bb_taskstats.json")
+
+    def test_record_save(self):
+        stats = bb.taskstats.TaskStats(self.filename)
+        self.assertIsNone(stats.get("a:do_compile", "duration"))
+        stats.record("a:do_compile", "duration", 10.0)
+        stats.save()
+
+        # A concurrent build saving later is merged rather than overwritten
+        other = bb.taskstats.TaskStats(self.filename)
+        stats.record("b:do_compile", "duration", 4.0)
+        other.record("a:do_compile", "duration", 20.0)
+        other.save()
+        stats.save()
+
+        stats = bb.taskstats.TaskStats(self.filename)
+        self.assertEqual(stats.get("a:do_compile", "duration"), 15.0)
+        self.assertEqual(stats.values("duration"), {"a:do_compile": 15.0, "b:do_compile": 4.0})
+
+    def test_corrupt(self):
+        with open(self.filename, "w") as f:
+            f.write("{")
+        stats = bb.taskstats.TaskStats(self.filename)
+        self.assertEqual(stats.values("duration"), {})
+
+    def test_read_buildstats(self):
+        recipedir = os.path.join(self.tmpdir.name, "20240101000000", "zlib-1.3-r0")
+        os.makedirs(recipedir)
+        with open(os.path.join(recipedir, "do_compile"), "w") as f:
+            f.write("Event: TaskStarted\nStarted: 100.00\nEvent: TaskSucceeded\nEnded: 112.50\nElapsed time: 12.50 seconds\n")
+        with open(os.path.join(recipedir, "do_fetch"), "w") as f:
+            f.write("Event: TaskStarted\nStarted: 90.00\nEvent: TaskSucceeded\nEnded: 92.00\n")
+        with open(os.path.join(recipedir, "do_unpack"), "w") as f:
+            f.write("Event: TaskStarted\nStarted: 92.00\n")
+        durations = bb.taskstats.read_buildstats(os.path.join(self.tmpdir.name, "20240101000000"))
+        self.assertEqual(durations, {"zlib-1.3-r0": {"do_compile": 12.5, "do_fetch": 2.0}})
+
+    def test_estimate_missing(self):
+        taskname = lambda tid: tid.rsplit(":", 1)[1]
+        known = {"a.bb:do_compile": 10.0, "b.bb:do_compile": 20.0, "a.bb:do_fetch": 1.0}
+        tids = list(known) + ["c.bb:do_compile", "c.bb:do_install"]
+        expected = bb.taskstats.estimate_missing(known, tids, taskname)
+        self.assertEqual(expected["c.bb:do_compile"], 15.0)
+        self.assertEqual(expected["c.bb:do_install"], 10.0)
+        self.assertEqual(bb.taskstats.estimate_missing({}, ["c.bb:do_x"], taskname), {"c.bb:do_x": 1.0})
+
+    def test_sample_session_rss(self):
+        sid = os.getsid(0)
+        rss = bb.taskstats.sample_session_rss([sid, -1])
+        self.assertGreater(rss[sid], 0)
+        self.assertEqual(rss[-1], 0)
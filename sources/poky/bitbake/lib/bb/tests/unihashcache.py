@@ -0,0 +1,88 @@
+#
+# BitBake Tests for the local unihash cache
+#
+# Copyright BitBake Contributors
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+
+import os
+import sqlite3
+import tempfile
+import unittest
+import unittest.mock
+
+import bb.unihashcache
+
+class UnihashCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory(prefix="bitbake-unihashcache-")
+        self.addCleanup(self.tmpdir.cleanup)
+        self.filename = os.path.join(self.tmpdir.name, "cache", "bb_unihash_cache.sqlite3")
+
+    def make_cache(self, server="server:8686", size=100, ttl=3600):
+        cache = bb.unihashcache.UnihashCache(self.filename, server, size, ttl)
+        self.addCleanup(cache.close)
+        return cache
+
+    def test_unihashes(self):
+        cache = self.make_cache()
+        queries = {"a": ("method", "1111"), "b": ("method", "2222"), "c": ("method2", "1111")}
+        self.assertEqual(cache.get_unihashes(queries), {})
+        cache.add_unihashes([("method", "1111", "aaaa"), ("method", "2222", "bbbb")])
+
+        # Another instance sharing the file sees the entries, but only for
+        # the same server
+        other = self.make_cache()
+        self.assertEqual(other.get_unihashes(queries), {"a": "aaaa", "b": "bbbb"})
+        self.assertEqual(other.stats["unihash_hits"], 2)
+        self.assertEqual(other.stats["unihash_misses"], 1)
+        self.assertEqual(self.make_cache(server="other:8686").get_unihashes(queries), {})
+
+    def test_many_queries(self):
+        cache = self.make_cache(size=5000)
+        cache.add_unihashes([("method", "%04d" % i, "u%d" % i) for i in range(0, 2000, 2)])
+        result = cache.get_unihashes(dict((i, ("method", "%04d" % i)) for i in range(2000)))
+        self.assertEqual(result, dict((i, "u%d" % i) for i in range(0, 2000, 2)))
+
+    def test_unihashes_exist(self):
+        cache = self.make_cache()
+        cache.add_unihashes_exist(["aaaa", "bbbb"])
+        self.assertEqual(cache.unihashes_exist({"aaaa", "cccc"}), {"aaaa"})
+        self.assertEqual(cache.stats["exists_hits"], 1)
+        self.assertEqual(cache.stats["exists_misses"], 1)
+
+    def test_trim(self):
+        cache = self.make_cache(size=3, ttl=100)
+        with unittest.mock.patch("time.time", return_value=1000.0):
+            cache.add_unihashes([("method", "0000", "old")])
+        for i in range(1, 6):
+            with unittest.mock.patch("time.time", return_value=1100.0 + i):
+                cache.add_unihashes([("method", "%04d" % i, "u%d" % i)])
+
+        queries = dict((i, ("method", "%04d" % i)) for i in range(6))
+        with unittest.mock.patch("time.time", return_value=1110.0):
+            # Expired entries are ignored even before they are dropped
+            self.assertEqual(len(cache.get_unihashes(queries)), 5)
+            cache.trim()
+            self.assertEqual(cache.get_unihashes(queries), {3: "u3", 4: "u4", 5: "u5"})
+
+    def test_unusable(self):
+        # A cache which can't be opened is disabled rather than failing the build
+        cache = self.make_cache()
+        with unittest.mock.patch("sqlite3.connect", side_effect=sqlite3.OperationalError("unable to open database file")):
+            with self.assertLogs("BitBake.SigGen.HashEquiv", level="WARNING"):
+                self.assertEqual(cache.get_unihashes({"a": ("method", "1111")}), {})
+        cache.add_unihashes([("method", "1111", "aaaa")])
+        self.assertEqual(cache.get_unihashes({"a": ("method", "1111")}), {})
+        self.assertFalse(os.path.exists(self.filename))
+
+        # Nor is one whose directory can't be created
+        notadir = os.path.join(self.tmpdir.name, "notadir")
+        with open(notadir, "w"):
+            pass
+        cache = bb.unihashcache.UnihashCache(os.path.join(notadir, "cache", "bb_unihash_cache.sqlite3"), "server:8686", 100, 3600)
+        self.addCleanup(cache.close)
+        with self.assertLogs("BitBake.SigGen.HashEquiv", level="WARNING"):
+            cache.add_unihashes_exist(["aaaa"])
+        self.assertEqual(cache.unihashes_exist({"aaaa"}), set())
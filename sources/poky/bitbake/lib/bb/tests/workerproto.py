@@ -0,0 +1,56 @@
+#
+# Copyright BitBake Contributors
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+
+import pickle
+import unittest
+
+from bb import workerproto
+
+class WorkerProtoTest(unittest.TestCase):
+    def test_roundtrip(self):
+        reader = workerproto.FrameReader()
+        reader.feed(workerproto.encode_pickled("event", {"a": 1}))
+        reader.feed(workerproto.encode_pickled("exitcode", ("mc:x:/a.bb:do_b", 0)))
+        frames = [(name, pickle.loads(payload)) for name, payload in reader.frames()]
+        self.assertEqual(frames, [("event", {"a": 1}), ("exitcode", ("mc:x:/a.bb:do_b", 0))])
+        self.assertEqual(len(reader), 0)
+
+    def test_partial(self):
+        # Payloads which contain what used to be end markers must survive
+        data = [b"</event>" * 10, b"<exitcode>", bytes(range(256)) * 100]
+        stream = b"".join(workerproto.encode_pickled("event", d) for d in data)
+        reader = workerproto.FrameReader()
+        received = []
+        for i in range(0, len(stream), 7):
+            reader.feed(stream[i:i + 7])
+            received.extend(pickle.loads(payload) for _, payload in reader.frames())
+        self.assertEqual(received, data)
+        self.assertEqual(len(reader), 0)
+
+    def test_incomplete_kept(self):
+        frame = workerproto.encode_frame("runtask", b"x" * 100)
+        reader = workerproto.FrameReader()
+        reader.feed(frame[:-1])
+        self.assertEqual(list(reader.frames()), [])
+        self.assertEqual(len(reader), len(frame) - 1)
+        reader.feed(frame[-1:])
+        self.assertEqual(list(reader.frames()), [("runtask", b"x" * 100)])
+
+    def test_compressed(self):
+        payload = b"newtaskhashes" * 1000
+        frame = workerproto.encode_frame("newtaskhashes", payload, compress=True)
+        self.assertLess(len(frame), len(payload))
+        reader = workerproto.FrameReader()
+        reader.feed(frame)
+        self.assertEqual(list(reader.frames()), [("newtaskhashes", payload)])
+
+    def test_consumer_stops_early(self):
+        reader = workerproto.FrameReader()
+        reader.feed(workerproto.encode_frame("ping", b"1"))
+        reader.feed(workerproto.encode_frame("quit", b"2"))
+        for name, payload in reader.frames():
+            break
+        self.assertEqual(list(reader.frames()), [("quit", b"2")])
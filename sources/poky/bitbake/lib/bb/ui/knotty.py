@@ -755,6 +755,8 @@ def main(server, eventHandler, params, tf = TerminalFilter):
                 if params.options.quiet == 0:
                     print(("Parsing of %d .bb files complete (%d cached, %d parsed). %d targets, %d skipped, %d masked, %d errors."
                         % ( event.total, event.cached, event.parsed, event.virtuals, event.skipped, event.masked, event.errors)))
+                    if getattr(event, "statskipped", 0):
+                        print("File watcher avoided %d file stat calls." % event.statskipped)
                 continue
 
             if isinstance(event, bb.event.CacheLoadStarted):
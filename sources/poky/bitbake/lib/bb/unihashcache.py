@@ -0,0 +1,170 @@
+"""
+BitBake local unihash cache
+
+Keeps the answers given by a hash equivalence server on disk so that later
+builds, and other bitbake instances on the same host, can use them rather
+than asking the server again. Only positive answers are kept: a taskhash
+without a unihash or an unknown unihash may become known on the server at
+any time. Entries expire after a time to live and the oldest are dropped
+once there are more than the maximum number.
+"""
+
+# Copyright BitBake Contributors
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+
+import logging
+import os
+import sqlite3
+import time
+
+import bb.utils
+
+logger = logging.getLogger("BitBake.SigGen.HashEquiv")
+
+# Keep well under the limit on the number of parameters in a sqlite query
+QUERY_CHUNK = 500
+
+def unihash_cache_file(d):
+    """
+    Return the path of the unihash cache for the configuration d
+    """
+    cachedir = d.getVar("BB_HASHSERVE_CACHE_DIR") or d.getVar("PERSISTENT_DIR") or d.getVar("CACHE")
+    if not cachedir:
+        return None
+    return os.path.join(cachedir, "bb_unihash_cache.sqlite3")
+
+class UnihashCache(object):
+    """
+    The answers from the server at address server, at most size of each kind
+    and each kept for up to ttl seconds. Lookups and their outcome are
+    counted in stats.
+    """
+    def __init__(self, filename, server, size, ttl):
+        self.filename = filename
+        self.server = server
+        self.size = size
+        self.ttl = ttl
+        self.connection = None
+        self.stats = dict.fromkeys(("unihash_hits", "unihash_misses", "exists_hits", "exists_misses"), 0)
+
+    def _connect(self):
+        if self.connection is None:
+            bb.utils.mkdirhier(os.path.dirname(self.filename))
+            # Other bitbake instances may be writing, wait for them rather than
+            # failing. The cooker uses the cache from more than one thread but
+            # never at the same time.
+            self.connection = sqlite3.connect(self.filename, timeout=30, check_same_thread=False)
+            self.connection.execute("PRAGMA journal_mode = WAL")
+            self.connection.execute("PRAGMA synchronous = NORMAL")
+            with self.connection:
+                self.connection.execute("CREATE TABLE IF NOT EXISTS unihashes (server TEXT NOT NULL, method TEXT NOT NULL, taskhash TEXT NOT NULL, unihash TEXT NOT NULL, created REAL NOT NULL, PRIMARY KEY (server, taskhash, method))")
+                self.connection.execute("CREATE INDEX IF NOT EXISTS unihashes_created ON unihashes (created)")
+                self.connection.execute("CREATE TABLE IF NOT EXISTS unihashes_exist (server TEXT NOT NULL, unihash TEXT NOT NULL, created REAL NOT NULL, PRIMARY KEY (server, unihash))")
+                self.connection.execute("CREATE INDEX IF NOT EXISTS unihashes_exist_created ON unihashes_exist (created)")
+        return self.connection
+
+    def _failed(self, e):
+        # The cache is only an optimisation, carry on without it
+        logger.warning("Unable to use unihash cache %s, disabling it: %s" % (self.filename, e))
+        self.close()
+        self.size = 0
+
+    def _select(self, query, values):
+        values = list(values)
+        rows = []
+        for i in range(0, len(values), QUERY_CHUNK):
+            chunk = values[i:i + QUERY_CHUNK]
+            rows.extend(self._connect().execute(query % ",".join("?" * len(chunk)),
+                                                [self.server, time.time() - self.ttl] + chunk))
+        return rows
+
+    def get_unihashes(self, queries):
+        """
+        Given a dictionary mapping keys to (method, taskhash), return a
+        dictionary mapping the keys found in the cache to their unihash
+        """
+        if not self.size or not queries:
+            return {}
+        try:
+            rows = self._select("SELECT method, taskhash, unihash FROM unihashes WHERE server = ? AND created > ? AND taskhash IN (%s)",
+                                set(taskhash for _, taskhash in queries.values()))
+        except (sqlite3.Error, OSError) as e:
+            self._failed(e)
+            return {}
+
+        found = dict(((method, taskhash), unihash) for method, taskhash, unihash in rows)
+        result = dict((key, found[query]) for key, query in queries.items() if query in found)
+        self.stats["unihash_hits"] += len(result)
+        self.stats["unihash_misses"] += len(queries) - len(result)
+        return result
+
+    def add_unihashes(self, entries):
+        """
+        Record the unihashes from the server in entries, a list of
+        (method, taskhash, unihash)
+        """
+        if not self.size or not entries:
+            return
+        now = time.time()
+        try:
+            with self._connect() as connection:
+                connection.executemany("INSERT OR REPLACE INTO unihashes (server, method, taskhash, unihash, created) VALUES (?, ?, ?, ?, ?)",
+                                       ((self.server, method, taskhash, unihash, now) for method, taskhash, unihash in entries))
+        except (sqlite3.Error, OSError) as e:
+            self._failed(e)
+
+    def unihashes_exist(self, unihashes):
+        """
+        Return the set of unihashes, from the given set, which the cache knows exist
+        """
+        if not self.size or not unihashes:
+            return set()
+        try:
+            rows = self._select("SELECT unihash FROM unihashes_exist WHERE server = ? AND created > ? AND unihash IN (%s)", unihashes)
+        except (sqlite3.Error, OSError) as e:
+            self._failed(e)
+            return set()
+
+        result = set(unihash for unihash, in rows)
+        self.stats["exists_hits"] += len(result)
+        self.stats["exists_misses"] += len(unihashes) - len(result)
+        return result
+
+    def add_unihashes_exist(self, unihashes):
+        """
+        Record that the server knows the unihashes in the iterable unihashes
+        """
+        if not self.size:
+            return
+        now = time.time()
+        try:
+            with self._connect() as connection:
+                connection.executemany("INSERT OR REPLACE INTO unihashes_exist (server, unihash, created) VALUES (?, ?, ?)",
+                                       ((self.server, unihash, now) for unihash in unihashes))
+        except (sqlite3.Error, OSError) as e:
+            self._failed(e)
+
+    def trim(self):
+        """
+        Drop the expired entries and then the oldest ones if there are more
+        than the maximum
+        """
+        if not self.size or self.connection is None:
+            return
+        try:
+            with self.connection as connection:
+                for table in ("unihashes", "unihashes_exist"):
+                    connection.execute("DELETE FROM %s WHERE created <= ?" % table, (time.time() - self.ttl,))
+                    count = connection.execute("SELECT COUNT(*) FROM %s" % table).fetchone()[0]
+                    if count > self.size:
+                        connection.execute("DELETE FROM %s WHERE rowid IN (SELECT rowid FROM %s ORDER BY created LIMIT ?)" % (table, table),
+                                           (count - self.size,))
+        except (sqlite3.Error, OSError) as e:
+            self._failed(e)
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
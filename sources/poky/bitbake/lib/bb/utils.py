@@ -310,13 +310,14 @@ def better_compile(text, file, realfile, mode = "exec", lineno = 0):
     A better compile method. This method
     will print the offending lines.
     """
+    import bb.codeparser
     try:
         cache = bb.methodpool.compile_cache(text)
         if cache:
             return cache
         # We can't add to the linenumbers for compile, we can pad to the correct number of blank lines though
         text2 = "\n" * int(lineno) + text
-        code = compile(text2, realfile, mode)
+        code = bb.codeparser.compile_cached(text2, realfile, mode)
         bb.methodpool.compile_cache_add(text, code)
         return code
     except Exception as e:
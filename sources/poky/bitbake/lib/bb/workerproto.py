@@ -0,0 +1,79 @@
+"""
+BitBake cooker/worker message framing
+
+Messages between the cooker and bitbake-worker, and between bitbake-worker
+and the task processes it forks, are length prefixed frames:
+
+    header (name length, flags, payload length), name, payload
+
+The payload is usually a pickle and may be zlib compressed, which is
+recorded in the flags. Readers never need to search the data for markers so
+the cost of reading a message is linear in its size.
+"""
+
+# Copyright BitBake Contributors
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+
+import pickle
+import struct
+import zlib
+
+FRAME_HEADER = struct.Struct(">BBI")
+FRAME_COMPRESSED = 0x1
+
+def encode_frame(name, payload, compress=False):
+    """
+    Return the frame for a message called name carrying the bytes payload
+    """
+    if isinstance(name, str):
+        name = name.encode("ascii")
+    flags = 0
+    if compress:
+        payload = zlib.compress(payload, 1)
+        flags |= FRAME_COMPRESSED
+    return FRAME_HEADER.pack(len(name), flags, len(payload)) + name + payload
+
+def encode_pickled(name, data, compress=False):
+    """
+    Return the frame for a message called name carrying data pickled
+    """
+    return encode_frame(name, pickle.dumps(data), compress)
+
+class FrameReader(object):
+    """
+    Accumulates data read from a pipe and splits it back into messages
+    """
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def feed(self, data):
+        self.buffer.extend(data)
+
+    def frames(self):
+        """
+        Yield (name, payload) for each complete message received so far. name
+        is a str and payload the (decompressed) bytes.
+        """
+        buf = self.buffer
+        pos = 0
+        try:
+            while len(buf) - pos >= FRAME_HEADER.size:
+                namelen, flags, length = FRAME_HEADER.unpack_from(buf, pos)
+                start = pos + FRAME_HEADER.size + namelen
+                end = start + length
+                if end > len(buf):
+                    break
+                name = bytes(buf[start - namelen:start]).decode("ascii")
+                payload = bytes(buf[start:end])
+                if flags & FRAME_COMPRESSED:
+                    payload = zlib.decompress(payload)
+                pos = end
+                yield name, payload
+        finally:
+            # Drop the messages consumed in one go rather than after each one
+            del buf[:pos]
@@ -14,13 +14,24 @@ from . import create_async_client
 logger = logging.getLogger("hashserv.client")
 
 
+async def iter_msgs(msgs):
+    if hasattr(msgs, "__aiter__"):
+        async for m in msgs:
+            yield m
+    else:
+        for m in msgs:
+            yield m
+
+
 class Batch(object):
-    def __init__(self):
+    def __init__(self, callback=None):
         self.done = False
         self.cond = asyncio.Condition()
         self.pending = []
         self.results = []
+        self.callback = callback
         self.sent_count = 0
+        self.recv_count = 0
 
     async def recv(self, socket):
         while True:
@@ -33,7 +44,11 @@ class Batch(object):
                     continue
 
             r = await socket.recv()
-            self.results.append(r)
+            self.recv_count += 1
+            if self.callback:
+                self.callback(r)
+            else:
+                self.results.append(r)
 
             async with self.cond:
                 self.pending.pop(0)
@@ -45,7 +60,7 @@ class Batch(object):
             for m in self.pending:
                 await socket.send(m)
 
-            for m in msgs:
+            async for m in iter_msgs(msgs):
                 # Add the message to the pending list before attempting to send
                 # it so that if the send fails it will be retried
                 async with self.cond:
@@ -66,9 +81,9 @@ class Batch(object):
             self.send(socket, msgs),
         )
 
-        if len(self.results) != self.sent_count:
+        if self.recv_count != self.sent_count:
             raise ValueError(
-                f"Expected result count {len(self.results)}. Expected {self.sent_count}"
+                f"Expected result count {self.recv_count}. Expected {self.sent_count}"
             )
 
         return self.results
@@ -79,6 +94,10 @@ class AsyncClient(bb.asyncrpc.AsyncClient):
     MODE_GET_STREAM = 1
     MODE_EXIST_STREAM = 2
 
+    # The maximum number of hashes sent in a single "get-multi" or
+    # "exists-multi" message
+    MAX_MULTI_QUERIES = 1000
+
     def __init__(self, username=None, password=None):
         super().__init__("OEHASHEQUIV", "1.1", logger)
         self.mode = self.MODE_NORMAL
@@ -97,7 +116,7 @@ class AsyncClient(bb.asyncrpc.AsyncClient):
             if become:
                 await self.become_user(become)
 
-    async def send_stream_batch(self, mode, msgs):
+    async def send_stream_batch(self, mode, msgs, callback=None):
         """
         Does a "batch" process of stream messages. This sends the query
         messages as fast as possible, and simultaneously attempts to read the
@@ -107,11 +126,13 @@ class AsyncClient(bb.asyncrpc.AsyncClient):
 
         The implementation does more complicated tracking using a count of sent
         messages so that `msgs` can be a generator function (i.e. its length is
-        unknown)
-
+        unknown). msgs may also be an async iterable, in which case each
+        message is sent as soon as it is produced. If callback is given it is
+        called with each result as it is received rather than the results being
+        returned.
         """
 
-        b = Batch()
+        b = Batch(callback)
 
         async def proc():
             nonlocal b
@@ -176,6 +197,42 @@ class AsyncClient(bb.asyncrpc.AsyncClient):
         )
         return [r if r else None for r in result]
 
+    async def get_unihash_stream(self, args, callback):
+        """
+        Query the unihashes of the (method, taskhash) pairs produced by the
+        async iterable args, sending each query as soon as it is produced so
+        that the round trips for later queries overlap with producing them.
+        callback is called with each unihash (or None) in the order of args as
+        it is received.
+        """
+
+        async def msgs():
+            async for method, taskhash in args:
+                yield f"{method} {taskhash}"
+
+        await self.send_stream_batch(
+            self.MODE_GET_STREAM, msgs(), lambda r: callback(r if r else None)
+        )
+
+    async def get_unihash_multi(self, args):
+        """
+        Query the unihashes of the list of (method, taskhash) pairs args,
+        returning a list of the unihashes (or None) in the same order.
+
+        Unlike get_unihash_batch(), many queries are sent in each message and
+        the server answers them with a single database query, which costs
+        much less per query. Servers without support for the "get-multi"
+        message drop the connection.
+        """
+        args = list(args)
+        result = []
+        for i in range(0, len(args), self.MAX_MULTI_QUERIES):
+            r = await self.invoke(
+                {"get-multi": {"queries": args[i : i + self.MAX_MULTI_QUERIES]}}
+            )
+            result.extend(r["unihashes"])
+        return [r if r else None for r in result]
+
     async def report_unihash(self, taskhash, method, outhash, unihash, extra={}):
         m = extra.copy()
         m["taskhash"] = taskhash
@@ -204,6 +261,20 @@ class AsyncClient(bb.asyncrpc.AsyncClient):
         result = await self.send_stream_batch(self.MODE_EXIST_STREAM, unihashes)
         return [r == "true" for r in result]
 
+    async def unihash_exists_multi(self, unihashes):
+        """
+        As unihash_exists_batch(), but using "exists-multi" messages. See
+        get_unihash_multi()
+        """
+        unihashes = list(unihashes)
+        result = []
+        for i in range(0, len(unihashes), self.MAX_MULTI_QUERIES):
+            r = await self.invoke(
+                {"exists-multi": {"unihashes": unihashes[i : i + self.MAX_MULTI_QUERIES]}}
+            )
+            result.extend(r["exists"])
+        return result
+
     async def get_outhash(self, method, outhash, taskhash, with_unihash=True):
         return await self.invoke(
             {
@@ -324,11 +395,14 @@ class Client(bb.asyncrpc.Client):
             "connect_websocket",
             "get_unihash",
             "get_unihash_batch",
+            "get_unihash_stream",
+            "get_unihash_multi",
             "report_unihash",
             "report_unihash_equiv",
             "get_taskhash",
             "unihash_exists",
             "unihash_exists_batch",
+            "unihash_exists_multi",
             "get_outhash",
             "get_stats",
             "reset_stats",
@@ -5,6 +5,7 @@
 
 from datetime import datetime, timedelta
 import asyncio
+import collections
 import logging
 import math
 import time
@@ -49,6 +50,21 @@ TOKEN_SIZE = 48
 
 SALT_SIZE = 8
 
+# The maximum number of hashes looked up by a single database query when
+# answering "get-multi" and "exists-multi" messages
+MULTI_QUERY_CHUNK = 500
+
+# The default number of entries in each of the caches of database answers
+DEFAULT_CACHE_SIZE = 100000
+
+# The number of connections used to look up hashes on the upstream server, and
+# the maximum number of hashes sent in each batch on one of them
+UPSTREAM_CONNECTIONS = 4
+UPSTREAM_BATCH_SIZE = 1000
+
+# The number of locks shared by the reports of output hashes not seen before
+REPORT_LOCKS = 64
+
 
 class Measurement(object):
     def __init__(self, sample):
@@ -143,6 +159,129 @@ class Stats(object):
         }
 
 
+class LRUCache(object):
+    """
+    A cache of up to size entries, dropping the least recently used one when
+    full. Lookups are counted in hits and misses.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.reset()
+
+    def reset(self):
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        try:
+            value = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if self.size <= 0:
+            return
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def discard(self, key):
+        self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+
+    def todict(self):
+        return {
+            "entries": len(self.entries),
+            "size": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+class UpstreamBatcher(object):
+    """
+    Looks up keys on the upstream server at address for all of the clients of
+    a server. call(client, keys) is given a batch of keys and returns a list
+    of their values. Lookups of a key already in progress wait for the same
+    answer rather than asking again, and the keys queued while a batch is in
+    flight are sent together in the next batch. If given, found(key, value)
+    is called for each key with a value.
+    """
+
+    def __init__(self, address, call, logger, found=None):
+        self.address = address
+        self.call = call
+        self.found = found
+        self.logger = logger
+        self.pending = {}
+        self.queue = collections.deque()
+        self.cond = asyncio.Condition()
+        self.stopping = False
+
+    async def get(self, key):
+        fut = self.pending.get(key)
+        if fut is None:
+            fut = asyncio.get_running_loop().create_future()
+            self.pending[key] = fut
+            self.queue.append(key)
+            async with self.cond:
+                self.cond.notify()
+        # Other clients may be waiting for the same answer, so the lookup must
+        # not be cancelled if this client goes away
+        return await asyncio.shield(fut)
+
+    async def get_many(self, keys):
+        return await asyncio.gather(*(self.get(k) for k in keys))
+
+    async def worker_task(self):
+        client = None
+        try:
+            while True:
+                async with self.cond:
+                    await self.cond.wait_for(lambda: self.queue or self.stopping)
+                    if not self.queue:
+                        break
+                    keys = [
+                        self.queue.popleft()
+                        for _ in range(min(len(self.queue), UPSTREAM_BATCH_SIZE))
+                    ]
+
+                try:
+                    if client is None:
+                        client = await create_async_client(self.address)
+                    values = await self.call(client, keys)
+                except Exception as e:
+                    self.logger.warning("Upstream query failed: %s", e)
+                    for k in keys:
+                        self.pending.pop(k).set_exception(e)
+                    if client is not None:
+                        await client.close()
+                        client = None
+                    continue
+
+                for k, v in zip(keys, values):
+                    if v and self.found is not None:
+                        await self.found(k, v)
+                    self.pending.pop(k).set_result(v)
+        finally:
+            if client is not None:
+                await client.close()
+
+    async def stop(self):
+        async with self.cond:
+            self.stopping = True
+            self.cond.notify_all()
+
+
 token_refresh_semaphore = asyncio.Lock()
 
 
@@ -235,6 +374,8 @@ class ServerClient(bb.asyncrpc.AsyncServerConnection):
                 "get-outhash": self.handle_get_outhash,
                 "get-stream": self.handle_get_stream,
                 "exists-stream": self.handle_exists_stream,
+                "get-multi": self.handle_get_multi,
+                "exists-multi": self.handle_exists_multi,
                 "get-stats": self.handle_get_stats,
                 "get-db-usage": self.handle_get_db_usage,
                 "get-db-query-columns": self.handle_get_db_query_columns,
@@ -337,16 +478,38 @@ class ServerClient(bb.asyncrpc.AsyncServerConnection):
                 d = await self.upstream_client.get_taskhash(method, taskhash, True)
                 await self.update_unified(d)
         else:
-            row = await self.db.get_equivalent(method, taskhash)
+            unihash = await self.get_equivalent(method, taskhash)
 
-            if row is not None:
-                d = {k: row[k] for k in row.keys()}
-            elif self.upstream_client is not None:
-                d = await self.upstream_client.get_taskhash(method, taskhash)
-                await self.db.insert_unihash(d["method"], d["taskhash"], d["unihash"])
+            if unihash is not None:
+                d = {"taskhash": taskhash, "method": method, "unihash": unihash}
+            elif self.server.upstream is not None:
+                unihash = await self.server.upstream_unihashes.get((method, taskhash))
+                if unihash:
+                    d = {"taskhash": taskhash, "method": method, "unihash": unihash}
 
         return d
 
+    async def get_equivalent(self, method, taskhash):
+        # Only unihashes which exist are cached. Once set, the unihash of a
+        # taskhash only changes if it is removed, which clears the cache
+        key = (method, taskhash)
+        unihash = self.server.equivalent_cache.get(key)
+        if unihash is None:
+            row = await self.db.get_equivalent(method, taskhash)
+            if row is None:
+                return None
+            unihash = row["unihash"]
+            self.server.equivalent_cache.put(key, unihash)
+        return unihash
+
+    async def unihash_exists(self, unihash):
+        if self.server.unihash_exists_cache.get(unihash):
+            return True
+        if await self.db.unihash_exists(unihash):
+            self.server.unihash_exists_cache.put(unihash, True)
+            return True
+        return False
+
     @permissions(READ_PERM)
     async def handle_get_outhash(self, request):
         method = request["method"]
@@ -414,16 +577,15 @@ class ServerClient(bb.asyncrpc.AsyncServerConnection):
         async def handler(l):
             (method, taskhash) = l.split()
             # self.logger.debug('Looking up %s %s' % (method, taskhash))
-            row = await self.db.get_equivalent(method, taskhash)
+            unihash = await self.get_equivalent(method, taskhash)
 
-            if row is not None:
-                # self.logger.debug('Found equivalent task %s -> %s', (row['taskhash'], row['unihash']))
-                return row["unihash"]
+            if unihash is not None:
+                # self.logger.debug('Found equivalent task %s -> %s', (taskhash, unihash))
+                return unihash
 
-            if self.upstream_client is not None:
-                upstream = await self.upstream_client.get_unihash(method, taskhash)
+            if self.server.upstream is not None:
+                upstream = await self.server.upstream_unihashes.get((method, taskhash))
                 if upstream:
-                    await self.server.backfill_queue.put((method, taskhash))
                     return upstream
 
             return ""
@@ -433,17 +595,70 @@ class ServerClient(bb.asyncrpc.AsyncServerConnection):
     @permissions(READ_PERM)
     async def handle_exists_stream(self, request):
         async def handler(l):
-            if await self.db.unihash_exists(l):
+            if await self.unihash_exists(l):
                 return "true"
 
-            if self.upstream_client is not None:
-                if await self.upstream_client.unihash_exists(l):
+            if self.server.upstream is not None:
+                if await self.server.upstream_unihashes_exist.get(l):
                     return "true"
 
             return "false"
 
         return await self._stream_handler(handler)
 
+    @permissions(READ_PERM)
+    async def handle_get_multi(self, request):
+        # Unlike the stream modes, the whole list of (method, taskhash) pairs
+        # is received at once so the database is queried for many of them at
+        # a time
+        queries = [tuple(q) for q in request["queries"]]
+
+        found = {}
+        taskhashes = {}
+        for method, taskhash in queries:
+            unihash = self.server.equivalent_cache.get((method, taskhash))
+            if unihash is not None:
+                found[(method, taskhash)] = unihash
+            else:
+                taskhashes.setdefault(method, []).append(taskhash)
+
+        for method, l in taskhashes.items():
+            for i in range(0, len(l), MULTI_QUERY_CHUNK):
+                for row in await self.db.get_equivalents(method, l[i : i + MULTI_QUERY_CHUNK]):
+                    key = (row["method"], row["taskhash"])
+                    found[key] = row["unihash"]
+                    self.server.equivalent_cache.put(key, row["unihash"])
+
+        if self.server.upstream is not None:
+            missing = [q for q in queries if q not in found]
+            if missing:
+                upstream = await self.server.upstream_unihashes.get_many(missing)
+                for q, unihash in zip(missing, upstream):
+                    if unihash:
+                        found[q] = unihash
+
+        return {"unihashes": [found.get(q) for q in queries]}
+
+    @permissions(READ_PERM)
+    async def handle_exists_multi(self, request):
+        unihashes = request["unihashes"]
+
+        found = set(u for u in unihashes if self.server.unihash_exists_cache.get(u))
+        missing = [u for u in unihashes if u not in found]
+        for i in range(0, len(missing), MULTI_QUERY_CHUNK):
+            exists = await self.db.unihashes_exist(missing[i : i + MULTI_QUERY_CHUNK])
+            for u in exists:
+                self.server.unihash_exists_cache.put(u, True)
+            found |= exists
+
+        if self.server.upstream is not None:
+            missing = [u for u in unihashes if u not in found]
+            if missing:
+                upstream = await self.server.upstream_unihashes_exist.get_many(missing)
+                found.update(u for u, exists in zip(missing, upstream) if exists)
+
+        return {"exists": [u in found for u in unihashes]}
+
     async def report_readonly(self, data):
         method = data["method"]
         outhash = data["outhash"]
@@ -493,21 +708,33 @@ class ServerClient(bb.asyncrpc.AsyncServerConnection):
             if row is not None:
                 # A matching output hash was found. Set our taskhash to the
                 # same unihash since they are equivalent
-                unihash = row["unihash"]
+                await self.insert_unihash(data, row["unihash"])
             else:
-                # No matching output hash was found. This is probably the
-                # first outhash to be added.
-                unihash = data["unihash"]
-
-                # Query upstream to see if it has a unihash we can use
-                if self.upstream_client is not None:
-                    upstream_data = await self.upstream_client.get_outhash(
+                # The inserts wait to be committed with those of other
+                # clients, so another report of the same output hash may
+                # also have found no match. Only one of them may pick the
+                # unihash.
+                async with self.server.report_lock(data["method"], data["outhash"]):
+                    row = await self.db.get_equivalent_for_outhash(
                         data["method"], data["outhash"], data["taskhash"]
                     )
-                    if upstream_data is not None:
-                        unihash = upstream_data["unihash"]
 
-            await self.db.insert_unihash(data["method"], data["taskhash"], unihash)
+                    if row is not None:
+                        unihash = row["unihash"]
+                    else:
+                        # No matching output hash was found. This is probably the
+                        # first outhash to be added.
+                        unihash = data["unihash"]
+
+                        # Query upstream to see if it has a unihash we can use
+                        if self.upstream_client is not None:
+                            upstream_data = await self.upstream_client.get_outhash(
+                                data["method"], data["outhash"], data["taskhash"]
+                            )
+                            if upstream_data is not None:
+                                unihash = upstream_data["unihash"]
+
+                    await self.insert_unihash(data, unihash)
 
         unihash_data = await self.get_unihash(data["method"], data["taskhash"])
         if unihash_data is not None:
@@ -521,9 +748,14 @@ class ServerClient(bb.asyncrpc.AsyncServerConnection):
             "unihash": unihash,
         }
 
+    async def insert_unihash(self, data, unihash):
+        await self.db.insert_unihash(data["method"], data["taskhash"], unihash)
+        self.server.equivalent_cache.discard((data["method"], data["taskhash"]))
+
     @permissions(READ_PERM, REPORT_PERM)
     async def handle_equivreport(self, data):
         await self.db.insert_unihash(data["method"], data["taskhash"], data["unihash"])
+        self.server.equivalent_cache.discard((data["method"], data["taskhash"]))
 
         # Fetch the unihash that will be reported for the taskhash. If the
         # unihash matches, it means this row was inserted (or the mapping
@@ -541,17 +773,15 @@ class ServerClient(bb.asyncrpc.AsyncServerConnection):
 
     @permissions(READ_PERM)
     async def handle_get_stats(self, request):
-        return {
-            "requests": self.server.request_stats.todict(),
-        }
+        return self.server.get_stats()
 
     @permissions(DB_ADMIN_PERM)
     async def handle_reset_stats(self, request):
-        d = {
-            "requests": self.server.request_stats.todict(),
-        }
+        d = self.server.get_stats()
 
         self.server.request_stats.reset()
+        self.server.equivalent_cache.reset()
+        self.server.unihash_exists_cache.reset()
         return d
 
     @permissions(READ_PERM)
@@ -568,7 +798,9 @@ class ServerClient(bb.asyncrpc.AsyncServerConnection):
         if not isinstance(condition, dict):
             raise TypeError("Bad condition type %s" % type(condition))
 
-        return {"count": await self.db.remove(condition)}
+        count = await self.db.remove(condition)
+        self.server.clear_caches()
+        return {"count": count}
 
     @permissions(DB_ADMIN_PERM)
     async def handle_gc_mark(self, request):
@@ -598,6 +830,7 @@ class ServerClient(bb.asyncrpc.AsyncServerConnection):
             )
 
         count = await self.db.gc_sweep()
+        self.server.clear_caches()
 
         return {"count": count}
 
@@ -792,6 +1025,7 @@ class Server(bb.asyncrpc.AsyncServer):
         anon_perms=DEFAULT_ANON_PERMS,
         admin_username=None,
         admin_password=None,
+        cache_size=DEFAULT_CACHE_SIZE,
     ):
         if upstream and read_only:
             raise bb.asyncrpc.ServerError(
@@ -810,10 +1044,19 @@ class Server(bb.asyncrpc.AsyncServer):
         super().__init__(logger)
 
         self.request_stats = Stats()
+        # Answers from the database shared by all the clients. Another server
+        # using the same database may remove hashes without clearing these,
+        # so only hashes which exist are cached and these are generally
+        # never removed outside of garbage collection
+        self.equivalent_cache = LRUCache(cache_size)
+        self.unihash_exists_cache = LRUCache(cache_size)
         self.db_engine = db_engine
         self.upstream = upstream
         self.read_only = read_only
         self.backfill_queue = None
+        self.upstream_unihashes = None
+        self.upstream_unihashes_exist = None
+        self.report_locks = [asyncio.Lock() for _ in range(REPORT_LOCKS)]
         self.anon_perms = set(anon_perms)
         self.admin_username = admin_username
         self.admin_password = admin_password
@@ -825,6 +1068,20 @@ class Server(bb.asyncrpc.AsyncServer):
     def accept_client(self, socket):
         return ServerClient(socket, self)
 
+    def get_stats(self):
+        return {
+            "requests": self.request_stats.todict(),
+            "equivalent-cache": self.equivalent_cache.todict(),
+            "unihash-exists-cache": self.unihash_exists_cache.todict(),
+        }
+
+    def report_lock(self, method, outhash):
+        return self.report_locks[hash((method, outhash)) % len(self.report_locks)]
+
+    def clear_caches(self):
+        self.equivalent_cache.clear()
+        self.unihash_exists_cache.clear()
+
     async def create_admin_user(self):
         admin_permissions = (ALL_PERM,)
         async with self.db_engine.connect(self.logger) as db:
@@ -846,27 +1103,49 @@ class Server(bb.asyncrpc.AsyncServer):
                 )
                 self.logger.info("Admin user '%s' updated", self.admin_username)
 
+    async def queue_backfill(self, key, unihash):
+        method, taskhash = key
+        await self.backfill_queue.put((method, taskhash, unihash))
+
     async def backfill_worker_task(self):
-        async with await create_async_client(
-            self.upstream
-        ) as client, self.db_engine.connect(self.logger) as db:
-            while True:
-                item = await self.backfill_queue.get()
-                if item is None:
+        async with self.db_engine.connect(self.logger) as db:
+            done = False
+            while not done:
+                # Insert everything which arrived while the last batch was
+                # being written in a single transaction
+                items = [await self.backfill_queue.get()]
+                while not self.backfill_queue.empty():
+                    items.append(self.backfill_queue.get_nowait())
+
+                rows = [i for i in items if i is not None]
+                done = len(rows) != len(items)
+                if rows:
+                    try:
+                        await db.insert_unihashes(rows)
+                    except Exception as e:
+                        self.logger.error("Unable to backfill %d unihashes: %s", len(rows), e)
+
+                for _ in items:
                     self.backfill_queue.task_done()
-                    break
-
-                method, taskhash = item
-                d = await client.get_taskhash(method, taskhash)
-                if d is not None:
-                    await db.insert_unihash(d["method"], d["taskhash"], d["unihash"])
-                self.backfill_queue.task_done()
 
     def start(self):
         tasks = super().start()
         if self.upstream:
             self.backfill_queue = asyncio.Queue()
+            self.upstream_unihashes = UpstreamBatcher(
+                self.upstream,
+                lambda client, keys: client.get_unihash_batch(keys),
+                self.logger,
+                self.queue_backfill,
+            )
+            self.upstream_unihashes_exist = UpstreamBatcher(
+                self.upstream,
+                lambda client, keys: client.unihash_exists_batch(keys),
+                self.logger,
+            )
             tasks += [self.backfill_worker_task()]
+            for b in (self.upstream_unihashes, self.upstream_unihashes_exist):
+                tasks += [b.worker_task() for _ in range(UPSTREAM_CONNECTIONS)]
 
         self.loop.run_until_complete(self.db_engine.create())
 
@@ -878,4 +1157,7 @@ class Server(bb.asyncrpc.AsyncServer):
     async def stop(self):
         if self.backfill_queue is not None:
             await self.backfill_queue.put(None)
+        for b in (self.upstream_unihashes, self.upstream_unihashes_exist):
+            if b is not None:
+                await b.stop()
         await super().stop()
@@ -5,6 +5,7 @@
 # SPDX-License-Identifier: GPL-2.0-only
 #
 
+import asyncio
 import logging
 from datetime import datetime
 from . import User
@@ -35,6 +36,13 @@ from sqlalchemy.orm import declarative_base
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.dialects.postgresql import insert as postgres_insert
 
+# How long inserts are held so that those arriving together can be committed
+# in one transaction, and the most committed in one transaction. Even without
+# a delay, the inserts made while the event loop runs the other clients, or
+# while a commit is in progress, are committed together.
+GROUP_COMMIT_DELAY = 0
+GROUP_COMMIT_MAX = 1000
+
 Base = declarative_base()
 
 
@@ -113,6 +121,92 @@ class UnihashesV2(DeprecatedBase):
     )
 
 
+class GroupCommitWriter(object):
+    """
+    Runs the inserts of all the clients of a server on one connection. Each
+    insert is held for GROUP_COMMIT_DELAY seconds and those arriving in the
+    meantime are committed with it, so that a burst of reports waits for
+    one commit rather than one each.
+    """
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.engine = None
+        self.db = None
+        self.pending = []
+        self.task = None
+
+    async def execute(self, statement):
+        """
+        Run statement and return the number of rows it changed once it is
+        committed. An insert of a row which already exists changes nothing.
+        """
+        fut = asyncio.get_running_loop().create_future()
+        self.pending.append((statement, fut))
+        if self.task is None:
+            self.task = asyncio.create_task(self._commit_pending())
+        return await fut
+
+    async def _commit_pending(self):
+        try:
+            await asyncio.sleep(GROUP_COMMIT_DELAY)
+            while self.pending:
+                batch = self.pending[:GROUP_COMMIT_MAX]
+                del self.pending[:GROUP_COMMIT_MAX]
+                await self._commit(batch)
+        finally:
+            self.task = None
+
+    async def _commit(self, batch):
+        try:
+            if self.db is None:
+                self.db = await self.engine.connect()
+        except Exception as e:
+            # Nothing can be written, committing each insert on its own
+            # wouldn't help
+            self._fail(batch, e)
+            return
+
+        try:
+            counts = []
+            async with self.db.begin():
+                for statement, _ in batch:
+                    self.logger.debug("%s", statement)
+                    result = await self.db.execute(statement)
+                    counts.append(result.rowcount)
+        except Exception as e:
+            if len(batch) == 1:
+                fut = batch[0][1]
+                if isinstance(e, IntegrityError):
+                    if not fut.done():
+                        fut.set_result(0)
+                else:
+                    self._fail(batch, e)
+                return
+
+            # Commit each insert on its own so that only the caller whose
+            # insert failed sees the error
+            self.logger.debug("Group commit of %d inserts failed: %s", len(batch), e)
+            for item in batch:
+                await self._commit([item])
+            return
+
+        for (_, fut), count in zip(batch, counts):
+            # The caller may have gone away in the meantime
+            if not fut.done():
+                fut.set_result(count)
+
+    def _fail(self, batch, e):
+        for _, fut in batch:
+            if not fut.done():
+                fut.set_exception(e)
+
+    async def close(self):
+        if self.db is not None:
+            await self.db.close()
+            self.db = None
+
+
 class DatabaseEngine(object):
     def __init__(self, url, username=None, password=None):
         self.logger = logging.getLogger("hashserv.sqlalchemy")
@@ -124,6 +218,8 @@ class DatabaseEngine(object):
         if password is not None:
             self.url = self.url.set(password=password)
 
+        self.writer = GroupCommitWriter(self.logger)
+
     async def create(self):
         def check_table_exists(conn, name):
             return inspect(conn).has_table(name)
@@ -135,6 +231,8 @@ class DatabaseEngine(object):
         else:
             self.engine = create_async_engine(self.url, poolclass=NullPool)
 
+        self.writer.engine = self.engine
+
         async with self.engine.begin() as conn:
             # Create tables
             self.logger.info("Creating tables...")
@@ -159,7 +257,7 @@ class DatabaseEngine(object):
                 self.logger.info("Upgrade complete")
 
     def connect(self, logger):
-        return Database(self.engine, logger)
+        return Database(self.engine, self.writer, logger)
 
 
 def map_row(row):
@@ -187,8 +285,9 @@ def _make_condition_statement(table, condition):
 
 
 class Database(object):
-    def __init__(self, engine, logger):
+    def __init__(self, engine, writer, logger):
         self.engine = engine
+        self.writer = writer
         self.db = None
         self.logger = logger
 
@@ -293,6 +392,15 @@ class Database(object):
 
             return result.first() is not None
 
+    async def unihashes_exist(self, unihashes):
+        async with self.db.begin():
+            result = await self._execute(
+                select(UnihashesV3.unihash)
+                .where(UnihashesV3.unihash.in_(unihashes))
+                .distinct()
+            )
+            return set(row.unihash for row in result)
+
     async def get_outhash(self, method, outhash):
         async with self.db.begin():
             result = await self._execute(
@@ -348,6 +456,20 @@ class Database(object):
             )
             return map_row(result.first())
 
+    async def get_equivalents(self, method, taskhashes):
+        async with self.db.begin():
+            result = await self._execute(
+                select(
+                    UnihashesV3.unihash,
+                    UnihashesV3.method,
+                    UnihashesV3.taskhash,
+                ).where(
+                    UnihashesV3.method == method,
+                    UnihashesV3.taskhash.in_(taskhashes),
+                )
+            )
+            return [map_row(row) for row in result]
+
     async def remove(self, condition):
         async def do_remove(table):
             where = _make_condition_statement(table, condition)
@@ -458,15 +580,43 @@ class Database(object):
                 gc_mark=self._get_config_subquery("gc-mark", ""),
             )
 
-        try:
-            async with self.db.begin():
-                result = await self._execute(statement)
-                return result.rowcount != 0
-        except IntegrityError:
+        if await self.writer.execute(statement) == 0:
             self.logger.debug(
                 "%s, %s, %s already in unihash database", method, taskhash, unihash
             )
             return False
+        return True
+
+    async def insert_unihashes(self, rows):
+        values = [
+            {
+                "method": method,
+                "taskhash": taskhash,
+                "unihash": unihash,
+                "gc_mark": self._get_config_subquery("gc-mark", ""),
+            }
+            for method, taskhash, unihash in rows
+        ]
+
+        # Postgres specific ignore on insert duplicate
+        if self.engine.name == "postgresql":
+            statement = (
+                postgres_insert(UnihashesV3)
+                .values(values)
+                .on_conflict_do_nothing(index_elements=("method", "taskhash"))
+            )
+            async with self.db.begin():
+                await self._execute(statement)
+            return
+
+        try:
+            async with self.db.begin():
+                await self._execute(insert(UnihashesV3).values(values))
+        except IntegrityError:
+            # Some of the rows are already present, insert the rest one at a
+            # time
+            for method, taskhash, unihash in rows:
+                await self.insert_unihash(method, taskhash, unihash)
 
     async def insert_outhash(self, data):
         outhash_columns = set(c.key for c in OuthashesV2.__table__.columns)
@@ -488,15 +638,12 @@ class Database(object):
         else:
             statement = insert(OuthashesV2).values(**data)
 
-        try:
-            async with self.db.begin():
-                result = await self._execute(statement)
-                return result.rowcount != 0
-        except IntegrityError:
+        if await self.writer.execute(statement) == 0:
             self.logger.debug(
                 "%s, %s already in outhash database", data["method"], data["outhash"]
             )
             return False
+        return True
 
     async def _get_user(self, username):
         async with self.db.begin():
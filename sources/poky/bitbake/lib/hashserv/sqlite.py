@@ -4,6 +4,7 @@
 #
 # SPDX-License-Identifier: GPL-2.0-only
 #
+import asyncio
 import sqlite3
 import logging
 from contextlib import closing
@@ -52,6 +53,13 @@ CONFIG_TABLE_DEFINITION = (
 
 CONFIG_TABLE_COLUMNS = tuple(name for name, _, _ in CONFIG_TABLE_DEFINITION)
 
+# How long inserts are held so that those arriving together can be committed
+# in one transaction, and the most committed in one transaction. Even without
+# a delay, the inserts made while the event loop runs the other clients, or
+# while a commit is in progress, are committed together.
+GROUP_COMMIT_DELAY = 0
+GROUP_COMMIT_MAX = 1000
+
 
 def _make_table(cursor, name, definition):
     cursor.execute(
@@ -109,11 +117,110 @@ def _schema_table_name(version):
     return "sqlite_master"
 
 
+def _connect(dbname, sync):
+    db = sqlite3.connect(dbname)
+    db.row_factory = sqlite3.Row
+
+    with closing(db.cursor()) as cursor:
+        cursor.execute("PRAGMA journal_mode = WAL")
+        cursor.execute("PRAGMA synchronous = %s" % ("NORMAL" if sync else "OFF"))
+
+    return db
+
+
+class GroupCommitWriter(object):
+    """
+    Runs the inserts of all the clients of a server on one connection. Each
+    insert is held for GROUP_COMMIT_DELAY seconds and those arriving in the
+    meantime are committed with it, so that a burst of reports waits for
+    one sync of the database rather than one each.
+    """
+
+    def __init__(self, logger, dbname, sync):
+        self.logger = logger
+        self.dbname = dbname
+        self.sync = sync
+        self.db = None
+        self.pending = []
+        self.task = None
+
+    async def execute(self, query, params):
+        """
+        Run query with params and return the number of rows it changed once
+        it is committed
+        """
+        fut = asyncio.get_running_loop().create_future()
+        self.pending.append((query, params, fut))
+        if self.task is None:
+            self.task = asyncio.create_task(self._commit_pending())
+        return await fut
+
+    async def _commit_pending(self):
+        try:
+            await asyncio.sleep(GROUP_COMMIT_DELAY)
+            while self.pending:
+                batch = self.pending[:GROUP_COMMIT_MAX]
+                del self.pending[:GROUP_COMMIT_MAX]
+                self._commit(batch)
+        finally:
+            self.task = None
+
+    def _commit(self, batch):
+        try:
+            if self.db is None:
+                self.db = _connect(self.dbname, self.sync)
+        except Exception as e:
+            # Nothing can be written, committing each insert on its own
+            # wouldn't help
+            self._fail(batch, e)
+            return
+
+        try:
+            counts = []
+            with closing(self.db.cursor()) as cursor:
+                for query, params, _ in batch:
+                    cursor.execute(query, params)
+                    counts.append(cursor.rowcount)
+            self.db.commit()
+        except Exception as e:
+            try:
+                self.db.rollback()
+            except sqlite3.Error:
+                # Start again with a new connection
+                self.close()
+            if len(batch) == 1:
+                self._fail(batch, e)
+                return
+
+            # Commit each insert on its own so that only the caller whose
+            # insert failed sees the error
+            self.logger.debug("Group commit of %d inserts failed: %s", len(batch), e)
+            for item in batch:
+                self._commit([item])
+            return
+
+        for (_, _, fut), count in zip(batch, counts):
+            # The caller may have gone away in the meantime
+            if not fut.done():
+                fut.set_result(count)
+
+    def _fail(self, batch, e):
+        for _, _, fut in batch:
+            if not fut.done():
+                fut.set_exception(e)
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+
 class DatabaseEngine(object):
     def __init__(self, dbname, sync):
         self.dbname = dbname
         self.logger = logger
         self.sync = sync
+        self.writer = GroupCommitWriter(logger, dbname, sync)
 
     async def create(self):
         db = sqlite3.connect(self.dbname)
@@ -172,23 +279,18 @@ class DatabaseEngine(object):
                 self.logger.info("Upgrade complete")
 
     def connect(self, logger):
-        return Database(logger, self.dbname, self.sync)
+        return Database(logger, self.dbname, self.sync, self.writer)
 
 
 class Database(object):
-    def __init__(self, logger, dbname, sync):
+    def __init__(self, logger, dbname, sync, writer):
         self.dbname = dbname
         self.logger = logger
+        self.writer = writer
 
-        self.db = sqlite3.connect(self.dbname)
-        self.db.row_factory = sqlite3.Row
+        self.db = _connect(self.dbname, sync)
 
         with closing(self.db.cursor()) as cursor:
-            cursor.execute("PRAGMA journal_mode = WAL")
-            cursor.execute(
-                "PRAGMA synchronous = %s" % ("NORMAL" if sync else "OFF")
-            )
-
             self.sqlite_version = _get_sqlite_version(cursor)
 
     async def __aenter__(self):
@@ -271,6 +373,15 @@ class Database(object):
             )
             return cursor.fetchone() is not None
 
+    async def unihashes_exist(self, unihashes):
+        with closing(self.db.cursor()) as cursor:
+            cursor.execute(
+                "SELECT DISTINCT unihash FROM unihashes_v3 WHERE unihash IN (%s)"
+                % ",".join("?" * len(unihashes)),
+                unihashes,
+            )
+            return set(row["unihash"] for row in cursor.fetchall())
+
     async def get_outhash(self, method, outhash):
         with closing(self.db.cursor()) as cursor:
             cursor.execute(
@@ -318,6 +429,15 @@ class Database(object):
             )
             return cursor.fetchone()
 
+    async def get_equivalents(self, method, taskhashes):
+        with closing(self.db.cursor()) as cursor:
+            cursor.execute(
+                "SELECT taskhash, method, unihash FROM unihashes_v3 WHERE method=? AND taskhash IN (%s)"
+                % ",".join("?" * len(taskhashes)),
+                [method] + taskhashes,
+            )
+            return cursor.fetchall()
+
     async def remove(self, condition):
         def do_remove(columns, table_name, cursor):
             where, clause = _make_condition_statement(columns, condition)
@@ -415,26 +535,39 @@ class Database(object):
             return cursor.rowcount
 
     async def insert_unihash(self, method, taskhash, unihash):
+        count = await self.writer.execute(
+            """
+            INSERT OR IGNORE INTO unihashes_v3 (method, taskhash, unihash, gc_mark) VALUES
+                (
+                :method,
+                :taskhash,
+                :unihash,
+                COALESCE((SELECT value FROM config WHERE name='gc-mark'), '')
+                )
+            """,
+            {
+                "method": method,
+                "taskhash": taskhash,
+                "unihash": unihash,
+            },
+        )
+        return count != 0
+
+    async def insert_unihashes(self, rows):
         with closing(self.db.cursor()) as cursor:
-            prevrowid = cursor.lastrowid
-            cursor.execute(
+            cursor.executemany(
                 """
                 INSERT OR IGNORE INTO unihashes_v3 (method, taskhash, unihash, gc_mark) VALUES
                     (
-                    :method,
-                    :taskhash,
-                    :unihash,
+                    ?,
+                    ?,
+                    ?,
                     COALESCE((SELECT value FROM config WHERE name='gc-mark'), '')
                     )
                 """,
-                {
-                    "method": method,
-                    "taskhash": taskhash,
-                    "unihash": unihash,
-                },
+                rows,
             )
             self.db.commit()
-            return cursor.lastrowid != prevrowid
 
     async def insert_outhash(self, data):
         data = {k: v for k, v in data.items() if k in OUTHASH_TABLE_COLUMNS}
@@ -443,11 +576,7 @@ class Database(object):
             fields=", ".join(keys),
             values=", ".join(":" + k for k in keys),
         )
-        with closing(self.db.cursor()) as cursor:
-            prevrowid = cursor.lastrowid
-            cursor.execute(query, data)
-            self.db.commit()
-            return cursor.lastrowid != prevrowid
+        return await self.writer.execute(query, data) != 0
 
     def _get_user(self, username):
         with closing(self.db.cursor()) as cursor:
@@ -9,6 +9,8 @@ from . import create_server, create_client
 from .server import DEFAULT_ANON_PERMS, ALL_PERMISSIONS
 from bb.asyncrpc import InvokeError
 from .client import ClientPool
+import asyncio
+import concurrent.futures
 import hashlib
 import logging
 import multiprocessing
@@ -18,6 +20,7 @@ import tempfile
 import threading
 import unittest
 import socket
+import sqlite3
 import time
 import signal
 import subprocess
@@ -30,10 +33,11 @@ THIS_DIR = Path(__file__).parent
 BIN_DIR = THIS_DIR.parent.parent / "bin"
 
 def server_prefunc(server, idx):
-    logging.basicConfig(level=logging.DEBUG, filename='bbhashserv-%d.log' % idx, filemode='w',
+    # Log into the test's own directory rather than wherever the tests are run from
+    logging.basicConfig(level=logging.DEBUG, filename=os.path.join(server.logdir, 'bbhashserv-%d.log' % idx), filemode='w',
                         format='%(levelname)s %(filename)s:%(lineno)d %(message)s')
     server.logger.debug("Running server %d" % idx)
-    sys.stdout = open('bbhashserv-stdout-%d.log' % idx, 'w')
+    sys.stdout = open(os.path.join(server.logdir, 'bbhashserv-stdout-%d.log' % idx), 'w')
     sys.stderr = sys.stdout
 
 class HashEquivalenceTestSetup(object):
@@ -62,6 +66,7 @@ class HashEquivalenceTestSetup(object):
                                admin_username=admin_username,
                                admin_password=admin_password)
         server.dbpath = dbpath
+        server.logdir = self.temp_dir.name
 
         server.serve_as_process(prefunc=prefunc, args=(self.server_index,))
         self.addCleanup(cleanup_server, server)
@@ -226,6 +231,26 @@ class HashEquivalenceCommonTests(object):
         result_outhash = self.client.get_outhash(self.METHOD, outhash, taskhash)
         self.assertIsNone(result_outhash)
 
+    def test_cache(self):
+        taskhash, outhash, unihash = self.create_test_hash(self.client)
+        self.client.reset_stats()
+
+        for _ in range(3):
+            self.assertClientGetHash(self.client, taskhash, unihash)
+            self.assertTrue(self.client.unihash_exists(unihash))
+            self.assertFalse(self.client.unihash_exists("6662e699d6e3d894b24408ff9a4031ef9b038ee8"))
+
+        stats = self.client.get_stats()
+        self.assertEqual(stats["equivalent-cache"]["hits"], 3)
+        self.assertEqual(stats["equivalent-cache"]["misses"], 0)
+        self.assertEqual(stats["unihash-exists-cache"]["hits"], 2)
+        self.assertEqual(stats["unihash-exists-cache"]["misses"], 4)
+
+        # Removed hashes must not be answered from the cache
+        self.client.remove({"taskhash": taskhash})
+        self.assertClientGetHash(self.client, taskhash, None)
+        self.assertFalse(self.client.unihash_exists(unihash))
+
     def test_remove_unihash(self):
         taskhash, outhash, unihash = self.create_test_hash(self.client)
         result = self.client.remove({"unihash": unihash})
@@ -631,6 +656,152 @@ class HashEquivalenceCommonTests(object):
             None,
         ])
 
+    def test_get_unihash_multi(self):
+        TEST_INPUT = (
+            # taskhash                                   outhash                                                            unihash
+            ('8aa96fcffb5831b3c2c0cb75f0431e3f8b20554a', 'afe240a439959ce86f5e322f8c208e1fedefea9e813f2140c81af866cc9edf7e','218e57509998197d570e2c98512d0105985dffc9'),
+            # Duplicated taskhash with multiple output hashes and unihashes.
+            ('8aa96fcffb5831b3c2c0cb75f0431e3f8b20554a', '0904a7fe3dc712d9fd8a74a616ddca2a825a8ee97adf0bd3fc86082c7639914d', 'ae9a7d252735f0dafcdb10e2e02561ca3a47314c'),
+            # Equivalent hash
+            ("044c2ec8aaf480685a00ff6ff49e6162e6ad34e1", '0904a7fe3dc712d9fd8a74a616ddca2a825a8ee97adf0bd3fc86082c7639914d', "def64766090d28f627e816454ed46894bb3aab36"),
+            ("e3da00593d6a7fb435c7e2114976c59c5fd6d561", "1cf8713e645f491eb9c959d20b5cae1c47133a292626dda9b10709857cbe688a", "3b5d3d83f07f259e9086fcb422c855286e18a57d"),
+        )
+
+        for taskhash, outhash, unihash in TEST_INPUT:
+            self.client.report_unihash(taskhash, self.METHOD, outhash, unihash)
+
+        result = self.client.get_unihash_multi(
+            [(self.METHOD, data[0]) for data in TEST_INPUT] +
+            [(self.METHOD, "6b6be7a84ab179b4240c4302518dc3f6"), (self.METHOD + ".other", TEST_INPUT[0][0])]
+        )
+
+        self.assertListEqual(result, [
+            "218e57509998197d570e2c98512d0105985dffc9",
+            "218e57509998197d570e2c98512d0105985dffc9",
+            "218e57509998197d570e2c98512d0105985dffc9",
+            "3b5d3d83f07f259e9086fcb422c855286e18a57d",
+            None,
+            None,
+        ])
+
+        # More queries than fit in one message or one database query
+        query = [(self.METHOD, "%040x" % i) for i in range(2500)]
+        query[1234] = (self.METHOD, TEST_INPUT[3][0])
+        result = self.client.get_unihash_multi(query)
+        self.assertEqual(len(result), len(query))
+        self.assertEqual(result[1234], TEST_INPUT[3][2])
+        self.assertEqual(result.count(None), len(query) - 1)
+
+    def test_unihash_exists_multi(self):
+        taskhash, outhash, unihash = self.create_test_hash(self.client)
+        query = ["%040x" % i for i in range(2500)]
+        query[1234] = unihash
+        result = self.client.unihash_exists_multi(query)
+        self.assertListEqual(result, [u == unihash for u in query])
+
+    def test_upstream_server_multi(self):
+        down_server = self.start_server(upstream=self.server_address)
+        down_client = self.start_client(down_server.address)
+        side_server = self.start_server(dbpath=down_server.dbpath)
+        side_client = self.start_client(side_server.address)
+
+        taskhash, outhash, unihash = self.create_test_hash(self.client)
+        query = [(self.METHOD, taskhash), (self.METHOD, "6b6be7a84ab179b4240c4302518dc3f6")]
+
+        self.assertListEqual(side_client.get_unihash_multi(query), [None, None])
+        self.assertListEqual(down_client.get_unihash_multi(query), [unihash, None])
+        self.assertListEqual(down_client.unihash_exists_multi([unihash, "6b6be7a84ab179b4240c4302518dc3f6"]), [True, False])
+
+        # The hashes found upstream are backfilled into the downstream database
+        down_client.backfill_wait()
+        self.assertListEqual(side_client.get_unihash_multi(query), [unihash, None])
+
+    def test_upstream_server_concurrent(self):
+        down_server = self.start_server(upstream=self.server_address)
+        side_server = self.start_server(dbpath=down_server.dbpath)
+        side_client = self.start_client(side_server.address)
+
+        hashes = []
+        for i in range(20):
+            taskhash = hashlib.sha256(("taskhash %d" % i).encode("utf-8")).hexdigest()
+            outhash = hashlib.sha256(("outhash %d" % i).encode("utf-8")).hexdigest()
+            unihash = hashlib.sha256(("unihash %d" % i).encode("utf-8")).hexdigest()
+            self.client.report_unihash(taskhash, self.METHOD, outhash, unihash)
+            hashes.append((taskhash, unihash))
+        query = [(self.METHOD, taskhash) for taskhash, _ in hashes] + [(self.METHOD, "6b6be7a84ab179b4240c4302518dc3f6")]
+        expected = [unihash for _, unihash in hashes] + [None]
+
+        # Clients asking for the same hashes at the same time share the
+        # upstream lookups
+        def query_hashes(i):
+            client = self.start_client(down_server.address)
+            if i % 2:
+                return client.get_unihash_batch(query)
+            return [client.get_unihash(m, t) for m, t in query]
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+            for result in executor.map(query_hashes, range(8)):
+                self.assertListEqual(result, expected)
+
+        down_client = self.start_client(down_server.address)
+        down_client.backfill_wait()
+        self.assertListEqual(side_client.get_unihash_batch(query), expected)
+
+    def test_report_concurrent(self):
+        # Reports arriving together are committed together, but each client
+        # still gets the answer it would have got on its own
+        outhash = hashlib.sha256(b"shared outhash").hexdigest()
+
+        def report(i):
+            client = self.start_client(self.server_address)
+            taskhash = hashlib.sha256(("taskhash %d" % i).encode("utf-8")).hexdigest()
+            own_outhash = hashlib.sha256(("outhash %d" % i).encode("utf-8")).hexdigest()
+            unihash = hashlib.sha256(("unihash %d" % i).encode("utf-8")).hexdigest()
+            own = client.report_unihash(taskhash, self.METHOD, own_outhash, unihash)
+            shared = client.report_unihash(taskhash + "0", self.METHOD, outhash, unihash)
+            again = client.report_unihash(taskhash, self.METHOD, own_outhash, unihash + "0")
+            return unihash, own["unihash"], shared["unihash"], again["unihash"]
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(report, range(16)))
+
+        for unihash, own, _, again in results:
+            self.assertEqual(own, unihash)
+            self.assertEqual(again, unihash)
+        # All the tasks with the same output hash get the same unihash
+        self.assertEqual(len(set(shared for _, _, shared, _ in results)), 1)
+        self.assertIn(results[0][2], [unihash for unihash, _, _, _ in results])
+
+    def test_get_unihash_stream(self):
+        TEST_INPUT = (
+            # taskhash                                   outhash                                                            unihash
+            ('8aa96fcffb5831b3c2c0cb75f0431e3f8b20554a', 'afe240a439959ce86f5e322f8c208e1fedefea9e813f2140c81af866cc9edf7e','218e57509998197d570e2c98512d0105985dffc9'),
+            ("e3da00593d6a7fb435c7e2114976c59c5fd6d561", "1cf8713e645f491eb9c959d20b5cae1c47133a292626dda9b10709857cbe688a", "3b5d3d83f07f259e9086fcb422c855286e18a57d"),
+        )
+
+        for taskhash, outhash, unihash in TEST_INPUT:
+            self.client.report_unihash(taskhash, self.METHOD, outhash, unihash)
+
+        received = []
+
+        async def queries():
+            for idx, (taskhash, _, _) in enumerate(TEST_INPUT):
+                yield (self.METHOD, taskhash)
+                # Each answer is received before the next query is produced
+                while len(received) <= idx:
+                    await asyncio.sleep(0.01)
+            yield (self.METHOD, "6b6be7a84ab179b4240c4302518dc3f6")
+
+        self.client.get_unihash_stream(queries(), received.append)
+        self.assertListEqual(received, [
+            "218e57509998197d570e2c98512d0105985dffc9",
+            "3b5d3d83f07f259e9086fcb422c855286e18a57d",
+            None,
+        ])
+
+        # The client can be used normally afterwards
+        self.assertEqual(self.client.get_unihash(self.METHOD, TEST_INPUT[0][0]), TEST_INPUT[0][2])
+
     def test_client_pool_unihash_exists(self):
         TEST_INPUT = (
             # taskhash                                   outhash                                                            unihash
@@ -1194,6 +1365,9 @@ class TestHashEquivalenceClient(HashEquivalenceTestSetup, unittest.TestCase):
     def test_stress(self):
         self.run_hashclient(["--address", self.server_address, "stress"], check=True)
 
+    def test_bench(self):
+        self.run_hashclient(["--address", self.server_address, "bench", "--report", "--requests", "100", "--batch-size", "30"], check=True)
+
     def test_unihash_exsits(self):
         taskhash, outhash, unihash = self.create_test_hash(self.client)
 
@@ -1482,6 +1656,59 @@ class TestHashEquivalenceClient(HashEquivalenceTestSetup, unittest.TestCase):
         self.assertClientGetHash(self.client, taskhash, unihash)
 
 
+class TestGroupCommitWriter(unittest.TestCase):
+    def setUp(self):
+        from .sqlite import DatabaseEngine
+
+        self.temp_dir = tempfile.TemporaryDirectory(prefix='bb-hashserv')
+        self.addCleanup(self.temp_dir.cleanup)
+        self.engine = DatabaseEngine(os.path.join(self.temp_dir.name, "db.sqlite"), False)
+        self.addCleanup(self.engine.writer.close)
+        asyncio.run(self.engine.create())
+
+    def test_results(self):
+        async def run():
+            async with self.engine.connect(logging.getLogger("hashserv")) as db:
+                return await asyncio.gather(
+                    db.insert_unihash("method", "1111", "aaaa"),
+                    db.insert_unihash("method", "2222", "bbbb"),
+                    db.insert_unihash("method", "1111", "cccc"),
+                    self.engine.writer.execute("INSERT INTO missing VALUES (1)", {}),
+                    db.insert_unihash("method", "3333", "dddd"),
+                    return_exceptions=True,
+                )
+
+        results = asyncio.run(run())
+        self.assertListEqual(results[:3], [True, True, False])
+        self.assertIsInstance(results[3], sqlite3.OperationalError)
+        self.assertTrue(results[4])
+
+        async def check():
+            async with self.engine.connect(logging.getLogger("hashserv")) as db:
+                rows = await db.get_equivalents("method", ["1111", "2222", "3333"])
+                return sorted((row["taskhash"], row["unihash"]) for row in rows)
+
+        self.assertListEqual(asyncio.run(check()), [("1111", "aaaa"), ("2222", "bbbb"), ("3333", "dddd")])
+
+    def test_connect_failure(self):
+        from .sqlite import GroupCommitWriter
+
+        # Every caller sees the error rather than waiting forever
+        writer = GroupCommitWriter(logging.getLogger("hashserv"), os.path.join(self.temp_dir.name, "missing", "db.sqlite"), False)
+        self.addCleanup(writer.close)
+
+        async def run():
+            return await asyncio.wait_for(asyncio.gather(
+                writer.execute("INSERT INTO config VALUES (1)", {}),
+                writer.execute("INSERT INTO config VALUES (2)", {}),
+                return_exceptions=True,
+            ), 10)
+
+        results = asyncio.run(run())
+        self.assertIsInstance(results[0], sqlite3.OperationalError)
+        self.assertIsInstance(results[1], sqlite3.OperationalError)
+
+
 class TestHashEquivalenceUnixServer(HashEquivalenceTestSetup, HashEquivalenceCommonTests, unittest.TestCase):
     def get_server_addr(self, server_idx):
         return "unix://" + os.path.join(self.temp_dir.name, 'sock%d' % server_idx)
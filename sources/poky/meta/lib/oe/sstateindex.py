@@ -0,0 +1,115 @@
+#
+# Copyright OpenEmbedded Contributors
+#
+# SPDX-License-Identifier: MIT
+#
+"""
+Index of the objects held by an sstate mirror
+
+scripts/sstate-mirror-index.py writes the list of the sstate objects in a
+cache directory to INDEX_NAME at its top. When a build uses the directory
+as a mirror, sstate_checkhashes() downloads the list once per build instead
+of asking the mirror about each object it needs. Objects which were added after the
+index was written are not listed, so those are still checked on the mirror.
+"""
+
+import gzip
+import os
+import tempfile
+
+INDEX_NAME = "sstate-index.txt.gz"
+INDEX_HEADER = "# sstate mirror index v1"
+
+# The objects checked by sstate_checkhashes(), see generate_sstatefn()
+INDEX_SUFFIXES = (".tar.zst", ".tar.zst.siginfo")
+
+def is_sstate_object(name):
+    return name.startswith("sstate:") and name.endswith(INDEX_SUFFIXES)
+
+def scan(sstate_dir):
+    """
+    Return the sorted paths, relative to sstate_dir, of the sstate objects
+    in it
+    """
+    names = []
+    for root, _, files in os.walk(sstate_dir):
+        reldir = os.path.relpath(root, sstate_dir)
+        for f in files:
+            if is_sstate_object(f):
+                names.append(f if reldir == "." else os.path.join(reldir, f))
+    return sorted(names)
+
+def write_index(names, filename):
+    """
+    Write the index listing names to filename, replacing it in one go so that
+    a mirror never serves a partly written index
+    """
+    fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)), prefix=".sstate-index.")
+    try:
+        with os.fdopen(fd, "wb") as raw, gzip.open(raw, "wt") as f:
+            f.write(INDEX_HEADER + "\n")
+            for name in names:
+                f.write(name + "\n")
+        os.chmod(tmpname, 0o644)
+        os.replace(tmpname, filename)
+    except BaseException:
+        os.unlink(tmpname)
+        raise
+
+def read_index(filename):
+    """
+    Return the set of names listed in the index filename. Raises ValueError
+    if it isn't an index this version understands.
+    """
+    with gzip.open(filename, "rt") as f:
+        header = f.readline().rstrip("\n")
+        if header != INDEX_HEADER:
+            raise ValueError("%s is not a supported sstate mirror index" % filename)
+        return set(line.rstrip("\n") for line in f)
+
+# The indexes fetched during the current build, keyed by (BUILDNAME, PREMIRRORS)
+mirror_indexes = {}
+
+def fetch_mirror_index(d):
+    """
+    Return the index from the mirrors in PREMIRRORS of the datastore d, set
+    up for fetching sstate objects as in sstate_checkhashes(). The first
+    mirror with an index is used. Returns the set of names it lists, or None
+    if no mirror has one. The index is only downloaded the first time it is
+    needed in each build, callers must not change the set.
+    """
+    key = (d.getVar("BUILDNAME"), d.getVar("PREMIRRORS"))
+    if key not in mirror_indexes:
+        # The mirror may have changed since the last build so drop what was
+        # fetched for that
+        for other in [k for k in mirror_indexes if k[0] != key[0]]:
+            del mirror_indexes[other]
+        mirror_indexes[key] = download_mirror_index(d)
+    return mirror_indexes[key]
+
+def download_mirror_index(d):
+    """
+    Download the index as for fetch_mirror_index(), whether or not it has
+    been downloaded before
+    """
+    import bb.fetch2
+    import bb.utils
+
+    sstate_dir = d.getVar("SSTATE_DIR")
+    bb.utils.mkdirhier(sstate_dir)
+    with tempfile.TemporaryDirectory(dir=sstate_dir, prefix=".sstate-index.") as tmpdir:
+        localdata = bb.data.createCopy(d)
+        localdata.setVar("DL_DIR", tmpdir)
+        localdata.setVar("FILESPATH", tmpdir)
+        srcuri = "file://" + INDEX_NAME
+        localdata.setVar("SRC_URI", srcuri)
+        try:
+            fetcher = bb.fetch2.Fetch([srcuri], localdata)
+            # A mirror without an index is not an error, so check quietly
+            # before downloading
+            fetcher.checkstatus()
+            fetcher.download()
+            return read_index(fetcher.localpath(srcuri))
+        except (bb.fetch2.BBFetchException, OSError, EOFError, ValueError) as e:
+            bb.debug(2, "SState: No usable sstate mirror index (%s)" % e)
+            return None
@@ -0,0 +1,77 @@
+#
+# Copyright OpenEmbedded Contributors
+#
+# SPDX-License-Identifier: MIT
+#
+
+from unittest.case import TestCase
+import bb, bb.data
+import oe, oe.sstateindex
+import gzip
+import os
+import tempfile
+
+class TestSstateIndex(TestCase):
+    OBJECTS = [
+        "universal/ab/cd/sstate:zlib:core2-64-poky-linux:1.3:r0:core2-64:12:abcd_package.tar.zst",
+        "universal/ab/cd/sstate:zlib:core2-64-poky-linux:1.3:r0:core2-64:12:abcd_package.tar.zst.siginfo",
+        "ubuntu-22.04/12/34/sstate:zlib-native:x86_64-linux:1.3:r0:x86_64:12:1234_populate_sysroot.tar.zst",
+    ]
+    IGNORED = [
+        "universal/ab/cd/sstate:zlib:core2-64-poky-linux:1.3:r0:core2-64:12:abcd_package.tar.zst.done",
+        "universal/ab/cd/sstate:zlib:core2-64-poky-linux:1.3:r0:core2-64:12:abcd_package.tar.zst.Abc123",
+        "universal/README",
+    ]
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory(prefix="sstateindex")
+        self.addCleanup(self.tempdir.cleanup)
+        self.mirror = os.path.join(self.tempdir.name, "mirror")
+        for name in self.OBJECTS + self.IGNORED:
+            os.makedirs(os.path.join(self.mirror, os.path.dirname(name)), exist_ok=True)
+            with open(os.path.join(self.mirror, name), "w"):
+                pass
+        self.addCleanup(oe.sstateindex.mirror_indexes.clear)
+
+    def test_scan(self):
+        self.assertEqual(oe.sstateindex.scan(self.mirror), sorted(self.OBJECTS))
+
+    def test_write_read(self):
+        index = os.path.join(self.mirror, oe.sstateindex.INDEX_NAME)
+        oe.sstateindex.write_index(oe.sstateindex.scan(self.mirror), index)
+        self.assertEqual(oe.sstateindex.read_index(index), set(self.OBJECTS))
+        # No temporary files are left behind
+        self.assertFalse([f for f in os.listdir(self.mirror) if f.startswith(".sstate-index.")])
+
+        with gzip.open(index, "wt") as f:
+            f.write("# some other index\n")
+        with self.assertRaises(ValueError):
+            oe.sstateindex.read_index(index)
+
+    def fetch_index(self, buildname="20260101000000"):
+        d = bb.data.init()
+        d.setVar("BUILDNAME", buildname)
+        sstate_dir = os.path.join(self.tempdir.name, "sstate-cache")
+        d.setVar("SSTATE_DIR", sstate_dir)
+        d.setVar("DL_DIR", sstate_dir)
+        d.setVar("FILESPATH", sstate_dir)
+        d.setVar("PREMIRRORS", "file://.* file://%s/PATH" % self.mirror)
+        return oe.sstateindex.fetch_mirror_index(d)
+
+    def test_fetch_mirror_index(self):
+        index = os.path.join(self.mirror, oe.sstateindex.INDEX_NAME)
+        self.assertIsNone(self.fetch_index(buildname="1"))
+
+        # A mirror without an index isn't asked again during the same build
+        oe.sstateindex.write_index(self.OBJECTS, index)
+        self.assertIsNone(self.fetch_index(buildname="1"))
+
+        # The index is downloaded once in each build
+        self.assertEqual(self.fetch_index(buildname="2"), set(self.OBJECTS))
+        os.unlink(index)
+        self.assertEqual(self.fetch_index(buildname="2"), set(self.OBJECTS))
+
+        oe.sstateindex.write_index(self.OBJECTS[:1], index)
+        self.assertEqual(self.fetch_index(buildname="3"), set(self.OBJECTS[:1]))
+        # Only the current build's indexes are kept
+        self.assertEqual(list(oe.sstateindex.mirror_indexes), [("3", "file://.* file://%s/PATH" % self.mirror)])
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+#
+# Copyright OpenEmbedded Contributors
+#
+# SPDX-License-Identifier: MIT
+#
+# Write the index of the objects in an sstate cache directory which is served
+# as an sstate mirror. Builds setting SSTATE_MIRROR_INDEX = "1" download it
+# rather than asking the mirror about each object they need. Run it again
+# whenever objects are added to or removed from the directory, e.g. after
+# sstate-cache-management.py.
+#
+
+import argparse
+import os
+import sys
+
+scripts_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(scripts_path, "..", "meta", "lib"))
+import oe.sstateindex
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Write the index of an sstate mirror.")
+
+    parser.add_argument(
+        "--cache-dir",
+        default=os.environ.get("SSTATE_CACHE_DIR"),
+        help="""Specify sstate cache directory, will use the environment
+            variable SSTATE_CACHE_DIR if it is not specified.""",
+    )
+
+    parser.add_argument(
+        "-o",
+        "--output",
+        help=f"""Write the index to OUTPUT rather than to
+            {oe.sstateindex.INDEX_NAME} in the cache directory.""",
+    )
+
+    args = parser.parse_args()
+    if not args.cache_dir:
+        parser.error("No sstate cache directory given")
+    return args
+
+
+def main():
+    args = parse_arguments()
+
+    output = args.output or os.path.join(args.cache_dir, oe.sstateindex.INDEX_NAME)
+    names = oe.sstateindex.scan(args.cache_dir)
+    oe.sstateindex.write_index(names, output)
+    print(f"Wrote {len(names)} objects to {output}")
+
+
+if __name__ == "__main__":
+    main()